@@ -0,0 +1,346 @@
+#-------------------------------------------------------------------------------
+# Name:        Extract CLUs by AOI - asyncio API
+# Purpose:     Non-blocking version of the CLU extraction in extract_CLU_by_AOI.py
+#              for embedding in asyncio services.
+#
+# Created:     10/19/2026
+#
+# This module is Python 3 only and does not use arcpy so it can be imported by web
+# services that are not running inside ArcGIS.  It keeps the same query semantics as
+# submitFSquery and getCLUgeometryByExtent (POSTed url-encoded queries against the
+# CLU FeatureServer, token regeneration on 'Invalid Token', a 2nd attempt on a bad
+# response, CLUs de-duplicated by clu_identifier) but instead of subdividing the AOI
+# it requests the object IDs within the AOI once and downloads them in chunks of
+# maxRecordCount.
+#
+# Usage:
+#     session = await openSession(cluRESTurl_Metadata, token)
+#     async for feature in iterCLUfeatures(aoiJSON, session):
+#         ...
+#     await closeSession(session)
+#
+# or, to push every feature into a callable (or coroutine function):
+#     count = await extract(aoiJSON, sink, token=token)
+#
+# Many extractions can share one session (one connection pool, one concurrency limit).
+# http.client is blocking; every session runs its requests on its own thread pool of
+# maxConcurrency threads so that the default executor of the application is not used.
+# A plain tokenProvider runs on the same thread pool.  iterCLUfeatures keeps no more than
+# maxPendingChunks chunk requests ahead of its consumer.
+#-------------------------------------------------------------------------------
+
+## ====================================== Imports ====================================
+import asyncio, json, http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+cluRESTurl_Metadata = """https://gis.sc.egov.usda.gov/appserver/rest/services/common_land_units/common_land_units/FeatureServer/0"""
+
+## ===================================================================================
+def openConnection(session):
+    """ This function will return a new keep-alive HTTP(S) connection to the host
+        of the feature service.  Connections are tracked in the session so that
+        closeSession can close the ones that are in use as well."""
+
+    if session['scheme'] == 'https':
+        conn = http.client.HTTPSConnection(session['host'],timeout=session['timeout'])
+    else:
+        conn = http.client.HTTPConnection(session['host'],timeout=session['timeout'])
+
+    session['connections'].add(conn)
+    return conn
+
+## ===================================================================================
+def discardConnection(session,conn):
+    """ This function will close a connection and stop tracking it."""
+
+    conn.close()
+    session['connections'].discard(conn)
+
+## ===================================================================================
+async def openSession(layerURL,token,maxConcurrency=4,tokenProvider=None,timeout=120):
+    """ This function will create a session that is shared by extractions running on
+        the same event loop.  The session holds a pool of keep-alive connections that
+        is also the concurrency limit; no more than maxConcurrency requests are in
+        flight at any time regardless of how many extractions are running.  The
+        blocking requests run on a thread pool of maxConcurrency threads owned by
+        the session.
+
+        layerURL - URL of the FeatureServer layer (without /query)
+        token - portal token string
+        tokenProvider - optional callable (or coroutine function) returning a new
+                        token string; used when the service answers 'Invalid Token'.
+                        A plain callable usually makes a blocking request so it runs
+                        on the session thread pool.
+
+        The layer definition is requested once and stored in the session so that
+        maxRecordCount is known.
+
+        Returns the session dictionary"""
+
+    urlParts = urlsplit(layerURL.rstrip('/'))
+
+    session = {'scheme':urlParts.scheme,
+               'host':urlParts.netloc,
+               'layerPath':urlParts.path,
+               'queryPath':urlParts.path + '/query',
+               'token':token,
+               'tokenProvider':tokenProvider,
+               'timeout':timeout,
+               'pool':asyncio.Queue(),
+               'connections':set(),   # every open connection; pooled or in use
+               'executor':ThreadPoolExecutor(maxConcurrency),
+               'maxConcurrency':maxConcurrency,
+               'closed':False}
+
+    for i in range(maxConcurrency):
+        session['pool'].put_nowait(openConnection(session))
+
+    session['metadata'] = await submitFSqueryAsync(session,session['layerPath'],{'f':'json'})
+
+    if not session['metadata'] or not 'maxRecordCount' in session['metadata']:
+        session['maxRecordCount'] = 1000
+    else:
+        session['maxRecordCount'] = session['metadata']['maxRecordCount']
+
+    return session
+
+## ===================================================================================
+async def closeSession(session):
+    """ This function will close every connection of the session, including the ones
+        of requests still in flight, and shut down its thread pool.  Requests in
+        flight fail."""
+
+    session['closed'] = True
+
+    while not session['pool'].empty():
+        session['pool'].get_nowait()
+
+    for conn in list(session['connections']):
+        discardConnection(session,conn)
+
+    session['executor'].shutdown(wait=False)
+
+## ===================================================================================
+async def postRequest(session,path,body):
+    """ This function will POST a url-encoded body using a pooled connection.  The
+        blocking http.client call runs on the session thread pool so the event loop
+        is never blocked.  If the calling task is cancelled while the request is in
+        flight the connection is discarded once the request finishes and replaced
+        with a new one so that the pool never hands out a connection in an unknown
+        state.
+
+        Returns a tuple of (status, response bytes)"""
+
+    if session['closed']:
+        raise IOError("The session is closed")
+
+    loop = asyncio.get_running_loop()
+    conn = await session['pool'].get()
+
+    def send():
+        try:
+            conn.request('POST',path,body,{'Content-Type':'application/x-www-form-urlencoded'})
+            resp = conn.getresponse()
+            return resp.status, resp.read()
+        except (http.client.HTTPException,OSError):
+            # stale keep-alive connection; reconnect and send once more
+            conn.close()
+            conn.request('POST',path,body,{'Content-Type':'application/x-www-form-urlencoded'})
+            resp = conn.getresponse()
+            return resp.status, resp.read()
+
+    future = loop.run_in_executor(session['executor'],send)
+    try:
+        result = await asyncio.shield(future)
+
+        if session['closed']:
+            discardConnection(session,conn)
+        else:
+            session['pool'].put_nowait(conn)
+        return result
+
+    except asyncio.CancelledError:
+        future.add_done_callback(lambda f: discardConnection(session,conn))
+        if not session['closed']:
+            session['pool'].put_nowait(openConnection(session))
+        raise
+
+    except Exception:
+        discardConnection(session,conn)
+        if not session['closed']:
+            session['pool'].put_nowait(openConnection(session))
+        raise
+
+## ===================================================================================
+async def submitFSqueryAsync(session,path,params):
+    """ This function is the asyncio equivalent of submitFSquery.  It will send a
+        query to the feature service and convert the results into a python structure.
+        If the service returns 'Invalid Token' the token is regenerated with the
+        session tokenProvider and the request is sent again.  If the results are an
+        error, empty or not JSON (i.e. an HTML error page of a proxy), or the request
+        failed, a 2nd attempt is made after 5 seconds.
+
+        params - dictionary of query parameters; the session token is added
+
+        Returns requested data via a python dictionary; False if both attempts failed"""
+
+    async def send():
+        requestParams = dict(params)
+        requestParams['token'] = session['token']
+
+        try:
+            status, jsonString = await postRequest(session,path,urlencode(requestParams))
+        except (http.client.HTTPException,OSError) as e:
+            # i.e. connection refused or timed out
+            return {'error':{'code':None,'message':str(e)}}
+
+        if status >= 400:
+            return {'error':{'code':status,'message':'HTTP ERROR'}}
+
+        try:
+            return json.loads(jsonString)
+        except ValueError:
+            return {'error':{'code':status,'message':'Response is not JSON'}}
+
+    try:
+        results = await send()
+
+        # Check for expired token; Update if expired and try again
+        if 'error' in results and results['error'].get('message') == 'Invalid Token' and session['tokenProvider']:
+            if asyncio.iscoroutinefunction(session['tokenProvider']):
+                newToken = await session['tokenProvider']()
+            else:
+                loop = asyncio.get_running_loop()
+                newToken = await loop.run_in_executor(session['executor'],session['tokenProvider'])
+                if asyncio.iscoroutine(newToken):
+                    newToken = await newToken
+            session['token'] = newToken
+            results = await send()
+
+        # Check results before returning them; Attempt a 2nd request if results are bad.
+        if 'error' in results or len(results) == 0:
+            await asyncio.sleep(5)
+            results = await send()
+
+            if 'error' in results or len(results) == 0:
+                return False
+
+        return results
+
+    except asyncio.CancelledError:
+        raise
+
+    except Exception:
+        return False
+
+## ===================================================================================
+async def iterCLUfeatures(aoi,session,outFields='*',returnGeometry=True,maxPendingChunks=None):
+    """ This function is an async iterator of the CLU features within the AOI.  The
+        object IDs within the AOI are requested once (returnIdsOnly requests are not
+        limited by maxRecordCount) and are then downloaded in chunks of
+        maxRecordCount.  Chunks are requested concurrently; the session pool bounds
+        how many are in flight.  Features are yielded as soon as their chunk arrives
+        and CLUs are de-duplicated by clu_identifier.
+
+        No more than maxPendingChunks chunks are requested or held ahead of the
+        consumer; a new chunk is only requested once a previous one was handed out.
+        A slow consumer of a large AOI therefore does not pile up downloaded chunks
+        or thousands of waiting tasks.
+
+        aoi - ESRI JSON polygon as a string or dictionary
+              i.e. '{"rings":[[[-90.11,37.00],...]],"spatialReference":{"wkid":4326}}'
+        maxPendingChunks - defaults to twice the session maxConcurrency
+
+        Yields feature dictionaries as returned by the feature service
+        {'attributes': {'clu_identifier': '73F53BC1-...'}, 'geometry': {'rings': [...]}}"""
+
+    if not isinstance(aoi,str):
+        aoi = json.dumps(aoi)
+
+    idQuery = await submitFSqueryAsync(session,session['queryPath'],
+                                       {'f':'json',
+                                        'geometry':aoi,
+                                        'geometryType':'esriGeometryPolygon',
+                                        'returnIdsOnly':'true'})
+    if not idQuery:
+        raise IOError("Failed to get the CLU object IDs within the AOI")
+
+    objectIds = sorted(idQuery.get('objectIds') or [])
+    chunkSize = session['maxRecordCount']
+    chunks = [objectIds[i:i + chunkSize] for i in range(0,len(objectIds),chunkSize)]
+
+    async def fetchChunk(chunk):
+        results = await submitFSqueryAsync(session,session['queryPath'],
+                                           {'f':'json',
+                                            'objectIds':','.join([str(oid) for oid in chunk]),
+                                            'returnGeometry':'true' if returnGeometry else 'false',
+                                            'outFields':outFields})
+        if not results:
+            raise IOError("Failed to download " + str(len(chunk)) + " CLUs")
+        return results.get('features',[])
+
+    if not maxPendingChunks:
+        maxPendingChunks = 2 * session['maxConcurrency']
+
+    chunks = iter(chunks)
+    pending = set()          # chunk tasks requested but not yet handed out
+    cluIdentifiers = set()   # Unique set of CLUs used to avoid duplicates
+
+    try:
+        while True:
+            for chunk in chunks:
+                pending.add(asyncio.ensure_future(fetchChunk(chunk)))
+                if len(pending) >= maxPendingChunks:
+                    break
+
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending,return_when=asyncio.FIRST_COMPLETED)
+            done = list(done)
+
+            while done:
+                for feature in done.pop().result():
+                    cluID = feature['attributes'].get('clu_identifier')
+
+                    if cluID is not None:
+                        if cluID in cluIdentifiers:
+                            continue
+                        cluIdentifiers.add(cluID)
+
+                    yield feature
+
+    finally:
+        # extraction finished, failed or was cancelled; don't leave requests behind
+        for task in pending:
+            task.cancel()
+
+## ===================================================================================
+async def extract(aoi,sink,session=None,token=None,maxConcurrency=4,tokenProvider=None,
+                  layerURL=cluRESTurl_Metadata,outFields='*',returnGeometry=True):
+    """ This function will extract the CLUs within the AOI and hand every feature to
+        sink.  sink can be a plain callable or a coroutine function.  If no session
+        is passed in a session is opened for this extraction and closed afterwards;
+        pass a shared session to run many extractions over one connection pool.
+        Cancelling the task running extract cancels all of its pending requests.
+
+        Returns the number of CLUs passed to sink"""
+
+    bOwnSession = session is None
+    if bOwnSession:
+        session = await openSession(layerURL,token,maxConcurrency,tokenProvider)
+
+    try:
+        count = 0
+        async for feature in iterCLUfeatures(aoi,session,outFields,returnGeometry):
+            result = sink(feature)
+            if asyncio.iscoroutine(result):
+                await result
+            count += 1
+
+        return count
+
+    finally:
+        if bOwnSession:
+            await closeSession(session)
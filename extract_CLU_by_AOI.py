@@ -74,6 +74,103 @@
 #   generated.  They were based on the coord system of the data frame vs. layer.
 #   Introduced code to temporarily change the coord system of the data frame to the AOI.
 
+# ==========================================================================================
+# Modified 10/19/2026
+# - Added an optional FlatGeobuf (.fgb) output.  CLUs are streamed into a spool file as
+#   they are downloaded and a packed Hilbert R-tree index is built when the file is
+#   closed so that consumers can do bbox lookups over HTTP range requests.  FlatBuffers
+#   are serialized by hand (buildFlatbuffer) b/c the flatbuffers library is not part of
+#   the ArcGIS python install.  Set bFlatGeobufOutput to True to enable.
+# - Added a sharded mode for large runs.  The planned envelopes are split into spatially
+#   coherent shards (hilbert order) and each shard is downloaded by a separate worker
+#   process into its own scratch FGDB.  The partial outputs are merged at the end and
+#   duplicates along shard boundaries are resolved by clu_identifier.  Set numOfShards
+#   to the number of worker processes to enable.  The worker (extractShard) is in
+#   extract_CLU_shard.py, which must be kept next to this script.  Script tools run in
+#   process in ArcGIS Pro where this script can not be imported by a worker process;
+#   the workers only import extract_CLU_shard.
+# - Added a bounded-memory streaming mode.  createListOfJSONextents was split into the
+#   iterJSONextents generator so that requests can be downloaded as soon as they are
+#   planned.  clu_identifiers used for de-duplication are kept in a set that spills to
+#   a temporary sqlite database past cluIdentifierMemoryLimit.  FlatGeobuf outputs are
+#   written without a spatial index in this mode.  Set bStreamingMode to True to enable.
+# - Reduced the size of the geometry sent with every count and CLU request
+#   (getRequestGeometry).  Pieces whose bounding box is entirely within the AOI are sent
+#   as an esriGeometryEnvelope; all other pieces are buffered outward and generalized so
+#   the simplified polygon still covers the piece.  Each part of a multipart AOI is
+#   planned separately.  Exact AOI filtering is still done by the final select by location.
+# - Added ID-diff fetching to getCLUgeometryByExtent.  The object IDs of each extent are
+#   requested first and only IDs not already ingested are downloaded with geometry using
+#   the objectIds parameter.  Set bIDdiffFetching to True to enable.
+# - Added field selection (outputFields).  Only the selected fields are created in the
+#   output, requested via outFields and inserted.  Setting bReturnGeometry to False
+#   creates an attribute-only table and requests CLUs with returnGeometry=false.
+# - The CLU service metadata is cached in the scratch folder and revalidated on every
+#   run against the editingInfo of the feature service; metadataCacheMaxAge only
+#   limits how old a cached copy may be when the service cannot be reached.  Outputs are created in one operation from a schema template kept in the
+#   scratch GDB instead of one AddField call per field (getSchemaTemplate).
+# - Added a dry run (bDryRun) that only plans the requests and reports the number of
+#   requests, expected CLUs and estimated download size and time.  The estimate is
+#   calibrated on the download statistics of previous runs kept in the scratch folder.
+#   Plans can be exported to GeoJSON (planExportPath) and re-used (planImportPath).
+# - Added a CLU density grid (densityGridFile) for planning requests without count
+#   queries.  The grid holds the CLU count of every cell and is populated by a one-time
+#   sweep (bSweepDensityGrid) or from the counts discovered by regular runs.  Requests
+#   are planned by k-d splitting the grid cells covering the AOI at the count-weighted
+#   median using prefix sums; only the densest few are verified with a count query.
+# - Added attribute-partitioned planning (bAttributePartitioning).  One outStatistics
+#   query grouped by the administrative partitionFields gives the exact CLU count of every
+#   partition within the AOI.  Requests use a where clause per partition (split into
+#   objectId ranges above maxRecordCount) so requests never overlap.
+# - Added a sampled profiling mode (profileSampleRate).  The planning, request, decode,
+#   transform, insert and final filter stages each get a cProfile profiler and tracemalloc
+#   peaks/allocation snapshots; a per-stage hotspot, allocation and memory timeline report
+#   is written to the scratch folder.
+# - Added an optional GeoParquet output (bGeoParquetOutput) for parallel downstream readers.
+#   CLUs are written as WKB with a bbox covering column into hive-style partitions by
+#   quadkey or by CLU fields (i.e. state/county).  Row groups are hilbert ordered so their
+#   bbox statistics allow predicate pushdown.
+# - Added load balancing across equivalent CLU service endpoints (cluServiceEndpoints).
+#   Requests are spread across endpoints weighted by their measured latency and error
+#   rate; endpoints that fail repeatedly are ejected with a backoff and re-admitted.
+# - Added a service capability probe (probeServiceCapabilities) that checks the extraction
+#   strategy of a run against the service (extractionStrategy).  The default is the
+#   original subdivision of the AOI; paged requests of maxRecordCount x
+#   maxRecordCountFactor CLUs are opt-in ('paged') and 'auto' picks attribute partitions
+#   if the service supports statistics.
+# - Added an update mode (bUpdateMode) for nightly syncs.  CLUs are extracted into the
+#   scratch GDB and compared to per-CLU hashes of the previous run stored next to the
+#   output; only inserts, updates and deletes are applied to CLU_<AOI> (applyCLUchanges).
+# - Added a columnar spool (bColumnSpool).  Downloaded CLUs are appended to per-field
+#   files (fixed width values, offsets + blob for text and WKB geometry) and bulk loaded
+#   into the output through one InsertCursor at the end; columns are read back as numpy
+#   memory maps.
+# - Added adaptive concurrency (bAdaptiveConcurrency).  Requests are downloaded on several
+#   threads and inserted on the main thread; an AIMD controller in submitFSquery raises the
+#   number of requests in flight while p95 latency and error rate are under their targets
+#   and halves it on 5xx responses, timeouts or latency spikes.  getCLUgeometryByExtent
+#   was split into fetchCLUgeometry and insertCLUgeometry.
+# - Added coalescing of planned requests (bCoalesceRequests).  Adjacent requests whose
+#   combined CLU count fits within maxRecordCount less a margin are merged into a single
+#   request geometry, best fit and smallest first.
+# - Added median splitting (bMedianSplitting).  The object IDs within a piece and the
+#   centroids of a random sample of them are requested and the piece is cut k-d tree
+#   style at the median centroid so every cut halves the CLU count instead of the area.
+#   Block counts are estimated from the sample; only blocks that may exceed the limit
+#   are verified with a count query.
+# - Added fetch-first mode (bFetchFirst).  Pieces go straight to the geometry query and
+#   are only split when the response exceeded the WFS limit, so pieces within the limit
+#   cost one round trip and downloads start with the first response.  Pieces likely to
+#   be over the limit are counted first and failed pieces are split before a retry.
+# - Added a File Geodatabase bulk-load mode (bFGDBbulkLoad).  The spatial index is removed
+#   before CLUs are inserted and rebuilt at the end with a grid size calculated from the
+#   CLU extents, along with an attribute index on clu_identifier.
+# - Added a local CLU mirror (cluMirrorFile); a sqlite database of the CLU layer, or a
+#   subset of it, with an R-tree spatial index.  bSyncCLUmirror synchronizes it with an
+#   object ID diff and an edit date query; AOIs covered by a mirror that is current are
+#   extracted from it instead of the CLU service.  An AOI is covered by a subset mirror
+#   only if the service has no CLUs within the AOI outside of the subset.
+
 #-------------------------------------------------------------------------------
 
 ## ==============================================================================================================================
@@ -82,19 +179,38 @@ def AddMsgAndPrint(msg, severity=0):
     # Adds tool message to the geoprocessor
     #
     #Split the message on \n first, so that if it's multiple lines, a GPMessage will be added for each line
+    #
+    # arcpy is not thread safe; messages of download threads are queued and written
+    # by the main thread the next time it adds a message.
+    try:
+        threadMessages.append((msg,severity))
+
+        if threading.current_thread().name != 'MainThread':
+            return
+
+        writeQueuedMessages()
+
+    except:
+        pass
+
+## ==============================================================================================================================
+def writeQueuedMessages():
+    # writes the queued messages in the order they were added; main thread only
     try:
+        while threadMessages:
+            msg,severity = threadMessages.popleft()
 
-        #print(msg)
-        #for string in msg.split('\n'):
-            #Add a geoprocessing message (in case this is run as a tool)
-        if severity == 0:
-            arcpy.AddMessage(msg)
+            #print(msg)
+            #for string in msg.split('\n'):
+                #Add a geoprocessing message (in case this is run as a tool)
+            if severity == 0:
+                arcpy.AddMessage(msg)
 
-        elif severity == 1:
-            arcpy.AddWarning(msg)
+            elif severity == 1:
+                arcpy.AddWarning(msg)
 
-        elif severity == 2:
-            arcpy.AddError("\n" + msg)
+            elif severity == 2:
+                arcpy.AddError("\n" + msg)
 
     except:
         pass
@@ -361,6 +477,282 @@ def getPortalTokenInfo(portalURL):
         errorMsg()
         return False
 
+## ===================================================================================
+def configureEndpoints(layerURLs):
+    """ This function will set the list of equivalent CLU FeatureServer layers that
+        requests are balanced across (i.e. the authoritative service and an internal
+        cached replica).  Every endpoint keeps a moving average of its latency and
+        error rate that is updated by submitFSquery.
+
+        layerURLs - ['https://gis.sc.egov.usda.gov/.../FeatureServer/0','https://replica/.../FeatureServer/0']"""
+
+    endpointState['endpoints'] = [{'url':url.rstrip('/'),
+                                   'latency':None,           # moving average of seconds per request
+                                   'errorRate':0.0,          # moving average of failed requests
+                                   'consecutiveErrors':0,
+                                   'requests':0,
+                                   'errors':0,
+                                   'ejections':0,
+                                   'ejectedUntil':0} for url in layerURLs]
+
+## ===================================================================================
+def resolveEndpoint(url):
+    """ This function will pick the endpoint that a request to url is sent to and
+        return the url re-written to that endpoint.  Endpoints that have not been
+        measured yet and have not failed are tried in turn (fewest requests first);
+        after that endpoints are picked at random weighted by their expected seconds
+        per successful request (latency / (1 - error rate)) so faster and healthier
+        endpoints get a larger share of the requests while slower ones are still
+        measured.  An endpoint that failed before its first successful request is
+        weighted with the average latency of the measured endpoints and its error
+        rate.  Ejected endpoints are skipped until their ejection expires; if every
+        endpoint is ejected the one that expires first is used.
+
+        Returns a tuple of (url, endpoint); endpoint is None if url does not belong
+        to a configured endpoint."""
+
+    with stateLock:
+        endpoints = endpointState['endpoints']
+        matches = [ep for ep in endpoints if url.startswith(ep['url'])]
+
+        if not matches:
+            return url,None
+
+        path = url[len(max(matches,key=lambda ep: len(ep['url']))['url']):]
+
+        if len(endpoints) == 1:
+            return endpoints[0]['url'] + path,endpoints[0]
+
+        now = time.time()
+        healthy = [ep for ep in endpoints if ep['ejectedUntil'] <= now]
+        if not healthy:
+            healthy = [min(endpoints,key=lambda ep: ep['ejectedUntil'])]
+
+        unmeasured = [ep for ep in healthy if ep['latency'] is None and not ep['errors']]
+        if unmeasured:
+            endpoint = min(unmeasured,key=lambda ep: ep['requests'])
+        else:
+            measured = [ep['latency'] for ep in healthy if ep['latency'] is not None]
+            defaultLatency = sum(measured) / len(measured) if measured else 1.0
+            weights = [max(0.05,1.0 - ep['errorRate']) / max(0.001,defaultLatency if ep['latency'] is None else ep['latency']) for ep in healthy]
+            pick = random.random() * sum(weights)
+            for endpoint,weight in zip(healthy,weights):
+                pick -= weight
+                if pick <= 0:
+                    break
+
+        return endpoint['url'] + path,endpoint
+
+## ===================================================================================
+def recordEndpointResult(endpoint,seconds,bError):
+    """ This function will update the latency and error rate of an endpoint after a
+        request.  An endpoint that fails 3 requests in a row is ejected for 30 seconds;
+        the ejection doubles every time it is ejected again (max 5 minutes).  Once the
+        ejection expires the endpoint is re-admitted with the error rate it had and is
+        fully trusted again after its first successful request."""
+
+    with stateLock:
+        if not endpoint:
+            return
+
+        endpoint['requests'] += 1
+
+        if bError:
+            endpoint['errors'] += 1
+            endpoint['consecutiveErrors'] += 1
+            endpoint['errorRate'] = (0.7 * endpoint['errorRate']) + 0.3
+
+            if endpoint['consecutiveErrors'] >= 3 and len(endpointState['endpoints']) > 1:
+                endpoint['ejections'] += 1
+                ejectSeconds = min(300,30 * 2 ** (endpoint['ejections'] - 1))
+                endpoint['ejectedUntil'] = time.time() + ejectSeconds
+                endpoint['consecutiveErrors'] = 0
+                AddMsgAndPrint("\tEndpoint " + endpoint['url'] + " ejected for " + str(ejectSeconds) + " seconds after repeated errors",1)
+
+        else:
+            if endpoint['ejections']:
+                AddMsgAndPrint("\tEndpoint " + endpoint['url'] + " re-admitted")
+                endpoint['ejections'] = 0
+                endpoint['ejectedUntil'] = 0
+
+            endpoint['consecutiveErrors'] = 0
+            endpoint['errorRate'] = 0.7 * endpoint['errorRate']
+
+            if endpoint['latency'] is None:
+                endpoint['latency'] = seconds
+            else:
+                endpoint['latency'] = (0.7 * endpoint['latency']) + (0.3 * seconds)
+
+## ===================================================================================
+def logEndpointSummary():
+    """ This function will report the number of requests, errors and the average
+        latency of every endpoint when more than one endpoint is configured."""
+
+    if len(endpointState['endpoints']) < 2:
+        return
+
+    AddMsgAndPrint("\nService endpoints:")
+    for endpoint in endpointState['endpoints']:
+        latency = "n/a" if endpoint['latency'] is None else str(round(endpoint['latency'],2)) + " sec"
+        AddMsgAndPrint("\t" + endpoint['url'] + " -- " + splitThousands(endpoint['requests']) + " requests -- " +
+                       splitThousands(endpoint['errors']) + " errors -- latency " + latency)
+
+## ===================================================================================
+def configureConcurrency(maxConcurrency=8,targetP95=30,targetErrorRate=0.05):
+    """ This function will turn on the AIMD (additive increase, multiplicative
+        decrease) controller of the number of requests submitFSquery has in flight.
+        The limit starts at 1 and is raised by 1 for every window of successful
+        requests while the 95th percentile latency of the last 50 requests stays under
+        targetP95 seconds and their error rate under targetErrorRate.  It is halved
+        on a 5xx response, a timeout or a latency spike (a request taking more than
+        twice targetP95), at most once per round trip.
+
+        The limit only matters when requests are sent from several threads
+        (downloadRequestsConcurrently)."""
+
+    concurrencyState.update({'enabled':True,
+                             'limit':1.0,
+                             'max':max(1,maxConcurrency),
+                             'inFlight':0,
+                             'peak':0,
+                             'targetP95':targetP95,
+                             'targetErrorRate':targetErrorRate,
+                             'latencies':collections.deque(maxlen=50),
+                             'errors':collections.deque(maxlen=50),
+                             'lastDecrease':0,
+                             'condition':threading.Condition()})
+
+## ===================================================================================
+def acquireRequestSlot():
+    """ This function will block until fewer requests than the current concurrency
+        limit are in flight and then count the calling request as in flight."""
+
+    state = concurrencyState
+    if not state['enabled']:
+        return
+
+    with state['condition']:
+        while state['inFlight'] >= int(state['limit']):
+            state['condition'].wait(1.0)
+
+        state['inFlight'] += 1
+        state['peak'] = max(state['peak'],state['inFlight'])
+
+## ===================================================================================
+def releaseRequestSlot(seconds,bError=False,bOverload=False):
+    """ This function will release the slot of a finished request and adjust the
+        concurrency limit from its latency and outcome.
+
+        bError - the service returned an error
+        bOverload - 5xx response, timeout or connection failure"""
+
+    state = concurrencyState
+    if not state['enabled']:
+        return
+
+    with state['condition']:
+        state['inFlight'] = max(0,state['inFlight'] - 1)
+        state['errors'].append(bError or bOverload)
+        if not bOverload:
+            state['latencies'].append(seconds)
+
+        latencies = sorted(state['latencies'])
+        p95 = latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0
+        errorRate = float(sum(state['errors'])) / len(state['errors'])
+        now = time.time()
+
+        bSpike = seconds > 2 * state['targetP95']
+        oldLimit = int(state['limit'])
+
+        if bOverload or bSpike:
+            # one decrease per round trip; requests of the same window fail together
+            if now - state['lastDecrease'] > max(p95,1.0):
+                state['limit'] = max(1.0,state['limit'] * 0.5)
+                state['lastDecrease'] = now
+                reason = "latency spike" if bSpike and not bOverload else "server overload"
+                AddMsgAndPrint("\tConcurrency reduced to " + str(int(state['limit'])) + " (" + reason + ")",1)
+
+        elif p95 <= state['targetP95'] and errorRate <= state['targetErrorRate']:
+            state['limit'] = min(float(state['max']),state['limit'] + 1.0 / state['limit'])
+
+            if int(state['limit']) > oldLimit:
+                AddMsgAndPrint("\tConcurrency raised to " + str(int(state['limit'])))
+
+        state['condition'].notify_all()
+
+## ===================================================================================
+def getConcurrencyStatus():
+    """ This function will return the current state of the concurrency controller for
+        monitoring.
+        {'current': 3, 'target': 4, 'peak': 6, 'p95': 2.4, 'errorRate': 0.0}"""
+
+    state = concurrencyState
+    if not state['enabled']:
+        return {'current':0,'target':1,'peak':0,'p95':0,'errorRate':0.0}
+
+    with state['condition']:
+        latencies = sorted(state['latencies'])
+        return {'current':state['inFlight'],
+                'target':int(state['limit']),
+                'peak':state['peak'],
+                'p95':latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0,
+                'errorRate':float(sum(state['errors'])) / len(state['errors']) if state['errors'] else 0.0}
+
+## ===================================================================================
+def regeneratePortalToken(expiredToken):
+    """ This function will replace the expired portal token with a new one.  If the
+        token was already regenerated for another request the current token is
+        returned instead of requesting yet another one.
+
+        Returns the portal token dictionary"""
+
+    global portalToken
+
+    if portalToken and portalToken['token'] != expiredToken:
+        return portalToken
+
+    AddMsgAndPrint("\tRegenerating ArcGIS Token Information")
+
+    # Update the original portalToken
+    portalToken = arcpy.GetSigninToken()
+    return portalToken
+
+## ===================================================================================
+def callOnMainThread(function):
+    """ This function will run function on the main thread and return its result.
+        arcpy is not thread safe so download threads hand arcpy calls (i.e.
+        arcpy.GetSigninToken) to the main thread, which runs them while it waits for
+        downloads (serviceMainThreadCalls).  Called from the main thread the function
+        is simply run."""
+
+    if threading.current_thread().name == 'MainThread':
+        return function()
+
+    call = {'function':function,'result':None,'done':threading.Event()}
+    mainThreadCalls.put(call)
+    call['done'].wait()
+    return call['result']
+
+## ===================================================================================
+def serviceMainThreadCalls():
+    """ This function will run the calls that download threads handed to the main
+        thread (callOnMainThread) and write their queued messages."""
+
+    while True:
+        try:
+            call = mainThreadCalls.get_nowait()
+        except queue.Empty:
+            break
+
+        try:
+            call['result'] = call['function']()
+        except:
+            errorMsg()
+        finally:
+            call['done'].set()
+
+    writeQueuedMessages()
+
 ## ===================================================================================
 def submitFSquery(url,INparams):
     """ This function will send a spatial query to a web feature service and convert
@@ -373,46 +765,66 @@ def submitFSquery(url,INparams):
         Error produced with invalid token
         {u'error': {u'code': 498, u'details': [], u'message': u'Invalid Token'}}
 
+        Requests to a configured endpoint are balanced across the equivalent
+        endpoints (resolveEndpoint) and their latency and errors are recorded.
+
         The function returns requested data via a python dictionary"""
 
+    endpoint = None
+    bSlotHeld = False
     try:
+        beginProfileStage('request')
+        url,endpoint = resolveEndpoint(url)
+        acquireRequestSlot()
+        bSlotHeld = True
+        requestStart = time.time()
+
         # Python 3.6 - ArcPro
         # Data should be in bytes; new in Python 3.6
         if bArcGISPro:
             INparams = INparams.encode('ascii')
-            resp = urllib.request.urlopen(url,INparams)  # A failure here will probably throw an HTTP exception
+            resp = urllib.request.urlopen(url,INparams,timeout=requestTimeout)  # A failure here will probably throw an HTTP exception
         # Python 2.7 - ArcMap
         else:
             req = urllib2.Request(url,INparams)
-            resp = urllib2.urlopen(req)
+            resp = urllib2.urlopen(req,timeout=requestTimeout)
 
         responseStatus = resp.getcode()
         responseMsg = resp.msg
         jsonString = resp.read()
+        with stateLock:
+            requestStats['requests'] += 1
+            requestStats['bytes'] += len(jsonString)
+        requestSeconds = time.time() - requestStart
+        endProfileStage('request')
 
         # json --> Python; dictionary containing 1 key with a list of lists
+        beginProfileStage('decode')
         results = json.loads(jsonString)
+        endProfileStage('decode')
+
+        # an expired token is not the endpoint's fault
+        recordEndpointResult(endpoint,requestSeconds,'error' in results and results['error'].get('message') != 'Invalid Token')
+        releaseRequestSlot(requestSeconds,'error' in results and results['error'].get('message') != 'Invalid Token')
+        bSlotHeld = False
 
         # Check for expired token; Update if expired and try again
         if 'error' in results.keys():
            if results['error']['message'] == 'Invalid Token':
-               AddMsgAndPrint("\tRegenerating ArcGIS Token Information")
-
-               # Get new ArcPro Token
-               newToken = arcpy.GetSigninToken()
-
-               # Update the original portalToken
-               global portalToken
-               portalToken = newToken
 
                # convert encoded string into python structure and update token
                # by parsing the encoded query strting into list of (name, value pairs)
                # i.e [('f', 'json'),('token','U62uXB9Qcd1xjyX1)]
                # convert to dictionary and update the token in dictionary
 
-               queryString = parseQueryString(params)
-
+               # INparams was encoded to bytes for ArcPro
+               queryString = parseQueryString(INparams.decode('ascii') if bArcGISPro else INparams)
                requestDict = dict(queryString)
+
+               # Get new ArcPro Token; arcpy is only called from the main thread
+               expiredToken = requestDict.get('token')
+               newToken = callOnMainThread(lambda: regeneratePortalToken(expiredToken))
+
                requestDict.update(token=newToken['token'])
 
                newParams = urllibEncode(requestDict)
@@ -424,33 +836,56 @@ def submitFSquery(url,INparams):
                INparams = newParams
 
                # Python 3.6 - ArcPro
+               acquireRequestSlot()
+               bSlotHeld = True
+               requestStart = time.time()
                if bArcGISPro:
-                   resp = urllib.request.urlopen(url,newParams)  # A failure here will probably throw an HTTP exception
+                   resp = urllib.request.urlopen(url,newParams,timeout=requestTimeout)  # A failure here will probably throw an HTTP exception
                else:
                    req = urllib2.Request(url,newParams)
-                   resp = urllib2.urlopen(req)
+                   resp = urllib2.urlopen(req,timeout=requestTimeout)
 
                responseStatus = resp.getcode()
                responseMsg = resp.msg
                jsonString = resp.read()
+               with stateLock:
+                   requestStats['requests'] += 1
+                   requestStats['bytes'] += len(jsonString)
+               requestSeconds = time.time() - requestStart
 
                results = json.loads(jsonString)
+               recordEndpointResult(endpoint,requestSeconds,'error' in results)
+               releaseRequestSlot(requestSeconds,'error' in results)
+               bSlotHeld = False
 
         # Check results before returning them; Attempt a 2nd request if results are bad.
         if 'error' in results.keys() or len(results) == 0:
             time.sleep(5)
 
+            # the 2nd attempt may go to a different endpoint
+            url,endpoint = resolveEndpoint(url)
+            acquireRequestSlot()
+            bSlotHeld = True
+            requestStart = time.time()
+
             if bArcGISPro:
-                resp = urllib.request.urlopen(url,INparams)  # A failure here will probably throw an HTTP exception
+                resp = urllib.request.urlopen(url,INparams,timeout=requestTimeout)  # A failure here will probably throw an HTTP exception
             else:
                 req = urllib2.Request(url,INparams)
-                resp = urllib2.urlopen(req)
+                resp = urllib2.urlopen(req,timeout=requestTimeout)
 
             responseStatus = resp.getcode()
             responseMsg = resp.msg
             jsonString = resp.read()
+            with stateLock:
+                requestStats['requests'] += 1
+                requestStats['bytes'] += len(jsonString)
+            requestSeconds = time.time() - requestStart
 
             results = json.loads(jsonString)
+            recordEndpointResult(endpoint,requestSeconds,'error' in results)
+            releaseRequestSlot(requestSeconds,'error' in results)
+            bSlotHeld = False
 
             if 'error' in results.keys() or len(results) == 0:
                 AddMsgAndPrint("\t2nd Request Attempt Failed - Error Code: " + str(responseStatus) + " -- " + responseMsg + " -- " + str(results),2)
@@ -462,6 +897,9 @@ def submitFSquery(url,INparams):
              return results
 
     except httpErrors as e:
+        recordEndpointResult(endpoint,0,True)
+        if bSlotHeld:
+            releaseRequestSlot(0,True,int(e.code) >= 500)
 
         if int(e.code) >= 500:
            #AddMsgAndPrint("\n\t\tHTTP ERROR: " + str(e.code) + " ----- Server side error. Probably exceed JSON imposed limit",2)
@@ -475,41 +913,123 @@ def submitFSquery(url,INparams):
            AddMsgAndPrint('HTTP ERROR = ' + str(e.code),2)
 
     except:
+        # i.e. connection refused or timed out
+        recordEndpointResult(endpoint,0,True)
+        if bSlotHeld:
+            releaseRequestSlot(0,True,True)
         errorMsg()
         return False
 
 ## ===================================================================================
-def createListOfJSONextents(inFC,RESTurl):
-    """ This function will deconstruct the input FC into JSON format and determine if the
+def getRequestGeometry(geometry,aoiGeometry,bGeometry=True):
+    """ This function will return the JSON geometry that is sent to the WFS for a piece
+        of the AOI.  Detailed boundaries can have tens of thousands of vertices that
+        would otherwise be re-sent and re-evaluated by the server for every request.
+
+        1) If the bounding box of the piece is entirely within the AOI the bounding box
+           is sent as an esriGeometryEnvelope.
+        2) Otherwise the piece is buffered outward and then generalized by the same
+           tolerance so the simplified polygon still contains the entire piece.  The
+           tolerance is requestGeometryTolerance (a fraction) of the larger side of
+           the piece's bounding box.  The original geometry is returned if
+           simplifying did not reduce the number of vertices.  Attribute-only
+           extracts (bGeometry False) have no geometry to filter by afterwards so
+           the piece itself is sent.
+
+        CLUs returned outside of the AOI are removed by the final AOI filter.
+
+        Returns a JSON string; use getGeometryType to determine its geometryType"""
+
+    try:
+        extent = geometry.extent
+        spatialReference = json.loads(geometry.JSON)['spatialReference']
+
+        if aoiGeometry.contains(extent.polygon):
+            return json.dumps({'xmin':extent.XMin,'ymin':extent.YMin,
+                               'xmax':extent.XMax,'ymax':extent.YMax,
+                               'spatialReference':spatialReference})
+
+        tolerance = max(extent.width,extent.height) * requestGeometryTolerance
+        if tolerance > 0 and bGeometry:
+            simplified = geometry.buffer(tolerance).generalize(tolerance)
+
+            if simplified.pointCount < geometry.pointCount:
+                return simplified.JSON
+
+        return geometry.JSON
+
+    except:
+        errorMsg()
+        return geometry.JSON
+
+## ===================================================================================
+def getGeometryType(jsonGeometry):
+    """ This function will return the REST geometryType of a JSON geometry string as
+        returned by getRequestGeometry.  i.e. 'esriGeometryEnvelope'"""
+
+    if jsonGeometry.find('"xmin"') > -1:
+        return 'esriGeometryEnvelope'
+    else:
+        return 'esriGeometryPolygon'
+
+## ===================================================================================
+def iterAOIparts(inFC):
+    """ This generator will yield a temporary single-part feature class for every part
+        of a multipart AOI so that each part can be planned on its own and the empty
+        space between parts is never queried.  The temporary feature classes are
+        deleted once the caller moves on to the next part.  Nothing is yielded if
+        the AOI is a single part."""
+
+    aoiGeometry = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@'])][0]
+
+    if aoiGeometry.partCount < 2:
+        return
+
+    AddMsgAndPrint("\nAOI is made up of " + str(aoiGeometry.partCount) + " parts; Planning each part separately")
+
+    for partNum in range(aoiGeometry.partCount):
+        partFC = "in_memory" + os.sep + os.path.basename(arcpy.CreateScratchName("aoi_part",data_type="FeatureClass",workspace=scratchWS))
+        arcpy.CopyFeatures_management([arcpy.Polygon(aoiGeometry.getPart(partNum),aoiGeometry.spatialReference)],partFC)
+        yield partFC
+        arcpy.Delete_management(partFC)
+
+## ===================================================================================
+def iterJSONextents(inFC,RESTurl,bGeometry=True):
+    """ This generator will deconstruct the input FC into JSON format and determine if the
         clu count within this extent exceeds the max record limit of the WFS.  If the clu
         count exceeds the WFS limit then the incoming FC will continously be split
         until the CLU count is below WFS limit.  Each split will be an individual request
         to the WFS. Splits are done by using the subdivide polygon tool.
 
-        The function will return a dictionary of JSON extents created from the individual
-        splits of the original fc bounding box along with a CLU count for the request
-        {'Min_BND': ['{"xmin":-90.1179,
-                       "ymin":37.0066,
-                       "xmax":-89.958,
-                       "ymax":37.174,
-                       "spatialReference":{"wkid":4326,"latestWkid":4326}}', 998]}
+        Each split is yielded as soon as its CLU count is below the WFS limit so that
+        requests can be downloaded while the rest of the AOI is still being planned.
+        Pieces waiting to be split are kept in a queue and removed once they are split.
+        ('request_4893871', ['{"rings":[[[-90.11,37.00],...]],"spatialReference":{"wkid":4326}}', 998])
 
-        Return False if jsonDict is empty"""
+        Each part of a multipart AOI is planned separately.  The geometry yielded is
+        the reduced request geometry from getRequestGeometry.
+
+        Nothing is yielded if the CLU count of the AOI could not be determined.  If
+        planning fails part way requestStats['planningErrors'] is incremented so the
+        extract is not treated as complete."""
 
     try:
-        # Dictionary containing JSON Extents to submit for geometry
-        jsonDict = dict()
+        bMultipart = False
+        for partFC in iterAOIparts(inFC):
+            bMultipart = True
+            for request in iterJSONextents(partFC,RESTurl,bGeometry):
+                yield request
 
-        # create JSON extent to send to REST URL to determine if
-        # records requested exceed max allowable records.
-        #jSONextent  = arcpy.da.Describe(inFC)['extent'].JSON
+        if bMultipart:
+            return
 
-        # deconstructed AOI geometry in JSON
-        jSONpolygon = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@JSON'])][0]
+        # deconstructed AOI geometry and the reduced geometry sent to the WFS
+        aoiGeometry = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@'])][0]
+        jSONpolygon = getRequestGeometry(aoiGeometry,aoiGeometry,bGeometry)
 
         params = urllibEncode({'f': 'json',
                                'geometry':jSONpolygon,
-                               'geometryType':'esriGeometryPolygon',
+                               'geometryType':getGeometryType(jSONpolygon),
                                'returnCountOnly':'true',
                                'token': portalToken['token']})
 
@@ -518,105 +1038,138 @@ def createListOfJSONextents(inFC,RESTurl):
 
         if not countQuery:
            AddMsgAndPrint("Failed to get estimate of CLU count",2)
-           return False
+           return
 
         AddMsgAndPrint("\nThere are approximately " + splitThousands(countQuery['count']) + " CLUs within AOI")
 
         # if count is within max records allowed no need to proceed
         if countQuery['count'] <= maxRecordCount:
-            jsonDict[os.path.basename(inFC)] = [jSONpolygon,countQuery['count']]
+            yield (os.path.basename(inFC),[jSONpolygon,countQuery['count']])
+            return
 
         # AOI bounding box will have to be continously split until polygons capture
         # CLU records below 1000 records.
-        else:
-            AddMsgAndPrint("Determining # of WFS requests")
+        AddMsgAndPrint("Determining # of WFS requests")
 
-            numOfAreas = int(countQuery['count'] / 800)  # How many times the input fc will be subdivided initially
-            splitNum = 0               # arbitrary number to keep track of unique files
-            subDividedFCList = list()  # list containing recycled fcs to be split
-            subDividedFCList.append(inFC)
+        numOfAreas = int(countQuery['count'] / 800)  # How many times the input fc will be subdivided initially
+        splitNum = 0               # arbitrary number to keep track of unique files
+        numOfRequests = 0          # number of requests yielded
+        subDividedFCList = collections.deque()  # queue containing recycled fcs to be split
+        subDividedFCList.append(inFC)
 
-            # iterate through each polygon in fc in list and d
-            for fc in subDividedFCList:
-                arcpy.SetProgressorLabel("Determining # of WFS requests. Current #: " + str(len(jsonDict)))
+        # iterate through each polygon in fc in list and d
+        while subDividedFCList:
+            fc = subDividedFCList.popleft()
+            arcpy.SetProgressorLabel("Determining # of WFS requests. Current #: " + str(numOfRequests))
 
-                # Subdivide fc into 2
-                subdivision_fc = "in_memory" + os.sep + os.path.basename(arcpy.CreateScratchName("subdivision",data_type="FeatureClass",workspace=scratchWS))
+            # Subdivide fc into 2
+            subdivision_fc = "in_memory" + os.sep + os.path.basename(arcpy.CreateScratchName("subdivision",data_type="FeatureClass",workspace=scratchWS))
 
-                if splitNum > 0:
-                   numOfAreas = 2
+            if splitNum > 0:
+               numOfAreas = 2
 
-                arcpy.SubdividePolygon_management(fc,subdivision_fc,"NUMBER_OF_EQUAL_PARTS",numOfAreas, "", "", "", "STACKED_BLOCKS")
+            arcpy.SubdividePolygon_management(fc,subdivision_fc,"NUMBER_OF_EQUAL_PARTS",numOfAreas, "", "", "", "STACKED_BLOCKS")
 
-                # first iteration will be the input AOI; don't wnat to delete it
-                if splitNum > 0:
-                   arcpy.Delete_management(fc)
+            # first iteration will be the input AOI; don't wnat to delete it
+            if splitNum > 0:
+               arcpy.Delete_management(fc)
 
-                # Add new fld to capture unique name used for the split tool to create
-                newOIDfld = "objectID_TEXT"
-                expression = "assignUniqueNumber(!" + arcpy.Describe(subdivision_fc).OIDFieldName + "!)"
-                randomNum = str(random.randint(1,9999999999))
+            # Add new fld to capture unique name used for the split tool to create
+            newOIDfld = "objectID_TEXT"
+            expression = "assignUniqueNumber(!" + arcpy.Describe(subdivision_fc).OIDFieldName + "!)"
+            randomNum = str(random.randint(1,9999999999))
 
-                # code block doesn't like indentations
-                codeBlock = """
+            # code block doesn't like indentations
+            codeBlock = """
 def assignUniqueNumber(oid):
     return \"request_\" + str(""" + str(randomNum) + """) + str(oid)"""
 
-                if not len(arcpy.ListFields(subdivision_fc,newOIDfld)) > 0:
-                    arcpy.AddField_management(subdivision_fc,newOIDfld,"TEXT","#","#","30")
+            if not len(arcpy.ListFields(subdivision_fc,newOIDfld)) > 0:
+                arcpy.AddField_management(subdivision_fc,newOIDfld,"TEXT","#","#","30")
 
-                arcpy.CalculateField_management(subdivision_fc,newOIDfld,expression,"PYTHON3",codeBlock)
-                splitNum+=1
+            arcpy.CalculateField_management(subdivision_fc,newOIDfld,expression,"PYTHON3",codeBlock)
+            splitNum+=1
 
-                # Create a fc for each subdivided polygon
-                # split by attributes was faster by 2 secs than split_analysis
-                arcpy.SplitByAttributes_analysis(subdivision_fc,"IN_MEMORY",[newOIDfld])
-                arcpy.Delete_management(subdivision_fc)
+            # Create a fc for each subdivided polygon
+            # split by attributes was faster by 2 secs than split_analysis
+            arcpy.SplitByAttributes_analysis(subdivision_fc,"IN_MEMORY",[newOIDfld])
+            arcpy.Delete_management(subdivision_fc)
 
-                # Create a list of fcs that the split tool outputs
-                #arcpy.env.workspace = scratchWS
-                arcpy.env.workspace = "IN_MEMORY"
-                #splitFCList = arcpy.ListFeatureClasses('request_' + str(splitNum) + '*')
-                splitFCList = arcpy.ListFeatureClasses('request_' + randomNum + '*')
+            # Create a list of fcs that the split tool outputs
+            #arcpy.env.workspace = scratchWS
+            arcpy.env.workspace = "IN_MEMORY"
+            #splitFCList = arcpy.ListFeatureClasses('request_' + str(splitNum) + '*')
+            splitFCList = arcpy.ListFeatureClasses('request_' + randomNum + '*')
 
-                # Assess each split FC to determine if it
-                for splitFC in splitFCList:
+            # Assess each split FC to determine if it
+            for splitFC in splitFCList:
 
-                    splitFC = arcpy.da.Describe(splitFC)['catalogPath']
-                    arcpy.SetProgressorLabel("Determining # of WFS requests. Current #: " + str(len(jsonDict)))
+                splitFC = arcpy.da.Describe(splitFC)['catalogPath']
+                arcpy.SetProgressorLabel("Determining # of WFS requests. Current #: " + str(numOfRequests))
 
-                    #splitExtent = arcpy.da.Describe(splitFC)['extent'].JSON
-                    splitExtent = [row[0] for row in arcpy.da.SearchCursor(splitFC, ['SHAPE@JSON'])][0]
+                #splitExtent = arcpy.da.Describe(splitFC)['extent'].JSON
+                splitGeometry = [row[0] for row in arcpy.da.SearchCursor(splitFC, ['SHAPE@'])][0]
+                splitExtent = getRequestGeometry(splitGeometry,aoiGeometry,bGeometry)
 
-                    params = urllibEncode({'f': 'json',
-                                           'geometry':splitExtent,
-                                           'geometryType':'esriGeometryPolygon',
-                                           'returnCountOnly':'true',
-                                           'token': portalToken['token']})
+                params = urllibEncode({'f': 'json',
+                                       'geometry':splitExtent,
+                                       'geometryType':getGeometryType(splitExtent),
+                                       'returnCountOnly':'true',
+                                       'token': portalToken['token']})
 
-                    # Send geometry count request
+                # Send geometry count request
+                countQuery = submitFSquery(RESTurl,params)
+
+                # request failed.....try once more
+                if not countQuery:
+                    time.sleep(5)
                     countQuery = submitFSquery(RESTurl,params)
 
-                    # request failed.....try once more
                     if not countQuery:
-                        time.sleep(5)
-                        countQuery = submitFSquery(RESTurl,params)
+                       AddMsgAndPrint("\tFailed to get count request -- 3 attempts made -- Recycling request")
+                       subDividedFCList.append(splitFC)
+                       continue
+
+                # if count is within max records allowed yield it
+                if countQuery['count'] <= maxRecordCount:
+                    #arcpy.CopyFeatures_management(splitFC,scratchWS + os.sep + arcpy.da.Describe(splitFC)['baseName'])
+                    arcpy.Delete_management(splitFC)
+                    numOfRequests+=1
+                    yield (os.path.basename(splitFC),[splitExtent,countQuery['count']])
+
+                # recycle this fc back to be split into 2 polygons
+                else:
+                    subDividedFCList.append(splitFC)
 
-                        if not countQuery:
-                           AddMsgAndPrint("\tFailed to get count request -- 3 attempts made -- Recycling request")
-                           subDividedFCList.append(splitFC)
-                           continue
+    # close() of the generator is not an error
+    except GeneratorExit:
+        raise
 
-                    # if count is within max records allowed add it dict
-                    if countQuery['count'] <= maxRecordCount:
-                        jsonDict[os.path.basename(splitFC)] = [splitExtent,countQuery['count']]
+    except:
+        errorMsg()
+        AddMsgAndPrint("\tPlanning of the WFS requests stopped; the extract will be incomplete",2)
+        with stateLock:
+            requestStats['planningErrors'] += 1
 
-                        #arcpy.CopyFeatures_management(splitFC,scratchWS + os.sep + arcpy.da.Describe(splitFC)['baseName'])
-                        arcpy.Delete_management(splitFC)
+## ===================================================================================
+def createListOfJSONextents(inFC,RESTurl,bGeometry=True):
+    """ This function will collect all of the extents planned by iterJSONextents into a
+        dictionary of JSON extents created from the individual splits of the original
+        fc along with a CLU count for the request
+        {'Min_BND': ['{"xmin":-90.1179,
+                       "ymin":37.0066,
+                       "xmax":-89.958,
+                       "ymax":37.174,
+                       "spatialReference":{"wkid":4326,"latestWkid":4326}}', 998]}
 
-                    # recycle this fc back to be split into 2 polygons
-                    else:
-                        subDividedFCList.append(splitFC)
+        Return False if jsonDict is empty"""
+
+    try:
+        # Dictionary containing JSON Extents to submit for geometry
+        jsonDict = dict()
+
+        for requestName,request in iterJSONextents(inFC,RESTurl,bGeometry):
+            jsonDict[requestName] = request
 
         if len(jsonDict) < 1:
             AddMsgAndPrint("\tCould not determine number of server requests.  Exiting",2)
@@ -630,7 +1183,7 @@ def assignUniqueNumber(oid):
         return False
 
 ## ===================================================================================
-def createListOfJSONextents_ArcMap(inFC,RESTurl):
+def createListOfJSONextents_ArcMap(inFC,RESTurl,bGeometry=True):
     """ This function will deconstruct the input FC into JSON format and determine if the
         clu count within this extent exceeds the max record limit of the WFS.  If the clu
         count exceeds the WFS limit then the incoming FC will continously be split
@@ -656,12 +1209,27 @@ def createListOfJSONextents_ArcMap(inFC,RESTurl):
         # records requested exceed max allowable records.
         #jSONextent  = arcpy.da.Describe(inFC)['extent'].JSON
 
-        # deconstructed AOI geometry in JSON
-        jSONpolygon = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@JSON'])][0]
+        # Plan each part of a multipart AOI separately
+        bMultipart = False
+        for partFC in iterAOIparts(inFC):
+            bMultipart = True
+            partDict = createListOfJSONextents_ArcMap(partFC,RESTurl,bGeometry)
+            if partDict:
+                jsonDict.update(partDict)
+
+        if bMultipart:
+            if len(jsonDict) < 1:
+                AddMsgAndPrint("\tCould not determine number of server requests.  Exiting",2)
+                return False
+            return jsonDict
+
+        # deconstructed AOI geometry and the reduced geometry sent to the WFS
+        aoiGeometry = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@'])][0]
+        jSONpolygon = getRequestGeometry(aoiGeometry,aoiGeometry,bGeometry)
 
         params = urllibEncode({'f': 'json',
                                'geometry':jSONpolygon,
-                               'geometryType':'esriGeometryPolygon',
+                               'geometryType':getGeometryType(jSONpolygon),
                                'returnCountOnly':'true',
                                'token': portalToken['token']})
 
@@ -801,11 +1369,12 @@ def createListOfJSONextents_ArcMap(inFC,RESTurl):
                     splitFC = arcpy.Describe(splitFC).catalogPath
                     arcpy.SetProgressorLabel("Determining # of WFS requests. Current #: " + str(len(jsonDict)))
 
-                    splitExtent = [row[0] for row in arcpy.da.SearchCursor(splitFC, ['SHAPE@JSON'])][0]
+                    splitGeometry = [row[0] for row in arcpy.da.SearchCursor(splitFC, ['SHAPE@'])][0]
+                    splitExtent = getRequestGeometry(splitGeometry,aoiGeometry,bGeometry)
 
                     params = urllibEncode({'f': 'json',
                                            'geometry':splitExtent,
-                                           'geometryType':'esriGeometryPolygon',
+                                           'geometryType':getGeometryType(splitExtent),
                                            'returnCountOnly':'true',
                                            'token': portalToken['token']})
 
@@ -850,197 +1419,3861 @@ def createListOfJSONextents_ArcMap(inFC,RESTurl):
 
 
 ## ===================================================================================
-def createOutputFC(metadata,outputWS,shape="POLYGON"):
-    """ This function will create an empty polygon feature class within the outputWS
-        The feature class will be set to the same spatial reference as the Web Feature
-        Service. All fields part of the WFS will also be added to the new feature class.
-        A field dictionary containing the field names and their property will also be
-        returned.  This fieldDict will be used to create the fields in the CLU fc and
-        by the getCLUgeometry insertCursor.
+def getServiceMetadata(metadataURL,cacheFile,maxAgeHours=24):
+    """ This function will return the feature service layer definition.  The definition
+        is cached in cacheFile.  On every run the editingInfo of the feature service is
+        requested first; it is a small request compared to the layer definition.  The
+        cached definition is only re-used while editingInfo is unchanged, otherwise the
+        layer definition is requested again and schema changes are reported.  Output
+        schema templates are keyed by the field definitions themselves so the template
+        is rebuilt along with the definition.  maxAgeHours only applies when the
+        service cannot be reached; a cached copy within that age is used instead.
 
-        fieldDict ={field:(fieldType,fieldLength,alias)
-        i.e {'clu_identifier': ('TEXT', 36, 'clu_identifier'),'clu_number': ('TEXT', 7, 'clu_number')}
+        cacheFile - {'cached': 1600000000.0, 'editingInfo': {...}, 'metadata': {...}}
 
-        Return the field dictionary and new feature class including the path
-        Return False if error ocurred."""
+        Returns the layer definition dictionary; False if it could not be retrieved"""
 
     try:
-        AddMsgAndPrint("\nCreating New Feature Class: " + "CLU_" + os.path.basename(AOI))
-        arcpy.SetProgressorLabel("Creating New Feature Class: " + "CLU_" + os.path.basename(AOI))
+        cache = None
+        if maxAgeHours and os.path.exists(cacheFile):
+            try:
+                with open(cacheFile,'r') as f:
+                    cache = json.load(f)
+            except:
+                cache = None
 
-        # output FC will have the AOI name with 'CLU_' as a prefix
-        newFC = outputWS + os.sep + "CLU_" + os.path.basename(AOI)
+        # Used for admin or feature service info; Send POST request
+        params = urllibEncode({'f': 'json','token': portalToken['token']})
 
-        # set the spatial Reference to same as WFS
-        # Probably WGS_1984_Web_Mercator_Auxiliary_Sphere
-        # {'spatialReference': {'latestWkid': 3857, 'wkid': 102100}
-        spatialReferences = metadata['extent']['spatialReference']
-        if 'latestWkid' in [sr for sr in spatialReferences.keys()]:
-            sr = spatialReferences['latestWkid']
-        else:
-            sr = spatialReferences['wkid']
+        # editingInfo of the feature service (parent of the layer) changes whenever
+        # the schema or data of the service are edited.
+        editingInfo = None
+        if cache:
+            serviceInfo = submitFSquery(metadataURL.rstrip('/').rsplit('/',1)[0],params)
 
-        outputCS = arcpy.SpatialReference(sr)
+            if not serviceInfo:
+                if (time.time() - cache['cached']) < (maxAgeHours * 3600):
+                    AddMsgAndPrint("\nCould not reach the CLU service; Using cached CLU service metadata from " + time.strftime('%m/%d/%Y %H:%M',time.localtime(cache['cached'])),1)
+                    return cache['metadata']
+            else:
+                editingInfo = serviceInfo.get('editingInfo')
+                if editingInfo and editingInfo == cache.get('editingInfo'):
+                    AddMsgAndPrint("\nCLU service is unchanged; Using cached CLU service metadata from " + time.strftime('%m/%d/%Y %H:%M',time.localtime(cache['cached'])))
+                    return cache['metadata']
 
-        # fields associated with feature service
-        fsFields = metadata['fields']   # {u'alias':u'land_unit_id',u'domain': None, u'name': u'land_unit_id', u'nullable': True, u'editable': True, u'alias': u'LAND_UNIT_ID', u'length': 38, u'type': u'esriFieldTypeString'}
-        fieldDict = dict()
+        # request info about the feature service
+        fsMetadata = submitFSquery(metadataURL,params)
 
-        # lookup list for fields that are in DATE field; Date values need to be converted
-        # from Unix Epoch format to mm/dd/yyyy format in order to populate a table
-        dateFields = list()
+        if not fsMetadata:
+            # fall back to an expired cache rather than failing
+            if cache:
+                AddMsgAndPrint("\nCould not request CLU service metadata; Using expired cached copy",1)
+                return cache['metadata']
+            return False
 
-        # cross-reference portal attribute description with ArcGIS attribute description
-        fldTypeDict = {'esriFieldTypeString':'TEXT','esriFieldTypeDouble':'DOUBLE','esriFieldTypeSingle':'FLOAT',
-                       'esriFieldTypeInteger':'LONG','esriFieldTypeSmallInteger':'SHORT','esriFieldTypeDate':'DATE',
-                       'esriFieldTypeGUID':'GUID','esriFieldTypeGlobalID':'GUID'}
+        if cache:
+            oldEditInfo = cache['metadata'].get('editingInfo',{})
+            newEditInfo = fsMetadata.get('editingInfo',{})
+            if oldEditInfo.get('schemaLastEditDate') != newEditInfo.get('schemaLastEditDate'):
+                AddMsgAndPrint("\nCLU service schema has changed since it was last cached",1)
+
+        if maxAgeHours:
+            # a first run has no editingInfo yet; request it so the next run can compare
+            if editingInfo is None:
+                serviceInfo = submitFSquery(metadataURL.rstrip('/').rsplit('/',1)[0],params)
+                editingInfo = serviceInfo.get('editingInfo') if serviceInfo else None
+            try:
+                with open(cacheFile,'w') as f:
+                    json.dump({'cached':time.time(),'editingInfo':editingInfo,'metadata':fsMetadata},f)
+            except:
+                AddMsgAndPrint("\tCould not cache CLU service metadata to " + cacheFile,1)
 
-        # Collect field info to pass to new fc
-        for fieldInfo in fsFields:
+        return fsMetadata
 
-            # skip the OID field
-            if fieldInfo['type'] == 'esriFieldTypeOID':
-               continue
+    except:
+        errorMsg()
+        return False
 
-            fldType = fldTypeDict[fieldInfo['type']]
-            fldAlias = fieldInfo['alias']
-            fldName = fieldInfo['name']
+## ===================================================================================
+def getCLUhash(row):
+    """ This function will return a compact hash of the attributes and geometry (WKB)
+        of a CLU row.  Only 64 bits of the md5 digest are kept; hashes are compared
+        per clu_identifier so collisions are not a concern."""
+
+    rowHash = hashlib.md5()
+    for value in row:
+        if isinstance(value,(bytes,bytearray)):
+            rowHash.update(bytes(value))
+        else:
+            rowHash.update(repr(value).encode('utf-8'))
+        rowHash.update(b'\x1f')
 
-            # skip the SHAPE_STArea__ and SHAPE_STLength__ fields
-            if fldName.find("SHAPE_ST") > -1:
-               continue
+    return rowHash.hexdigest()[:16]
 
-            if fldType == 'TEXT':
-               fldLength = fieldInfo['length']
-            elif fldType == 'DATE':
-                 dateFields.append(fldName)
-            else:
-               fldLength = ""
+## ===================================================================================
+def applyCLUchanges(stagingFC,outputFC,hashFile,fieldList,bGeometry,bComplete=True):
+    """ This function will update an existing CLU output with a new extract instead of
+        rewriting it.  A hash of every CLU (getCLUhash) is kept in a sqlite database
+        alongside the output keyed by clu_identifier.  The CLUs of the new extract
+        (stagingFC) are hashed and compared to the stored hashes:
 
-            fieldDict[fldName] = (fldType,fldLength,fldAlias)
+            new clu_identifier         --> inserted with an InsertCursor
+            different hash             --> updated with an UpdateCursor
+            clu_identifier not present --> deleted with an UpdateCursor
 
-        # Delete newFC if it exists
-        if arcpy.Exists(newFC):
-           arcpy.Delete_management(newFC)
-           AddMsgAndPrint("\t" + os.path.basename(newFC) + " exists.  Deleted")
+        Unchanged CLUs are not touched.  If the output or the hash database does not
+        exist yet, or the output fields changed, the output is written in full once.
+        The staging feature class is deleted afterwards.
 
-        # Create empty polygon featureclass with coordinate system that matches AOI.
-        arcpy.CreateFeatureclass_management(outputWS, os.path.basename(newFC), shape, "", "DISABLED", "DISABLED", outputCS)
+        If bComplete is False (a request failed twice or was cut off at the WFS
+        record limit) CLUs missing from the extract may still exist so nothing is
+        deleted; inserts and updates are still applied.
 
-        # Add fields from fieldDict to mimic WFS
-        arcpy.SetProgressor("step", "Adding Fields to " + "CLU_" + os.path.basename(AOI),0,len(fieldDict),1)
-        for field,params in fieldDict.items():
-            try:
-                fldLength = params[1]
-                fldAlias = params[2]
-            except:
-                fldLength = 0
-                pass
+        fieldList - output fields without geometry; must include clu_identifier
+
+        Return True if the changes were applied; False otherwise"""
+
+    try:
+        cursorFields = list(fieldList) + (['SHAPE@WKB'] if bGeometry else [])
+        idIndex = cursorFields.index('clu_identifier')
+        schemaHash = hashlib.md5(json.dumps([sorted(fieldList),bGeometry]).encode('utf-8')).hexdigest()
+
+        AddMsgAndPrint("\nComparing extracted CLUs to: " + os.path.basename(outputFC))
+        arcpy.SetProgressorLabel("Comparing extracted CLUs to " + os.path.basename(outputFC))
+
+        conn = sqlite3.connect(hashFile)
+        conn.execute("CREATE TABLE IF NOT EXISTS clu_hashes (clu_identifier TEXT PRIMARY KEY, hash TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS output_schema (hash TEXT)")
+        storedSchema = conn.execute("SELECT hash FROM output_schema").fetchone()
+
+        bFullWrite = not arcpy.Exists(outputFC) or not storedSchema or storedSchema[0] != schemaHash
+        if bFullWrite:
+            storedHashes = dict()
+        else:
+            storedHashes = dict(conn.execute("SELECT clu_identifier, hash FROM clu_hashes"))
+
+        # Hash the new extract; only rows of new or changed CLUs are kept
+        incomingHashes = dict()
+        changedRows = dict()
+        with arcpy.da.SearchCursor(stagingFC,cursorFields) as cursor:
+            for row in cursor:
+                cluID = row[idIndex]
+                cluHash = getCLUhash(row)
+                incomingHashes[cluID] = cluHash
+
+                if not bFullWrite and storedHashes.get(cluID) != cluHash:
+                    changedRows[cluID] = row
+
+        if bFullWrite:
+            if arcpy.Exists(outputFC):
+                arcpy.Delete_management(outputFC)
+            arcpy.Copy_management(stagingFC,outputFC)
+
+            conn.execute("DELETE FROM clu_hashes")
+            conn.execute("DELETE FROM output_schema")
+            conn.execute("INSERT INTO output_schema VALUES (?)",(schemaHash,))
+            conn.executemany("INSERT INTO clu_hashes VALUES (?,?)",incomingHashes.items())
+            AddMsgAndPrint("\tNo previous extract to compare to; " + splitThousands(len(incomingHashes)) + " CLUs written")
+
+        else:
+            insertedIDs = [cluID for cluID in changedRows if not cluID in storedHashes]
+            updatedIDs = [cluID for cluID in changedRows if cluID in storedHashes]
+            deletedIDs = [cluID for cluID in storedHashes if not cluID in incomingHashes]
+
+            if deletedIDs and not bComplete:
+                AddMsgAndPrint("\tThe extract is incomplete; " + splitThousands(len(deletedIDs)) + " CLUs missing from it were not deleted",1)
+                deletedIDs = []
+
+            # Updates and deletes; only the affected CLUs are selected
+            affectedIDs = updatedIDs + deletedIDs
+            cluIDfield = arcpy.AddFieldDelimiters(outputFC,'clu_identifier')
+            for i in range(0,len(affectedIDs),500):
+                idChunk = affectedIDs[i:i + 500]
+                where = cluIDfield + " IN ('" + "','".join([str(cluID).replace("'","''") for cluID in idChunk]) + "')"
+
+                with arcpy.da.UpdateCursor(outputFC,cursorFields,where) as cursor:
+                    for row in cursor:
+                        cluID = row[idIndex]
+                        if cluID in changedRows:
+                            cursor.updateRow(changedRows[cluID])
+                        else:
+                            cursor.deleteRow()
+
+            if insertedIDs:
+                with arcpy.da.InsertCursor(outputFC,cursorFields) as cursor:
+                    for cluID in insertedIDs:
+                        cursor.insertRow(changedRows[cluID])
+
+            conn.executemany("INSERT OR REPLACE INTO clu_hashes VALUES (?,?)",[(cluID,incomingHashes[cluID]) for cluID in changedRows])
+            conn.executemany("DELETE FROM clu_hashes WHERE clu_identifier = ?",[(cluID,) for cluID in deletedIDs])
+
+            AddMsgAndPrint("\t" + splitThousands(len(insertedIDs)) + " CLUs inserted, " + splitThousands(len(updatedIDs)) + " updated, " +
+                           splitThousands(len(deletedIDs)) + " deleted, " + splitThousands(len(incomingHashes) - len(changedRows)) + " unchanged")
+
+        conn.commit()
+        conn.close()
+
+        arcpy.Delete_management(stagingFC)
+        return True
+
+    except:
+        try: conn.close()
+        except: pass
+
+        errorMsg()
+        return False
+
+## ===================================================================================
+def createEmptyOutput(outputWS,name,shape,outputCS,fieldDict):
+    """ This function will create an empty polygon feature class (or a table if shape
+        is None) and add every field in fieldDict to it one at a time.
+
+        Returns the path to the new feature class"""
+
+    newFC = outputWS + os.sep + name
+
+    # Create empty polygon featureclass with coordinate system that matches AOI.
+    if shape:
+        arcpy.CreateFeatureclass_management(outputWS, name, shape, "", "DISABLED", "DISABLED", outputCS)
+
+    # Attribute-only extract
+    else:
+        arcpy.CreateTable_management(outputWS, name)
+
+    # Add fields from fieldDict to mimic WFS
+    arcpy.SetProgressor("step", "Adding Fields to " + name,0,len(fieldDict),1)
+    for field,params in fieldDict.items():
+        try:
+            fldLength = params[1]
+            fldAlias = params[2]
+        except:
+            fldLength = 0
+            pass
+
+        arcpy.SetProgressorLabel("Adding Field: " + field)
+        arcpy.AddField_management(newFC,field,params[0],"#","#",fldLength,fldAlias)
+        arcpy.SetProgressorPosition()
+
+    arcpy.ResetProgressor()
+    arcpy.SetProgressorLabel("")
+    return newFC
+
+## ===================================================================================
+def getSchemaTemplate(fieldDict,shape,outputCS):
+    """ This function will return an empty template feature class (or table) in the
+        scratch GDB that has the full output schema.  Adding fields to a File
+        Geodatabase one at a time is a slow schema-lock operation for every field so
+        the template is built once and new outputs are created from it in a single
+        operation.  The template name is derived from a hash of the field
+        definitions, geometry type and spatial reference so a template is only
+        re-used for an identical schema.
+
+        Returns the path to the template; False if it could not be created"""
+
+    try:
+        schema = json.dumps([sorted(fieldDict.items()),shape,outputCS.factoryCode],sort_keys=True)
+        templateName = "CLU_template_" + hashlib.md5(schema.encode('utf-8')).hexdigest()[:12]
+        templateFC = arcpy.env.scratchGDB + os.sep + templateName
+
+        if not arcpy.Exists(templateFC):
+            AddMsgAndPrint("\tCreating output schema template: " + templateName)
+            createEmptyOutput(arcpy.env.scratchGDB,templateName,shape,outputCS,fieldDict)
+
+        return templateFC
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def loadRunStatistics(statsFile):
+    """ This function will return the list of statistics recorded from previous runs
+        by recordRunStatistics.  An empty list is returned if there are none.
+        [{'requests': 42, 'features': 31250, 'bytes': 98304000, 'seconds': 315.2}]"""
+
+    try:
+        if os.path.exists(statsFile):
+            with open(statsFile,'r') as f:
+                return json.load(f)
+    except:
+        pass
+
+    return list()
+
+## ===================================================================================
+def recordRunStatistics(statsFile,requests,features,bytesDownloaded,seconds,maxRuns=50):
+    """ This function will append the download statistics of this run to statsFile so
+        that estimateRunCost can calibrate its throughput model on previous runs.
+        Only the most recent maxRuns runs are kept."""
+
+    try:
+        if not requests or not features:
+            return
+
+        runStats = loadRunStatistics(statsFile)
+        runStats.append({'requests':requests,'features':features,'bytes':bytesDownloaded,'seconds':seconds})
+
+        with open(statsFile,'w') as f:
+            json.dump(runStats[-maxRuns:],f)
+
+    except:
+        AddMsgAndPrint("\tCould not record run statistics to " + statsFile,1)
+
+## ===================================================================================
+def estimateRunCost(envelopeDict,statsFile):
+    """ This function will report the number of requests, expected number of CLUs,
+        expected download size and expected download time of a plan.  Size and time
+        are estimated from previous runs recorded by recordRunStatistics:
+
+            bytes   = features x (bytes / feature)
+            seconds = requests x (seconds / request) + features x (seconds / feature)
+
+        The two time coefficients are fit by least squares over previous runs.  If
+        there are not enough runs to fit them, seconds per CLU is used on its own;
+        without any previous runs conservative defaults are used.
+
+        Returns a dictionary with the estimates"""
+
+    try:
+        numOfRequests = len(envelopeDict)
+        numOfCLUs = sum([value[1] for value in envelopeDict.values()])
+        runStats = loadRunStatistics(statsFile)
+
+        # defaults when there are no previous runs
+        bytesPerCLU = 4000.0
+        secondsPerRequest = 2.0
+        secondsPerCLU = 0.002
+        calibration = "uncalibrated defaults"
+
+        if runStats:
+            totalCLUs = float(sum([run['features'] for run in runStats]))
+            bytesPerCLU = sum([run['bytes'] for run in runStats]) / totalCLUs
+            secondsPerRequest = 0.0
+            secondsPerCLU = sum([run['seconds'] for run in runStats]) / totalCLUs
+            calibration = "calibrated on " + str(len(runStats)) + " previous run(s)"
+
+            # least squares fit of seconds = a x requests + b x features
+            srr = sum([run['requests'] ** 2 for run in runStats])
+            sff = sum([run['features'] ** 2 for run in runStats])
+            srf = sum([run['requests'] * run['features'] for run in runStats])
+            srt = sum([run['requests'] * run['seconds'] for run in runStats])
+            sft = sum([run['features'] * run['seconds'] for run in runStats])
+            determinant = float(srr * sff - srf * srf)
+
+            if len(runStats) > 1 and determinant > 0:
+                a = (srt * sff - sft * srf) / determinant
+                b = (sft * srr - srt * srf) / determinant
+                if a >= 0 and b >= 0:
+                    secondsPerRequest = a
+                    secondsPerCLU = b
+
+        estimatedBytes = numOfCLUs * bytesPerCLU
+        estimatedSeconds = (numOfRequests * secondsPerRequest) + (numOfCLUs * secondsPerCLU)
+
+        AddMsgAndPrint("\n-------------------- Dry Run --------------------")
+        AddMsgAndPrint("\tRequests: " + splitThousands(numOfRequests))
+        AddMsgAndPrint("\tExpected CLUs: " + splitThousands(numOfCLUs) + " (includes CLUs counted by more than 1 request)")
+        AddMsgAndPrint("\tEstimated download: " + str(round(estimatedBytes / 1048576.0,1)) + " MB")
+        AddMsgAndPrint("\tEstimated download time: " + str(round(estimatedSeconds / 60.0,1)) + " minutes")
+        AddMsgAndPrint("\tThroughput model: " + calibration)
+
+        return {'requests':numOfRequests,'features':numOfCLUs,'bytes':estimatedBytes,'seconds':estimatedSeconds}
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def exportPlanGeoJSON(envelopeDict,planFile):
+    """ This function will export a plan as a GeoJSON FeatureCollection so that it can be
+        inspected or re-used by loadPlanGeoJSON.  Geometries are projected to WGS84 as
+        required by GeoJSON; the exact request geometry is kept in the 'request' property.
+
+        Return True if the plan was exported; False otherwise"""
+
+    try:
+        wgs84 = arcpy.SpatialReference(4326)
+        features = list()
+
+        for requestName,request in envelopeDict.items():
+            esriGeometry = json.loads(request[0])
+
+            # envelopes are exported as rectangular polygons
+            if getGeometryType(request[0]) == 'esriGeometryEnvelope':
+                xmin = esriGeometry['xmin']; ymin = esriGeometry['ymin']
+                xmax = esriGeometry['xmax']; ymax = esriGeometry['ymax']
+                esriGeometry = {'rings':[[[xmin,ymin],[xmin,ymax],[xmax,ymax],[xmax,ymin],[xmin,ymin]]],
+                                'spatialReference':esriGeometry['spatialReference']}
+
+            geometry = arcpy.AsShape(esriGeometry,True)
+
+            features.append({'type':'Feature',
+                             'geometry':geometry.projectAs(wgs84).__geo_interface__,
+                             'properties':{'name':requestName,
+                                           'count':request[1],
+                                           'geometryType':getGeometryType(request[0]),
+                                           'request':request[0],
+                                           'where':getRequestWhere(request),
+                                           'params':getRequestParams(request)}})
+
+        with open(planFile,'w') as f:
+            json.dump({'type':'FeatureCollection','features':features},f)
+
+        AddMsgAndPrint("\tPlan exported to: " + planFile)
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def loadPlanGeoJSON(planFile):
+    """ This function will load a plan exported by exportPlanGeoJSON and return it in
+        the same format as createListOfJSONextents.
+        {'request_42': ['{"xmin":-90.15,"ymin":37.19,...}', 691]}
+
+        Return False if the plan could not be loaded"""
+
+    try:
+        with open(planFile,'r') as f:
+            plan = json.load(f)
+
+        envelopeDict = dict()
+        for feature in plan['features']:
+            properties = feature['properties']
+            envelopeDict[properties['name']] = [properties['request'],properties['count']]
+
+            if properties.get('where') or properties.get('params'):
+                envelopeDict[properties['name']].append(properties.get('where'))
+
+            if properties.get('params'):
+                envelopeDict[properties['name']].append(properties['params'])
+
+        AddMsgAndPrint("\nLoaded " + splitThousands(len(envelopeDict)) + " requests from plan: " + planFile)
+        return envelopeDict
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def createCLUdensityGrid(metadata,cellSize):
+    """ This function will create an empty CLU density grid covering the full extent of
+        the feature service.  The grid holds the number of CLUs within every cell and
+        is used by createListOfJSONextentsFromGrid to plan requests locally instead of
+        discovering CLU density with count queries.  Cells that have never been
+        observed hold unknownCellValue.
+
+        cellSize is in the units of the feature service spatial reference (meters for
+        WGS_1984_Web_Mercator_Auxiliary_Sphere).
+
+        Returns the grid dictionary"""
+
+    extent = metadata['extent']
+    spatialReferences = extent['spatialReference']
+    if 'latestWkid' in spatialReferences:
+        wkid = spatialReferences['latestWkid']
+    else:
+        wkid = spatialReferences['wkid']
+
+    ncols = int(math.ceil((extent['xmax'] - extent['xmin']) / cellSize))
+    nrows = int(math.ceil((extent['ymax'] - extent['ymin']) / cellSize))
+
+    return {'wkid':wkid,
+            'xmin':extent['xmin'],
+            'ymin':extent['ymin'],
+            'cellSize':float(cellSize),
+            'ncols':ncols,
+            'nrows':nrows,
+            'counts':array.array('I',[unknownCellValue]) * (ncols * nrows)}
+
+## ===================================================================================
+def loadCLUdensityGrid(gridFile):
+    """ This function will load a CLU density grid saved by saveCLUdensityGrid.
+
+        The file is a small header followed by ncols x nrows little-endian uint32
+        counts stored row by row starting at the bottom-left cell:
+        'CLUG', version, wkid, xmin, ymin, cellSize, ncols, nrows
+
+        Return False if the grid could not be loaded"""
+
+    try:
+        with open(gridFile,'rb') as f:
+            header = f.read(struct.calcsize(gridHeaderFormat))
+            magic,version,wkid,xmin,ymin,cellSize,ncols,nrows = struct.unpack(gridHeaderFormat,header)
+
+            if magic != b'CLUG' or version != 1:
+                AddMsgAndPrint("\t" + gridFile + " is not a CLU density grid",1)
+                return False
+
+            counts = array.array('I')
+            counts.fromfile(f,ncols * nrows)
+
+        if sys.byteorder != 'little':
+            counts.byteswap()
+
+        return {'wkid':wkid,'xmin':xmin,'ymin':ymin,'cellSize':cellSize,
+                'ncols':ncols,'nrows':nrows,'counts':counts}
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def saveCLUdensityGrid(grid,gridFile):
+    """ This function will save a CLU density grid in the format read by
+        loadCLUdensityGrid."""
+
+    try:
+        counts = grid['counts']
+        if sys.byteorder != 'little':
+            counts = array.array('I',counts)
+            counts.byteswap()
+
+        with open(gridFile,'wb') as f:
+            f.write(struct.pack(gridHeaderFormat,b'CLUG',1,grid['wkid'],grid['xmin'],grid['ymin'],
+                                grid['cellSize'],grid['ncols'],grid['nrows']))
+            counts.tofile(f)
+
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def getGridWindow(grid,extent):
+    """ This function will return the range of grid columns and rows (c0,c1,r0,r1) that
+        cover an arcpy extent in the grid spatial reference.  c1 and r1 are exclusive."""
+
+    cellSize = grid['cellSize']
+    c0 = max(0,int(math.floor((extent.XMin - grid['xmin']) / cellSize)))
+    c1 = min(grid['ncols'],int(math.floor((extent.XMax - grid['xmin']) / cellSize)) + 1)
+    r0 = max(0,int(math.floor((extent.YMin - grid['ymin']) / cellSize)))
+    r1 = min(grid['nrows'],int(math.floor((extent.YMax - grid['ymin']) / cellSize)) + 1)
+    return c0,c1,r0,r1
+
+## ===================================================================================
+def getRectanglePolygon(xmin,ymin,xmax,ymax,spatialRef):
+    """ This function will return an arcpy polygon of a rectangle."""
+
+    return arcpy.Polygon(arcpy.Array([arcpy.Point(xmin,ymin),arcpy.Point(xmin,ymax),arcpy.Point(xmax,ymax),
+                                      arcpy.Point(xmax,ymin),arcpy.Point(xmin,ymin)]),spatialRef)
+
+## ===================================================================================
+def getCountQuery(jsonGeometry,RESTurl,where=None):
+    """ This function will send a returnCountOnly request for a JSON geometry, limited
+        to a where clause if one is given.  A 2nd attempt is made if the request fails.
+
+        Returns the CLU count; False if both attempts failed"""
+
+    queryParams = {'f': 'json',
+                   'geometry':jsonGeometry,
+                   'geometryType':getGeometryType(jsonGeometry),
+                   'returnCountOnly':'true',
+                   'token': portalToken['token']}
+    if where:
+        queryParams['where'] = where
+
+    params = urllibEncode(queryParams)
+
+    countQuery = submitFSquery(RESTurl,params)
+
+    # request failed.....try once more
+    if not countQuery:
+        time.sleep(5)
+        countQuery = submitFSquery(RESTurl,params)
+
+        if not countQuery:
+            return False
+
+    return countQuery['count']
+
+## ===================================================================================
+def sweepCLUdensityGrid(grid,inFC,RESTurl):
+    """ This function will populate the density grid cells within the extent of inFC
+        (i.e. a state boundary) with one count query per cell.  This is intended to be
+        run once per state; afterwards requests within that area can be planned
+        without any count queries.  Cells that do not intersect inFC are skipped.
+
+        Returns the number of cells populated"""
+
+    try:
+        gridSR = arcpy.SpatialReference(grid['wkid'])
+        cellSize = grid['cellSize']
+        sweepGeometry = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@'])][0].projectAs(gridSR)
+        c0,c1,r0,r1 = getGridWindow(grid,sweepGeometry.extent)
+
+        AddMsgAndPrint("\nSweeping " + splitThousands((c1 - c0) * (r1 - r0)) + " CLU density grid cells")
+        arcpy.SetProgressor("step", "Sweeping CLU density grid", 0, (c1 - c0) * (r1 - r0), 1)
+        numOfCells = 0
+
+        for r in range(r0,r1):
+            for c in range(c0,c1):
+                arcpy.SetProgressorPosition()
+
+                x = grid['xmin'] + (c * cellSize)
+                y = grid['ymin'] + (r * cellSize)
+                if sweepGeometry.disjoint(getRectanglePolygon(x,y,x + cellSize,y + cellSize,gridSR)):
+                    continue
+
+                cellJSON = json.dumps({'xmin':x,'ymin':y,'xmax':x + cellSize,'ymax':y + cellSize,
+                                       'spatialReference':{'wkid':grid['wkid']}})
+                count = getCountQuery(cellJSON,RESTurl)
+
+                if count is False:
+                    AddMsgAndPrint("\tFailed to get count of cell " + str(c) + "," + str(r),1)
+                    continue
+
+                grid['counts'][(r * grid['ncols']) + c] = count
+                numOfCells += 1
+
+        arcpy.ResetProgressor()
+        return numOfCells
+
+    except:
+        errorMsg()
+        return 0
+
+## ===================================================================================
+def updateCLUdensityGrid(grid,envelopeDict):
+    """ This function will update the density grid from the CLU counts of the requests
+        planned by a regular run.  A request only updates the cells that lie entirely
+        within its geometry; small requests (i.e. clipped to the AOI boundary or
+        coalesced pieces) would otherwise spread their small count over the whole
+        cell.  The cell estimate is the CLU density of the request (count / area)
+        times the cell area.  A cell keeps the largest estimate observed so that a
+        sparse part of a dense cell never lowers it; planning errs on the side of
+        smaller requests.  Over time the grid fills in wherever the tool is being used.
+
+        envelopeDict - {'request_42': ['{"rings":...}', 691]}"""
+
+    try:
+        gridSR = arcpy.SpatialReference(grid['wkid'])
+        cellSize = grid['cellSize']
+
+        for request in envelopeDict.values():
+
+            # attribute and paged requests do not cover an area
+            if getRequestWhere(request) or getRequestParams(request):
+                continue
+
+            esriGeometry = json.loads(request[0])
+
+            if getGeometryType(request[0]) == 'esriGeometryEnvelope':
+                esriGeometry = {'rings':[[[esriGeometry['xmin'],esriGeometry['ymin']],[esriGeometry['xmin'],esriGeometry['ymax']],
+                                          [esriGeometry['xmax'],esriGeometry['ymax']],[esriGeometry['xmax'],esriGeometry['ymin']],
+                                          [esriGeometry['xmin'],esriGeometry['ymin']]]],
+                                'spatialReference':esriGeometry['spatialReference']}
+
+            requestGeometry = arcpy.AsShape(esriGeometry,True).projectAs(gridSR)
+            if requestGeometry.area <= 0:
+                continue
+
+            cellCount = int(math.ceil(float(request[1]) * (cellSize * cellSize) / requestGeometry.area))
+            c0,c1,r0,r1 = getGridWindow(grid,requestGeometry.extent)
+
+            for r in range(r0,r1):
+                for c in range(c0,c1):
+                    x = grid['xmin'] + (c * cellSize)
+                    y = grid['ymin'] + (r * cellSize)
+
+                    if not requestGeometry.contains(getRectanglePolygon(x,y,x + cellSize,y + cellSize,gridSR)):
+                        continue
+
+                    cell = (r * grid['ncols']) + c
+                    if grid['counts'][cell] == unknownCellValue or grid['counts'][cell] < cellCount:
+                        grid['counts'][cell] = cellCount
+
+    except:
+        errorMsg()
+
+## ===================================================================================
+def getGeometryHalves(piece):
+    """ This function will cut a polygon in half along the longer side of its bounding
+        box.  Halves that do not overlap the polygon are left out.
+
+        Returns a list of arcpy polygons"""
+
+    extent = piece.extent
+
+    if extent.width > extent.height:
+        midX = (extent.XMin + extent.XMax) / 2.0
+        halves = [getRectanglePolygon(extent.XMin,extent.YMin,midX,extent.YMax,piece.spatialReference),
+                  getRectanglePolygon(midX,extent.YMin,extent.XMax,extent.YMax,piece.spatialReference)]
+    else:
+        midY = (extent.YMin + extent.YMax) / 2.0
+        halves = [getRectanglePolygon(extent.XMin,extent.YMin,extent.XMax,midY,piece.spatialReference),
+                  getRectanglePolygon(extent.XMin,midY,extent.XMax,extent.YMax,piece.spatialReference)]
+
+    halfPieces = list()
+    for half in halves:
+        halfPiece = piece.intersect(half,4)
+        if halfPiece and halfPiece.area > 0:
+            halfPieces.append(halfPiece)
+
+    return halfPieces
+
+## ===================================================================================
+def bisectPieceByCount(geometry,RESTurl,bGeometry=True):
+    """ This function will split a piece in half along the longer side of its bounding
+        box until every piece has a CLU count within the WFS limit.  It is used when a
+        piece planned from the density grid turns out to hold more CLUs than the grid
+        estimated.
+
+        Returns a list of [JSON geometry, count] lists"""
+
+    requests = list()
+    pieces = [geometry]
+
+    while pieces:
+        piece = pieces.pop()
+
+        for halfPiece in getGeometryHalves(piece):
+            requestJSON = getRequestGeometry(halfPiece,geometry,bGeometry)
+            count = getCountQuery(requestJSON,RESTurl)
+
+            if count is False:
+                AddMsgAndPrint("\tFailed to get count request -- Using piece as is",1)
+                requests.append([requestJSON,maxRecordCount])
+            elif count <= maxRecordCount:
+                requests.append([requestJSON,count])
+            else:
+                pieces.append(halfPiece)
+
+    return requests
+
+## ===================================================================================
+def getCLUcentroidSample(jsonGeometry,RESTurl,spatialRef,sampleSize):
+    """ This function will return the object IDs of the CLUs within a JSON geometry
+        along with the centroids of a random sample of them.  The object IDs are not
+        limited by maxRecordCount so their number is the exact CLU count.  The
+        centroids are requested with returnCentroid and returnGeometry=false so no
+        boundaries are downloaded; sampleSize can exceed maxRecordCount, the sample
+        is requested in chunks of maxRecordCount.  Every CLU is sampled if there are
+        no more than sampleSize.  Centroids are returned in spatialRef.
+
+        Returns a tuple of (list of object IDs, list of (x,y) centroids); the list of
+        centroids is empty if the service does not return centroids.
+        Returns False if the object IDs could not be requested"""
+
+    params = urllibEncode({'f': 'json',
+                           'geometry':jsonGeometry,
+                           'geometryType':getGeometryType(jsonGeometry),
+                           'returnIdsOnly':'true',
+                           'token': portalToken['token']})
+
+    idQuery = submitFSquery(RESTurl,params)
+
+    if not idQuery:
+        return False
+
+    objectIds = idQuery['objectIds'] or []
+
+    if len(objectIds) <= maxRecordCount or not spatialRef.factoryCode:
+        return (objectIds,[])
+
+    sample = random.sample(objectIds,min(sampleSize,len(objectIds)))
+    centroids = list()
+
+    for i in range(0,len(sample),maxRecordCount):
+        params = urllibEncode({'f': 'json',
+                               'objectIds':','.join([str(oid) for oid in sample[i:i + maxRecordCount]]),
+                               'returnCentroid':'true',
+                               'returnGeometry':'false',
+                               'outFields':idQuery.get('objectIdFieldName','objectid'),
+                               'outSR':spatialRef.factoryCode,
+                               'token': portalToken['token']})
+
+        centroidQuery = submitFSquery(RESTurl,params)
+
+        # the chunks requested so far are still a random sample
+        if not centroidQuery:
+            break
+
+        # u'centroid': {u'x': -89.4077, u'y': 43.3340}
+        centroids.extend([(feature['centroid']['x'],feature['centroid']['y']) for feature in centroidQuery.get('features',[])
+                          if feature.get('centroid')])
+
+    return (objectIds,centroids)
+
+## ===================================================================================
+def splitExtentAtMedian(xmin,ymin,xmax,ymax,centroids,target):
+    """ This function will split a bounding box k-d tree style until every block holds
+        no more than target sampled centroids.  Each block is cut along its longer
+        side at the median coordinate of the centroids within it so that every cut
+        halves the CLU count instead of the area.  A block whose centroids are all
+        at the same location is not cut any further.
+
+        Returns a list of (xmin,ymin,xmax,ymax,number of centroids) tuples"""
+
+    blocks = [(xmin,ymin,xmax,ymax,centroids)]
+    rectangles = list()
+
+    while blocks:
+        xmin,ymin,xmax,ymax,points = blocks.pop()
+
+        if len(points) <= target:
+            rectangles.append((xmin,ymin,xmax,ymax,len(points)))
+            continue
+
+        # longer side first; the other side if every centroid shares the coordinate
+        axes = [0,1] if (xmax - xmin) >= (ymax - ymin) else [1,0]
+        axes = [axis for axis in axes if min([point[axis] for point in points]) < max([point[axis] for point in points])]
+
+        # identical centroids (multiple CLUs sampled at one location) can't be split
+        if not axes:
+            rectangles.append((xmin,ymin,xmax,ymax,len(points)))
+            continue
+
+        axis = axes[0]
+        coords = sorted([point[axis] for point in points])
+        median = coords[len(coords) // 2]
+
+        # the lowest centroids are at the median; cut just above them
+        if median == coords[0]:
+            median = min([coord for coord in coords if coord > median])
+
+        lowerPoints = [point for point in points if point[axis] < median]
+        upperPoints = [point for point in points if point[axis] >= median]
+
+        if axis == 0:
+            blocks.extend([(xmin,ymin,median,ymax,lowerPoints),(median,ymin,xmax,ymax,upperPoints)])
+        else:
+            blocks.extend([(xmin,ymin,xmax,median,lowerPoints),(xmin,median,xmax,ymax,upperPoints)])
+
+    return rectangles
+
+## ===================================================================================
+def createListOfJSONextentsByMedian(inFC,RESTurl,bGeometry=True):
+    """ This function will plan the requests for the AOI by splitting it at the median
+        CLU location instead of into equal areas (SubdividePolygon in
+        createListOfJSONextents, a 2 cell fishnet in createListOfJSONextents_ArcMap)
+        where halves often come out 95/5 by count and have to be split again.
+
+        1) The object IDs within a piece and the centroids of a random sample of up
+           to medianSampleSize x maxRecordCount of them are requested
+           (getCLUcentroidSample).  A piece with fewer CLUs is sampled completely.
+        2) The piece is split locally k-d tree style at the median sampled centroid
+           (splitExtentAtMedian) until every block is estimated to hold fewer than
+           medianSplitTarget x maxRecordCount CLUs.
+        3) Every block is clipped to the piece and reduced with getRequestGeometry.
+           Its CLU count is estimated from its share of the sampled centroids; the
+           estimate is exact if every CLU was sampled.  Only blocks without sampled
+           centroids and blocks whose estimate plus 2 standard errors exceeds the
+           target are verified with a count query; blocks that still exceed the WFS
+           limit are sampled and split again.  The target is below maxRecordCount so
+           CLUs crossing the cut, which are returned for both blocks but only counted
+           once, fit as well.
+
+        If the service does not return centroids pieces are cut in half.
+
+        Returns a dictionary in the same format as createListOfJSONextents.
+        Return False if the CLUs within the AOI could not be requested; the caller
+        should subdivide the AOI instead."""
+
+    try:
+        aoiGeometry = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@'])][0]
+        spatialRef = aoiGeometry.spatialReference
+        target = max(1,int(maxRecordCount * medianSplitTarget))
+
+        jsonDict = dict()
+        pieces = [aoiGeometry]
+        numOfQueries = 0
+        numOfEstimates = 0
+        bFirstPiece = True
+
+        while pieces:
+            piece = pieces.pop()
+            requestJSON = getRequestGeometry(piece,aoiGeometry,bGeometry)
+            arcpy.SetProgressorLabel("Determining # of WFS requests. Current #: " + str(len(jsonDict)))
+
+            sample = getCLUcentroidSample(requestJSON,RESTurl,spatialRef,int(maxRecordCount * medianSampleSize))
+            numOfQueries += 1
+
+            if sample is False:
+                if bFirstPiece:
+                    AddMsgAndPrint("Failed to get the CLUs within AOI; Subdividing the AOI instead",1)
+                    return False
+                AddMsgAndPrint("\tFailed to get CLUs of a piece -- Using piece as is",1)
+                jsonDict["median_request_" + str(len(jsonDict))] = [requestJSON,maxRecordCount]
+                continue
+
+            objectIds,centroids = sample
+            numOfQueries += int(math.ceil(len(centroids) / float(maxRecordCount)))
+
+            if bFirstPiece:
+                AddMsgAndPrint("\nThere are " + splitThousands(len(objectIds)) + " CLUs within AOI")
+                bFirstPiece = False
+
+            if len(objectIds) <= maxRecordCount:
+                jsonDict["median_request_" + str(len(jsonDict))] = [requestJSON,len(objectIds)]
+                continue
+
+            extent = piece.extent
+            rectangles = list()
+            if centroids:
+                # every sampled centroid stands for len(objectIds)/len(centroids) CLUs
+                sampleTarget = max(1,int(target * len(centroids) / float(len(objectIds))))
+                rectangles = splitExtentAtMedian(extent.XMin,extent.YMin,extent.XMax,extent.YMax,centroids,sampleTarget)
+
+            # no centroids or the sample could not be split; cut the piece in half
+            if len(rectangles) < 2:
+                if extent.width > extent.height:
+                    midX = (extent.XMin + extent.XMax) / 2.0
+                    rectangles = [(extent.XMin,extent.YMin,midX,extent.YMax,0),(midX,extent.YMin,extent.XMax,extent.YMax,0)]
+                else:
+                    midY = (extent.YMin + extent.YMax) / 2.0
+                    rectangles = [(extent.XMin,extent.YMin,extent.XMax,midY,0),(extent.XMin,midY,extent.XMax,extent.YMax,0)]
+
+            for xmin,ymin,xmax,ymax,numOfCentroids in rectangles:
+                block = piece.intersect(getRectanglePolygon(xmin,ymin,xmax,ymax,spatialRef),4)
+
+                if not block or block.area == 0:
+                    continue
+
+                blockJSON = getRequestGeometry(block,aoiGeometry,bGeometry)
+
+                # estimate the CLU count from the share of the sampled centroids
+                # (finite population); count the block if it may exceed the target
+                count = None
+                if numOfCentroids:
+                    share = numOfCentroids / float(len(centroids))
+                    estimate = share * len(objectIds)
+                    stdError = len(objectIds) * math.sqrt(share * (1 - share) / len(centroids) *
+                                                          (len(objectIds) - len(centroids)) / max(1.0,len(objectIds) - 1.0))
+
+                    if estimate + 2 * stdError <= target:
+                        count = int(math.ceil(estimate))
+                        numOfEstimates += 1
+
+                if count is None:
+                    count = getCountQuery(blockJSON,RESTurl)
+                    numOfQueries += 1
+
+                if count is False:
+                    AddMsgAndPrint("\tFailed to get count request -- Using piece as is",1)
+                    jsonDict["median_request_" + str(len(jsonDict))] = [blockJSON,maxRecordCount]
+                elif count == 0:
+                    continue
+                elif count <= maxRecordCount:
+                    jsonDict["median_request_" + str(len(jsonDict))] = [blockJSON,count]
+                else:
+                    pieces.append(block)
+
+        if len(jsonDict) < 1:
+            AddMsgAndPrint("\tMedian splitting did not plan any requests; Subdividing the AOI instead",1)
+            return False
+
+        AddMsgAndPrint("\t" + splitThousands(len(jsonDict)) + " server requests are needed (" + splitThousands(numOfQueries) + " planning queries; " +
+                       splitThousands(numOfEstimates) + " counts estimated from the sampled centroids)")
+        return jsonDict
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def createListOfJSONextentsFromGrid(inFC,grid,RESTurl,bGeometry=True):
+    """ This function will plan the requests for the AOI from the CLU density grid
+        instead of subdividing the AOI with count queries.
+
+        1) The grid cells covering the AOI are read and cells that do not intersect
+           the AOI are set to 0.  A summed-area table (prefix sums) of the cells gives
+           the CLU count of any block of cells in constant time.
+        2) Blocks with more CLUs than densityGridTarget x maxRecordCount are split
+           along their longer side at the count-weighted median, k-d tree style.  A
+           single cell that is still too dense is split into equal strips.
+        3) Every block is clipped to the AOI and reduced with getRequestGeometry.
+        4) The densityGridVerifyCount blocks with the highest estimates and every
+           block estimated at densityGridVerifyFraction x maxRecordCount or more are
+           verified with a count query; blocks that exceed the WFS limit are bisected.
+
+        Returns a dictionary in the same format as createListOfJSONextents.
+        Return False if the grid does not cover the whole AOI; the caller should
+        plan the AOI with count queries instead."""
+
+    try:
+        gridSR = arcpy.SpatialReference(grid['wkid'])
+        cellSize = grid['cellSize']
+        ncols = grid['ncols']
+        target = maxRecordCount * densityGridTarget
+
+        aoiGeometry = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@'])][0].projectAs(gridSR)
+        c0,c1,r0,r1 = getGridWindow(grid,aoiGeometry.extent)
+        width = c1 - c0
+        height = r1 - r0
+
+        if width < 1 or height < 1:
+            return False
+
+        # ------------------------------------------- summed-area table of the window
+        prefix = [[0] * (width + 1) for r in range(height + 1)]
+        for r in range(height):
+            rowSum = 0
+            for c in range(width):
+                count = grid['counts'][((r0 + r) * ncols) + c0 + c]
+
+                if count == unknownCellValue:
+                    x = grid['xmin'] + ((c0 + c) * cellSize)
+                    y = grid['ymin'] + ((r0 + r) * cellSize)
+                    if not aoiGeometry.disjoint(getRectanglePolygon(x,y,x + cellSize,y + cellSize,gridSR)):
+                        AddMsgAndPrint("\nCLU density grid does not cover the entire AOI; Planning with count queries",1)
+                        return False
+                    count = 0
+
+                rowSum += count
+                prefix[r + 1][c + 1] = prefix[r][c + 1] + rowSum
+
+        def blockSum(ca,cb,ra,rb):
+            return prefix[rb][cb] - prefix[ra][cb] - prefix[rb][ca] + prefix[ra][ca]
+
+        AddMsgAndPrint("\nThere are approximately " + splitThousands(blockSum(0,width,0,height)) + " CLUs within AOI (CLU density grid)")
+
+        # ------------------------------------------- k-d split of the window
+        blocks = [(0,width,0,height)]
+        rectangles = list()   # (xmin,ymin,xmax,ymax,estimated count)
+
+        while blocks:
+            ca,cb,ra,rb = blocks.pop()
+            estimate = blockSum(ca,cb,ra,rb)
+
+            xmin = grid['xmin'] + ((c0 + ca) * cellSize); xmax = grid['xmin'] + ((c0 + cb) * cellSize)
+            ymin = grid['ymin'] + ((r0 + ra) * cellSize); ymax = grid['ymin'] + ((r0 + rb) * cellSize)
+
+            if estimate <= target:
+                rectangles.append((xmin,ymin,xmax,ymax,estimate))
+
+            # single cell; split into equal strips
+            elif cb - ca == 1 and rb - ra == 1:
+                numOfStrips = int(math.ceil(estimate / target))
+                stripWidth = cellSize / numOfStrips
+                for strip in range(numOfStrips):
+                    rectangles.append((xmin + (strip * stripWidth),ymin,xmin + ((strip + 1) * stripWidth),ymax,
+                                       int(math.ceil(float(estimate) / numOfStrips))))
+
+            # split along the longer side at the count-weighted median
+            elif cb - ca >= rb - ra:
+                split = min(range(ca + 1,cb),key=lambda k: abs(blockSum(ca,k,ra,rb) - (estimate / 2.0)))
+                blocks.extend([(ca,split,ra,rb),(split,cb,ra,rb)])
+            else:
+                split = min(range(ra + 1,rb),key=lambda k: abs(blockSum(ca,cb,ra,k) - (estimate / 2.0)))
+                blocks.extend([(ca,cb,ra,split),(ca,cb,split,rb)])
+
+        # ------------------------------------------- clip blocks to the AOI
+        jsonDict = dict()
+        pieces = dict()
+        for i,rectangle in enumerate(rectangles):
+            xmin,ymin,xmax,ymax,estimate = rectangle
+            piece = aoiGeometry.intersect(getRectanglePolygon(xmin,ymin,xmax,ymax,gridSR),4)
+
+            if not piece or piece.area == 0:
+                continue
+
+            requestName = "grid_request_" + str(i)
+            pieces[requestName] = piece
+            jsonDict[requestName] = [getRequestGeometry(piece,aoiGeometry,bGeometry),int(estimate)]
+
+        # ------------------------------------------- verify the densest blocks
+        densest = sorted(jsonDict.keys(),key=lambda key: jsonDict[key][1],reverse=True)
+        densest = densest[:densityGridVerifyCount] + [key for key in densest[densityGridVerifyCount:]
+                                                      if jsonDict[key][1] >= maxRecordCount * densityGridVerifyFraction]
+        for requestName in densest:
+            count = getCountQuery(jsonDict[requestName][0],RESTurl)
+
+            if count is False:
+                continue
+
+            elif count <= maxRecordCount:
+                jsonDict[requestName][1] = count
+
+            else:
+                AddMsgAndPrint("\t" + requestName + " has " + splitThousands(count) + " CLUs; Splitting")
+                for j,request in enumerate(bisectPieceByCount(pieces[requestName],RESTurl,bGeometry)):
+                    jsonDict[requestName + "_" + str(j)] = request
+                del jsonDict[requestName]
+
+        if len(jsonDict) < 1:
+            return False
+
+        AddMsgAndPrint("\t" + splitThousands(len(jsonDict)) + " server requests are needed")
+        return jsonDict
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def getRequestWhere(request):
+    """ This function will return the where clause of a planned request or None if the
+        request is only a geometry.
+        ['{"rings":...}', 691]  or  ['{"rings":...}', 691, "state_ansi_code = '19'"]"""
+
+    if len(request) > 2:
+        return request[2]
+    return None
+
+## ===================================================================================
+def getRequestParams(request):
+    """ This function will return the additional query parameters of a planned request
+        (i.e. resultOffset and resultRecordCount of a paged request) or None.
+        ['{"rings":...}', 2000, None, {'resultOffset': 4000, 'resultRecordCount': 2000}]"""
+
+    if len(request) > 3:
+        return request[3]
+    return None
+
+## ===================================================================================
+def probeServiceCapabilities(metadata):
+    """ This function will inspect the layer definition of the CLU service and return
+        the query capabilities that the extraction strategies depend on.  Properties
+        that older servers do not report are treated as not supported.
+
+        Returns a dictionary
+        {'supportsPagination': True, 'supportsStatistics': True, 'supportsPbf': False,
+         'maxRecordCountFactor': 1, 'standardMaxRecordCount': None,
+         'supportsReturningQueryExtent': True, 'queryFormats': ['JSON','GEOJSON']}"""
+
+    try:
+        advanced = metadata.get('advancedQueryCapabilities') or dict()
+        queryFormats = [fmt.strip().upper() for fmt in (metadata.get('supportedQueryFormats') or 'JSON').split(',')]
+
+        capabilities = {'supportsPagination':bool(advanced.get('supportsPagination')),
+                        'supportsStatistics':bool(advanced.get('supportsStatistics',metadata.get('supportsStatistics'))),
+                        'supportsPbf':'PBF' in queryFormats,
+                        'maxRecordCountFactor':1,
+                        'standardMaxRecordCount':metadata.get('standardMaxRecordCount'),
+                        'supportsReturningQueryExtent':bool(advanced.get('supportsReturningQueryExtent')),
+                        'queryFormats':queryFormats}
+
+        # Pages can be up to 5 times maxRecordCount with the maxRecordCountFactor parameter
+        if advanced.get('supportsMaxRecordCountFactor'):
+            capabilities['maxRecordCountFactor'] = max(1,min(5,int(metadata.get('maxRecordCountFactor',5))))
+
+        def yesNo(value):
+            return "yes" if value else "no"
+
+        AddMsgAndPrint("\nCLU service capabilities: pagination=" + yesNo(capabilities['supportsPagination']) +
+                       ", statistics=" + yesNo(capabilities['supportsStatistics']) +
+                       ", PBF=" + yesNo(capabilities['supportsPbf']) +
+                       ", maxRecordCountFactor=" + str(capabilities['maxRecordCountFactor']) +
+                       ", standardMaxRecordCount=" + str(capabilities['standardMaxRecordCount']) +
+                       ", query extent=" + yesNo(capabilities['supportsReturningQueryExtent']))
+        return capabilities
+
+    except:
+        errorMsg()
+        return {'supportsPagination':False,'supportsStatistics':False,'supportsPbf':False,'maxRecordCountFactor':1,
+                'standardMaxRecordCount':None,'supportsReturningQueryExtent':False,'queryFormats':['JSON']}
+
+## ===================================================================================
+def selectExtractionStrategy(capabilities,requestedStrategy='auto'):
+    """ This function will pick the extraction strategy for this run and log the choice.
+
+        paged      - one count query for the AOI and pages of maxRecordCount x
+                     maxRecordCountFactor CLUs ordered by object ID (supportsPagination)
+        attribute  - requests by administrative partition from one outStatistics
+                     query (supportsStatistics and the partitionFields)
+        subdivide  - the AOI is subdivided with count queries or planned from the
+                     CLU density grid; works on every server
+
+        'auto' picks attribute if the service supports it and subdivide otherwise;
+        paged requests are large JSON responses and are only used if requested.  A
+        density grid takes precedence over attribute in 'auto' b/c it is planned
+        without any query.  A requested strategy the service does not support
+        falls back to subdivide.  CLUs are always requested as JSON; PBF is reported
+        but not decoded by this tool.
+
+        Returns the name of the strategy"""
+
+    try:
+        fsFields = [fld['name'] for fld in fsMetadata['fields']]
+        bPartitionFields = len([fld for fld in partitionFields if not fld in fsFields]) == 0
+
+        supported = {'paged':capabilities['supportsPagination'],
+                     'attribute':capabilities['supportsStatistics'] and bPartitionFields,
+                     'subdivide':True}
+
+        if requestedStrategy == 'auto':
+            if densityGrid:
+                strategy = 'subdivide'
+            else:
+                strategy = [name for name in ('attribute','subdivide') if supported[name]][0]
+
+        elif requestedStrategy in supported and supported[requestedStrategy]:
+            strategy = requestedStrategy
+
+        else:
+            AddMsgAndPrint("\nThe CLU service does not support the '" + str(requestedStrategy) + "' extraction strategy; Subdividing the AOI",1)
+            strategy = 'subdivide'
+
+        if strategy == 'paged':
+            pageSize = maxRecordCount * capabilities['maxRecordCountFactor']
+            AddMsgAndPrint("Extraction strategy: paged -- pages of " + splitThousands(pageSize) + " CLUs")
+        elif strategy == 'attribute':
+            AddMsgAndPrint("Extraction strategy: attribute -- partitioned by " + ", ".join(partitionFields))
+        elif densityGrid:
+            AddMsgAndPrint("Extraction strategy: subdivide -- planned from the CLU density grid")
+        else:
+            AddMsgAndPrint("Extraction strategy: subdivide -- AOI subdivided using count queries")
+
+        if capabilities['supportsPbf']:
+            AddMsgAndPrint("Transport: JSON (PBF is supported by the service but is not decoded by this tool)")
+        else:
+            AddMsgAndPrint("Transport: JSON")
+
+        return strategy
+
+    except:
+        errorMsg()
+        return 'subdivide'
+
+## ===================================================================================
+def createListOfPagedRequests(inFC,RESTurl,bGeometry=True):
+    """ This function will plan the requests for the AOI as pages of a single query
+        ordered by object ID.  Only one count query is needed and no geoprocessing is
+        done.  If the service supports maxRecordCountFactor every page holds up to
+        maxRecordCount x maxRecordCountFactor CLUs which reduces the number of
+        requests by that factor.  Pages never overlap.
+
+        Returns a dictionary in the same format as createListOfJSONextents with the
+        paging parameters as a 4th item:
+        {'page_3': ['{"rings":...}', 2000, None, {'resultOffset': 6000, 'resultRecordCount': 2000, 'orderByFields': 'objectid'}]}
+
+        Return False if the CLU count could not be determined."""
+
+    try:
+        oidField = [fld['name'] for fld in fsMetadata['fields'] if fld['type'] == 'esriFieldTypeOID'][0]
+
+        aoiGeometry = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@'])][0]
+        jSONpolygon = getRequestGeometry(aoiGeometry,aoiGeometry,bGeometry)
+
+        count = getCountQuery(jSONpolygon,RESTurl)
+        if count is False:
+            AddMsgAndPrint("\nFailed to get the CLU count of the AOI; Subdividing the AOI",1)
+            return False
+
+        factor = serviceCapabilities['maxRecordCountFactor']
+        pageSize = maxRecordCount * factor
+
+        jsonDict = dict()
+        for offset in range(0,count,pageSize):
+            pageParams = {'resultOffset':offset,'resultRecordCount':pageSize,'orderByFields':oidField}
+            if factor > 1:
+                pageParams['maxRecordCountFactor'] = factor
+
+            jsonDict['page_' + str(offset // pageSize)] = [jSONpolygon,min(pageSize,count - offset),None,pageParams]
+
+        AddMsgAndPrint("\nThere are " + splitThousands(count) + " CLUs within AOI")
+        AddMsgAndPrint("\t" + splitThousands(len(jsonDict)) + " server requests are needed")
+
+        if len(jsonDict) < 1:
+            return False
+
+        return jsonDict
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def createListOfJSONextentsByAttribute(inFC,RESTurl,bGeometry=True):
+    """ This function will plan the requests for the AOI by administrative partition
+        instead of geometric bisection.  A single outStatistics query grouped by the
+        partitionFields (i.e. state and county ANSI codes) returns the exact CLU count
+        of every partition within the AOI.  Every partition becomes a request of the
+        form "where state_ansi_code = '19' AND county_ansi_code = '153'" with the AOI
+        as its geometry.  Partitions with more CLUs than the WFS limit are split into
+        objectId ranges of at most maxRecordCount CLUs.  Partitions never overlap so
+        no CLU is downloaded twice.
+
+        Returns a dictionary in the same format as createListOfJSONextents with the
+        where clause as a 3rd item:
+        {'partition_19_153': ['{"rings":...}', 812, "state_ansi_code = '19' AND county_ansi_code = '153'"]}
+
+        Return False if the service does not support the partition fields or the
+        statistics query failed; the caller should plan the AOI geometrically."""
+
+    try:
+        fsFields = dict([(fld['name'],fld['type']) for fld in fsMetadata['fields']])
+        missingFields = [fld for fld in partitionFields if not fld in fsFields]
+
+        if missingFields:
+            AddMsgAndPrint("\nCLU service does not have partition field(s): " + ", ".join(missingFields) + "; Planning geometrically",1)
+            return False
+
+        oidField = [name for name,fldType in fsFields.items() if fldType == 'esriFieldTypeOID'][0]
+
+        # deconstructed AOI geometry and the reduced geometry sent to the WFS
+        aoiGeometry = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@'])][0]
+        jSONpolygon = getRequestGeometry(aoiGeometry,aoiGeometry,bGeometry)
+
+        params = urllibEncode({'f': 'json',
+                               'geometry':jSONpolygon,
+                               'geometryType':getGeometryType(jSONpolygon),
+                               'where':'1=1',
+                               'outStatistics':json.dumps([{'statisticType':'count',
+                                                            'onStatisticField':oidField,
+                                                            'outStatisticFieldName':'clu_count'}]),
+                               'groupByFieldsForStatistics':','.join(partitionFields),
+                               'token': portalToken['token']})
+
+        # {'features': [{'attributes': {'state_ansi_code': '19', 'county_ansi_code': '153', 'clu_count': 812}}]}
+        statsQuery = submitFSquery(RESTurl,params)
+
+        if not statsQuery or not 'features' in statsQuery:
+            AddMsgAndPrint("\nFailed to get CLU counts by partition; Planning geometrically",1)
+            return False
+
+        jsonDict = dict()
+        totalCLUs = 0
+
+        for partition in statsQuery['features']:
+            attributes = partition['attributes']
+            count = attributes.get('clu_count') or attributes.get('CLU_COUNT') or 0
+            totalCLUs += count
+
+            whereList = list()
+            for fld in partitionFields:
+                value = attributes[fld]
+                if value is None:
+                    whereList.append(fld + " IS NULL")
+                elif fsFields[fld] == 'esriFieldTypeString':
+                    whereList.append(fld + " = '" + str(value).replace("'","''") + "'")
+                else:
+                    whereList.append(fld + " = " + str(value))
+
+            where = " AND ".join(whereList)
+            partitionName = "partition_" + "_".join([str(attributes[fld]) for fld in partitionFields])
+
+            if count <= maxRecordCount:
+                jsonDict[partitionName] = [jSONpolygon,count,where]
+                continue
+
+            # Split large partitions into objectId ranges
+            params = urllibEncode({'f': 'json',
+                                   'geometry':jSONpolygon,
+                                   'geometryType':getGeometryType(jSONpolygon),
+                                   'where':where,
+                                   'returnIdsOnly':'true',
+                                   'token': portalToken['token']})
+
+            idQuery = submitFSquery(RESTurl,params)
+
+            if not idQuery:
+                AddMsgAndPrint("\nFailed to get object IDs of " + partitionName + "; Planning geometrically",1)
+                return False
+
+            objectIds = sorted(idQuery['objectIds'] or [])
+            for i in range(0,len(objectIds),maxRecordCount):
+                chunk = objectIds[i:i + maxRecordCount]
+                rangeWhere = where + " AND " + oidField + " >= " + str(chunk[0]) + " AND " + oidField + " <= " + str(chunk[-1])
+                jsonDict[partitionName + "_" + str(i // maxRecordCount)] = [jSONpolygon,len(chunk),rangeWhere]
+
+        AddMsgAndPrint("\nThere are " + splitThousands(totalCLUs) + " CLUs within AOI in " + str(len(statsQuery['features'])) + " partitions")
+
+        if len(jsonDict) < 1:
+            return False
+
+        AddMsgAndPrint("\t" + splitThousands(len(jsonDict)) + " server requests are needed")
+        return jsonDict
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def getJSONgeometryBounds(jsonGeometry):
+    """ This function will return the bounding box (xmin,ymin,xmax,ymax) of an ESRI
+        JSON polygon or envelope string such as the ones stored in geometryEnvelopes."""
+
+    geometry = json.loads(jsonGeometry)
+
+    if 'rings' in geometry:
+        xs = [coord[0] for ring in geometry['rings'] for coord in ring]
+        ys = [coord[1] for ring in geometry['rings'] for coord in ring]
+        return (min(xs),min(ys),max(xs),max(ys))
+    else:
+        return (geometry['xmin'],geometry['ymin'],geometry['xmax'],geometry['ymax'])
+
+## ===================================================================================
+def coalescePlannedRequests(envelopeDict,margin=0.1):
+    """ This function will merge spatially adjacent planned requests whose combined
+        CLU count fits within maxRecordCount into a single request.  Binary splitting
+        often leaves siblings of i.e. 120 and 880 CLUs and every tiny request pays a
+        full round trip.
+
+        Requests are packed greedily, smallest first: each request is merged with the
+        adjacent request (bounding boxes touching or overlapping) that leaves the
+        least room in the merged request (best fit) until no more merges are
+        possible.  The combined count has to be below maxRecordCount less margin (a
+        fraction of maxRecordCount); counts of adjacent requests include the CLUs on
+        their shared edge twice so the combined count never under-estimates.  Merged
+        geometries are the union of the request geometries.  Attribute and paged
+        requests are left as they are.
+
+        envelopeDict - {'request_42': ['{"rings":...}', 691]}
+
+        Returns a dictionary in the same format; the original dictionary if error"""
+
+    try:
+        capacity = maxRecordCount - int(math.ceil(maxRecordCount * margin))
+
+        # groups of requests that are candidates for merging
+        groups = list()
+        for key,request in envelopeDict.items():
+            if getRequestWhere(request) or getRequestParams(request) or request[1] >= capacity:
+                continue
+            groups.append({'keys':[key],'count':request[1],'bounds':getJSONgeometryBounds(request[0])})
+
+        if len(groups) < 2:
+            return envelopeDict
+
+        def isAdjacent(a,b):
+            # bounding boxes touch or overlap; allow for floating point noise along shared edges
+            tolerance = 1e-9 * max(abs(a[2]),abs(a[3]),1.0)
+            return not (a[2] < b[0] - tolerance or b[2] < a[0] - tolerance or
+                        a[3] < b[1] - tolerance or b[3] < a[1] - tolerance)
+
+        bMerged = True
+        while bMerged:
+            bMerged = False
+            groups.sort(key=lambda grp: grp['count'])
+
+            for group in groups:
+                if group.get('merged'):
+                    continue
+
+                bestFit = None
+                for other in groups:
+                    if other is group or other.get('merged'):
+                        continue
+                    if group['count'] + other['count'] > capacity or not isAdjacent(group['bounds'],other['bounds']):
+                        continue
+                    if bestFit is None or other['count'] > bestFit['count']:
+                        bestFit = other
+
+                if bestFit:
+                    group['keys'].extend(bestFit['keys'])
+                    group['count'] += bestFit['count']
+                    group['bounds'] = (min(group['bounds'][0],bestFit['bounds'][0]),min(group['bounds'][1],bestFit['bounds'][1]),
+                                       max(group['bounds'][2],bestFit['bounds'][2]),max(group['bounds'][3],bestFit['bounds'][3]))
+                    bestFit['merged'] = True
+                    bMerged = True
+
+            groups = [grp for grp in groups if not grp.get('merged')]
+
+        # Assemble the merged requests
+        coalescedDict = dict(envelopeDict)
+        for group in groups:
+            if len(group['keys']) < 2:
+                continue
+
+            mergedGeometry = None
+            for key in group['keys']:
+                esriGeometry = json.loads(envelopeDict[key][0])
+
+                if getGeometryType(envelopeDict[key][0]) == 'esriGeometryEnvelope':
+                    esriGeometry = {'rings':[[[esriGeometry['xmin'],esriGeometry['ymin']],[esriGeometry['xmin'],esriGeometry['ymax']],
+                                              [esriGeometry['xmax'],esriGeometry['ymax']],[esriGeometry['xmax'],esriGeometry['ymin']],
+                                              [esriGeometry['xmin'],esriGeometry['ymin']]]],
+                                    'spatialReference':esriGeometry['spatialReference']}
+
+                polygon = arcpy.AsShape(esriGeometry,True)
+                mergedGeometry = polygon if mergedGeometry is None else mergedGeometry.union(polygon)
+                del coalescedDict[key]
+
+            coalescedDict[group['keys'][0] + "_merged"] = [mergedGeometry.JSON,group['count']]
+
+        if len(coalescedDict) < len(envelopeDict):
+            AddMsgAndPrint("\tCoalesced " + splitThousands(len(envelopeDict)) + " planned requests into " + splitThousands(len(coalescedDict)))
+
+        return coalescedDict
+
+    except:
+        errorMsg()
+        return envelopeDict
+
+## ===================================================================================
+def planJSONextents(inFC,RESTurl,bGeometry=True):
+    """ This function will plan the requests for the AOI.  If a CLU density grid is
+        loaded the requests are planned from the grid; otherwise (or if the grid does
+        not cover the AOI) the AOI is subdivided using count queries (at the median
+        CLU location if bMedianSplitting is set) and the counts that were discovered
+        are added to the grid.  The paged and attribute
+        strategies (selectExtractionStrategy) are planned first if they were selected.
+        If bCoalesceRequests is set adjacent undersized requests are merged
+        (coalescePlannedRequests).
+
+        Returns a dictionary in the same format as createListOfJSONextents.
+        Return False if the requests could not be planned."""
+
+    if extractionStrategy == 'paged':
+        jsonDict = createListOfPagedRequests(inFC,RESTurl,bGeometry)
+        if jsonDict:
+            return jsonDict
+
+    if extractionStrategy == 'attribute':
+        jsonDict = createListOfJSONextentsByAttribute(inFC,RESTurl,bGeometry)
+        if jsonDict:
+            return jsonDict
+
+    if densityGrid:
+        jsonDict = createListOfJSONextentsFromGrid(inFC,densityGrid,RESTurl,bGeometry)
+        if jsonDict:
+            if bCoalesceRequests:
+                jsonDict = coalescePlannedRequests(jsonDict,coalesceMargin)
+            return jsonDict
+
+    jsonDict = False
+    if bMedianSplitting:
+        jsonDict = createListOfJSONextentsByMedian(inFC,RESTurl,bGeometry)
+
+    if not jsonDict:
+        if bArcGISPro:
+            jsonDict = createListOfJSONextents(inFC,RESTurl,bGeometry)
+        else:
+            jsonDict = createListOfJSONextents_ArcMap(inFC,RESTurl,bGeometry)
+
+    if jsonDict and densityGrid:
+        updateCLUdensityGrid(densityGrid,jsonDict)
+        saveCLUdensityGrid(densityGrid,densityGridFile)
+
+    # after the grid update; merged requests span several grid windows
+    if jsonDict and bCoalesceRequests:
+        jsonDict = coalescePlannedRequests(jsonDict,coalesceMargin)
+
+    return jsonDict
+
+## ===================================================================================
+def createOutputFC(metadata,outputWS,shape="POLYGON",fieldList=None):
+    """ This function will create an empty polygon feature class within the outputWS
+        The feature class will be set to the same spatial reference as the Web Feature
+        Service. All fields part of the WFS will also be added to the new feature class.
+        A field dictionary containing the field names and their property will also be
+        returned.  This fieldDict will be used to create the fields in the CLU fc and
+        by the getCLUgeometry insertCursor.
+
+        If a fieldList is passed in only those WFS fields (and clu_identifier, which is
+        needed to remove duplicate CLUs) are added.  If shape is None a table is
+        created instead of a feature class for attribute-only extracts.
+
+        If bUseSchemaTemplate is set the output is created in one operation from a
+        template with the same schema kept in the scratch GDB (getSchemaTemplate).
+
+        If bFGDBbulkLoad is set the spatial index of a File Geodatabase feature class
+        is removed so that it is not maintained while CLUs are inserted; it is built
+        once at the end by buildOutputIndexes.
+
+        fieldDict ={field:(fieldType,fieldLength,alias)
+        i.e {'clu_identifier': ('TEXT', 36, 'clu_identifier'),'clu_number': ('TEXT', 7, 'clu_number')}
+
+        Return the field dictionary and new feature class including the path
+        Return False if error ocurred."""
+
+    try:
+        AddMsgAndPrint("\nCreating New Feature Class: " + "CLU_" + os.path.basename(AOI))
+        arcpy.SetProgressorLabel("Creating New Feature Class: " + "CLU_" + os.path.basename(AOI))
+
+        # output FC will have the AOI name with 'CLU_' as a prefix
+        newFC = outputWS + os.sep + "CLU_" + os.path.basename(AOI)
+
+        # set the spatial Reference to same as WFS
+        # Probably WGS_1984_Web_Mercator_Auxiliary_Sphere
+        # {'spatialReference': {'latestWkid': 3857, 'wkid': 102100}
+        spatialReferences = metadata['extent']['spatialReference']
+        if 'latestWkid' in [sr for sr in spatialReferences.keys()]:
+            sr = spatialReferences['latestWkid']
+        else:
+            sr = spatialReferences['wkid']
+
+        outputCS = arcpy.SpatialReference(sr)
+
+        # fields associated with feature service
+        fsFields = metadata['fields']   # {u'alias':u'land_unit_id',u'domain': None, u'name': u'land_unit_id', u'nullable': True, u'editable': True, u'alias': u'LAND_UNIT_ID', u'length': 38, u'type': u'esriFieldTypeString'}
+        fieldDict = dict()
+
+        # lookup list for fields that are in DATE field; Date values need to be converted
+        # from Unix Epoch format to mm/dd/yyyy format in order to populate a table
+        dateFields = list()
+
+        # cross-reference portal attribute description with ArcGIS attribute description
+        fldTypeDict = {'esriFieldTypeString':'TEXT','esriFieldTypeDouble':'DOUBLE','esriFieldTypeSingle':'FLOAT',
+                       'esriFieldTypeInteger':'LONG','esriFieldTypeSmallInteger':'SHORT','esriFieldTypeDate':'DATE',
+                       'esriFieldTypeGUID':'GUID','esriFieldTypeGlobalID':'GUID'}
+
+        # Collect field info to pass to new fc
+        for fieldInfo in fsFields:
+
+            # skip the OID field
+            if fieldInfo['type'] == 'esriFieldTypeOID':
+               continue
+
+            fldType = fldTypeDict[fieldInfo['type']]
+            fldAlias = fieldInfo['alias']
+            fldName = fieldInfo['name']
+
+            # skip the SHAPE_STArea__ and SHAPE_STLength__ fields
+            if fldName.find("SHAPE_ST") > -1:
+               continue
+
+            # skip fields that were not selected
+            if fieldList and not fldName in fieldList and fldName != 'clu_identifier':
+               continue
+
+            if fldType == 'TEXT':
+               fldLength = fieldInfo['length']
+            elif fldType == 'DATE':
+                 dateFields.append(fldName)
+            else:
+               fldLength = ""
+
+            fieldDict[fldName] = (fldType,fldLength,fldAlias)
+
+        if fieldList:
+            for fldName in fieldList:
+                if not fldName in fieldDict:
+                    AddMsgAndPrint("\t" + fldName + " is not a field of the CLU service.  Ignored",1)
+
+        # Delete newFC if it exists
+        if arcpy.Exists(newFC):
+           arcpy.Delete_management(newFC)
+           AddMsgAndPrint("\t" + os.path.basename(newFC) + " exists.  Deleted")
+
+        templateFC = getSchemaTemplate(fieldDict,shape,outputCS) if bUseSchemaTemplate else False
+
+        # Create the output from the schema template in one operation
+        if templateFC:
+            if shape:
+                arcpy.CreateFeatureclass_management(outputWS, os.path.basename(newFC), shape, templateFC, "DISABLED", "DISABLED", outputCS)
+            else:
+                arcpy.CreateTable_management(outputWS, os.path.basename(newFC), templateFC)
+
+        # Create empty polygon featureclass and add fields one at a time
+        else:
+            createEmptyOutput(outputWS,os.path.basename(newFC),shape,outputCS,fieldDict)
+
+        # Bulk load; the spatial index is built after all CLUs are inserted
+        if bFGDBbulkLoad and shape and outputWS.lower().endswith('.gdb'):
+            arcpy.RemoveSpatialIndex_management(newFC)
+
+        return fieldDict,newFC
+
+    except:
+        errorMsg()
+        AddMsgAndPrint("\tFailed to create scratch " + newFC + " Feature Class",2)
+        return False
+
+## ===================================================================================
+def buildOutputIndexes(outputFC):
+    """ This function will build the indexes of an output that was bulk loaded
+        (bFGDBbulkLoad) in one pass once all CLUs are inserted:
+
+            1) a spatial index with a grid size calculated from the extents of the
+               inserted CLUs (CalculateDefaultGridIndex); File Geodatabases use a
+               single grid level
+            2) an attribute index on clu_identifier, the key outputs are joined and
+               updated on
+
+        Tables (attribute-only extracts) only get the attribute index.
+
+        Return True if the indexes were built; False otherwise"""
+
+    try:
+        AddMsgAndPrint("\nBuilding indexes of " + os.path.basename(outputFC))
+        arcpy.SetProgressorLabel("Building indexes of " + os.path.basename(outputFC))
+
+        if arcpy.Describe(outputFC).dataType == 'FeatureClass' and int(arcpy.GetCount_management(outputFC)[0]) > 0:
+            gridSize = float(arcpy.CalculateDefaultGridIndex_management(outputFC).getOutput(0))
+            arcpy.AddSpatialIndex_management(outputFC,gridSize)
+            AddMsgAndPrint("\tSpatial index grid size: " + str(round(gridSize,2)))
+
+        arcpy.AddIndex_management(outputFC,['clu_identifier'],"clu_identifier_idx","NON_UNIQUE","ASCENDING")
+        AddMsgAndPrint("\tAttribute index: clu_identifier")
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def openCLUidentifierStore(memoryThreshold=250000,spillFolder=None):
+    """ This function will create the store used to keep track of the clu_identifiers
+        that have already been inserted so that CLUs returned by more than one request
+        are only inserted once.  Identifiers are kept in a python set until the set
+        holds more than memoryThreshold identifiers after which they are moved into a
+        temporary sqlite database on disk so that memory stays flat regardless of AOI
+        size.
+
+        Returns a dictionary describing the store"""
+
+    return {'ids':set(),
+            'claims':set(),               # identifiers claimed by requests in flight
+            'lock':threading.Lock(),      # the store is shared with download threads
+            'threshold':memoryThreshold,
+            'spillFolder':spillFolder,
+            'db':None,
+            'dbPath':None}
+
+## ===================================================================================
+def addCLUidentifier(store,cluID):
+    """ This function will add cluID to the store of inserted clu_identifiers.
+
+        Return True if cluID is new; False if it has already been inserted"""
+
+    with store['lock']:
+        if store['db'] is None:
+            if cluID in store['ids']:
+                return False
+            store['ids'].add(cluID)
+
+            # Spill the identifiers to disk once the threshold is exceeded
+            if len(store['ids']) > store['threshold']:
+                spillFolder = store['spillFolder'] or tempfile.gettempdir()
+                store['dbPath'] = os.path.join(spillFolder,"clu_identifiers_" + str(random.randint(1,9999999999)) + ".sqlite")
+                store['db'] = sqlite3.connect(store['dbPath'],check_same_thread=False)
+                store['db'].execute("PRAGMA journal_mode=OFF")
+                store['db'].execute("PRAGMA synchronous=OFF")
+                store['db'].execute("CREATE TABLE clu_ids (clu_identifier TEXT PRIMARY KEY) WITHOUT ROWID")
+                store['db'].executemany("INSERT INTO clu_ids VALUES (?)",[(i,) for i in store['ids']])
+                store['ids'] = set()
+                AddMsgAndPrint("\tMore than " + splitThousands(store['threshold']) + " CLUs downloaded; tracking CLU identifiers on disk")
+
+            return True
+
+        else:
+            return store['db'].execute("INSERT OR IGNORE INTO clu_ids VALUES (?)",(cluID,)).rowcount == 1
+
+## ===================================================================================
+def hasCLUidentifier(store,cluID):
+    """ This function will return True if cluID is in the store of inserted
+        clu_identifiers without adding it."""
+
+    with store['lock']:
+        if store['db'] is None:
+            return cluID in store['ids']
+        else:
+            return store['db'].execute("SELECT 1 FROM clu_ids WHERE clu_identifier = ?",(cluID,)).fetchone() is not None
+
+## ===================================================================================
+def claimCLUidentifiers(store,cluIDs):
+    """ This function will claim the identifiers that are neither in the store nor
+        claimed by another request in flight so that concurrent requests on
+        overlapping extents do not download the same CLUs.  Claims are released by
+        releaseCLUidentifiers once the request succeeded (after the identifiers were
+        added) or failed.
+
+        Returns the list of identifiers claimed"""
+
+    claimed = list()
+    for cluID in cluIDs:
+        if hasCLUidentifier(store,cluID):
+            continue
+
+        with store['lock']:
+            if not cluID in store['claims']:
+                store['claims'].add(cluID)
+                claimed.append(cluID)
+
+    return claimed
+
+## ===================================================================================
+def releaseCLUidentifiers(store,cluIDs):
+    """ This function will release identifiers claimed by claimCLUidentifiers."""
+
+    with store['lock']:
+        for cluID in cluIDs or []:
+            store['claims'].discard(cluID)
+
+## ===================================================================================
+def closeCLUidentifierStore(store):
+    """ This function will close and delete the on-disk portion of the store if the
+        identifiers were spilled to disk."""
+
+    try:
+        if store['db'] is not None:
+            store['db'].close()
+            os.remove(store['dbPath'])
+            store['db'] = None
+        store['ids'] = set()
+
+    except:
+        errorMsg()
+
+## ===================================================================================
+def getCLUgeometryByExtent(JSONextent,fc,RESTurl,where=None,pageParams=None):
+    """ This funciton will will retrieve CLU geometry from the CLU WFS and assemble
+        into the CLU fc along with the attributes associated with it.
+        It is intended to receive requests that will return records that are
+        below the WFS record limit.  An optional where clause further restricts
+        the CLUs within the extent (see createListOfJSONextentsByAttribute) and
+        pageParams request a single page of them (see createListOfPagedRequests).
+
+        The CLUs are requested by fetchCLUgeometry and inserted by insertCLUgeometry.
+
+        Return True if the CLUs were retrieved and inserted; False otherwise"""
+
+    result = fetchCLUgeometry(JSONextent,RESTurl,where,pageParams)
+
+    if not result:
+        return False
+
+    return insertCLUgeometry(result[0],fc,result[1])
+
+## ===================================================================================
+def fetchCLUgeometry(JSONextent,RESTurl,where=None,pageParams=None):
+    """ This function will request the CLUs of a planned request from the CLU WFS
+        without inserting them (see getCLUgeometryByExtent) so it can be run on a
+        download thread.  Messages and token regeneration of download threads are
+        handed to the main thread (AddMsgAndPrint, callOnMainThread).
+
+        If bIDdiffFetching is set the object IDs within the extent are requested
+        first (returnIdsOnly) and only the object IDs that have not already been
+        ingested by a previous request, nor claimed by a request in flight, are
+        downloaded with full geometry.  Planned extents overlap along their edges so
+        this avoids downloading the same boundary CLUs more than once.  Claims are
+        released if the request fails.  Pages never overlap so paged requests are not
+        ID-diffed.
+
+        Returns a tuple of (feature service response, object IDs to mark as ingested
+        once inserted); False if the request failed"""
+
+    newObjectIds = None
+    try:
+
+        # Only request the fields (and geometry) that are written to the output
+        outFields = ','.join([fld for fld in fields if fld != 'SHAPE@JSON'])
+        bGeometry = 'SHAPE@JSON' in fields
+        returnGeometry = 'true' if bGeometry else 'false'
+
+        newObjectIds = None
+        if bIDdiffFetching and not pageParams:
+            queryParams = {'f': 'json',
+                           'geometry':JSONextent,
+                           'geometryType':getGeometryType(JSONextent),
+                           'returnIdsOnly':'true',
+                           'token': portalToken['token']}
+            if where:
+                queryParams['where'] = where
+
+            params = urllibEncode(queryParams)
+
+            # {'objectIdFieldName': 'objectid', 'objectIds': [1234, 1235]}
+            idQuery = submitFSquery(RESTurl,params)
+
+            if not idQuery:
+               return False
+
+            # object IDs downloaded or being downloaded by another request are skipped
+            newObjectIds = claimCLUidentifiers(ingestedObjectIds,idQuery['objectIds'] or [])
+
+            # Every CLU within this extent has already been downloaded
+            if not newObjectIds:
+               return ({'features':[]},None)
+
+            params = urllibEncode({'f': 'json',
+                                   'objectIds':','.join([str(oid) for oid in newObjectIds]),
+                                   'returnGeometry':returnGeometry,
+                                   'outFields': outFields,
+                                   'token': portalToken['token']})
+
+        else:
+            queryParams = {'f': 'json',
+                           'geometry':JSONextent,
+                           'geometryType':getGeometryType(JSONextent),
+                           'returnGeometry':returnGeometry,
+                           'outFields': outFields,
+                           'token': portalToken['token']}
+            if where:
+                queryParams['where'] = where
+            if pageParams:
+                queryParams.update(pageParams)
+
+            params = urllibEncode(queryParams)
+
+        # Send request to feature service; The following dict keys are returned:
+        # ['objectIdFieldName', 'globalIdFieldName', 'geometryType', 'spatialReference', 'fields', 'features']
+        geometry = submitFSquery(RESTurl,params)
+
+        if not geometry:
+           releaseCLUidentifiers(ingestedObjectIds,newObjectIds)
+           return False
+
+        # Pages other than the last always exceed the transfer limit
+        if pageParams:
+           geometry.pop('exceededTransferLimit',None)
+
+        return (geometry,newObjectIds)
+
+    except:
+        releaseCLUidentifiers(ingestedObjectIds,newObjectIds)
+        errorMsg()
+        return False
+
+## ===================================================================================
+def insertCLUgeometry(geometry,fc,newObjectIds=None):
+    """ This function will assemble the CLUs of a feature service response into the
+        CLU fc along with the attributes associated with them.  CLUs that were already
+        inserted by another request are skipped.  Object IDs are only marked as
+        ingested once the CLUs were inserted so a failed request can be re-submitted
+        as is.  Responses cut off at the WFS record limit are counted in
+        requestStats['truncated'].
+
+        Return True if the CLUs were inserted; False otherwise"""
+
+    try:
+        bGeometry = 'SHAPE@JSON' in fields
+
+        # More CLUs than the WFS limit were within this extent; only maxRecordCount were returned
+        if geometry.get('exceededTransferLimit'):
+            AddMsgAndPrint("\tRequest exceeded the WFS record limit -- some CLUs may be missing",1)
+            with stateLock:
+                requestStats['truncated'] += 1
+
+        # Insert Geometry; CLUs are appended to the column spool instead if one is open
+        beginProfileStage('transform')
+        if columnSpool:
+            cur = None
+        else:
+            cur = arcpy.da.InsertCursor(fc, [fld for fld in fields])
+
+        arcpy.SetProgressor("step", "Assembling Geometry", 0, len(geometry['features']),1)
+        rows = list()      # rows are inserted as a batch once the response is assembled
+
+        # Iterenate through the 'features' key in geometry dict
+        # 'features' contains geometry and attributes
+        for rec in geometry['features']:
+
+            arcpy.SetProgressorLabel("Assembling Geometry")
+            values = list()    # list of attributes
+
+            attributes = rec['attributes']          # u'attributes': {u'land_unit_id': u'73F53BC1-E3F8-4747-B51F-E598EE445E47'}}
+
+            # "clu_identifier" is the unique field that will be used to
+            # maintain unique CLUs; If the CLU exists continue
+            if not addCLUidentifier(cluIdentifiers,attributes['clu_identifier']):
+               continue
+
+            if columnSpool:
+                appendColumnSpoolRow(columnSpool,attributes,rec['geometry'] if bGeometry else None)
+
+            else:
+                for fld in fields:
+                    if fld == "SHAPE@JSON":
+                        continue
+
+                    # DATE values need to be converted from Unix Epoch format
+                    # to dd/mm/yyyy format so that it can be inserted into fc.
+                    elif fldsDict[fld][0] == 'DATE':
+                        dateVal = attributes[fld]
+                        if not dateVal in (None,'null','','Null'):
+                            epochFormat = float(attributes[fld]) # 1609459200000
+
+                            # Convert to seconds from milliseconds and reformat
+                            localFormat = time.strftime('%m/%d/%Y',time.gmtime(epochFormat/1000))   # 01/01/2021
+                            values.append(localFormat)
+                        else:
+                            values.append(None)
+
+                    else:
+                        values.append(attributes[fld])
+
+                # geometry goes at the the end
+                if bGeometry:
+                    values.append(json.dumps(rec['geometry']))   # u'geometry': {u'rings': [[[-89.407702228, 43.334059191999984], [-89.40769642800001, 43.33560779300001]}
+
+                rows.append(values)
+
+            # the streamed outputs are written before the final AOI filter
+            if (fgbWriter or parquetWriter) and isCLUwithinAOI(aoiFilter,rec.get('geometry')):
+                if fgbWriter:
+                    writeFlatGeobufFeature(fgbWriter,attributes,rec['geometry'])
+
+                if parquetWriter:
+                    writeGeoParquetFeature(parquetWriter,attributes,rec['geometry'])
+
+            arcpy.SetProgressorPosition()
+
+        if rows:
+            beginProfileStage('insert')
+            for values in rows:
+                cur.insertRow(values)
+            endProfileStage('insert')
+
+        arcpy.ResetProgressor()
+        arcpy.SetProgressorLabel("")
+        del cur
+        endProfileStage('transform')
+
+        if newObjectIds:
+            for oid in newObjectIds:
+                addCLUidentifier(ingestedObjectIds,oid)
+            releaseCLUidentifiers(ingestedObjectIds,newObjectIds)
+
+        return True
+
+    except:
+        try: del cur
+        except: pass
+
+        # the CLUs of this request can be claimed again by its 2nd attempt
+        releaseCLUidentifiers(ingestedObjectIds,newObjectIds)
+        errorMsg()
+        return False
+
+## ===================================================================================
+def openCLUmirror(mirrorFile):
+    """ This function will open (and create if needed) the local CLU mirror; a sqlite
+        database holding a copy of the CLU layer, or a subset of it, with an R-tree
+        spatial index.
+
+            clu          - objectid, clu_identifier, attributes (JSON), geometry (JSON)
+            clu_rtree    - R-tree of the bounding box of every CLU keyed by objectid
+            mirror_info  - key/value pairs: lastSync, wkid, where
+
+        Returns the sqlite connection; False if error ocurred"""
+
+    try:
+        conn = sqlite3.connect(mirrorFile)
+        conn.execute("CREATE TABLE IF NOT EXISTS clu (objectid INTEGER PRIMARY KEY, clu_identifier TEXT, attributes TEXT, geometry TEXT)")
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS clu_rtree USING rtree(id, xmin, xmax, ymin, ymax)")
+        conn.execute("CREATE TABLE IF NOT EXISTS mirror_info (key TEXT PRIMARY KEY, value TEXT)")
+        return conn
+
+    except:
+        errorMsg()
+        AddMsgAndPrint("\tCould not open the CLU mirror " + mirrorFile + "; the sqlite R-tree module may not be available",2)
+        return False
+
+## ===================================================================================
+def syncCLUmirror(mirrorFile,RESTurl,metadata,where=''):
+    """ This function will bring the local CLU mirror up to date with the CLU service.
+        The first sync downloads every CLU (within the where clause i.e. a state
+        subset); later syncs are incremental:
+
+            1) The object IDs within the where clause are requested (returnIdsOnly).
+               Local CLUs whose object ID is no longer in the service are deleted and
+               object IDs missing locally are downloaded.
+            2) If the service tracks edit dates (editFieldsInfo) the object IDs of the
+               CLUs edited since the last sync, less a 10 minute margin for clock
+               differences, are downloaded again.
+
+        CLUs are downloaded by object ID in chunks of maxRecordCount and written with
+        their bounding box into the R-tree.
+
+        Returns the number of CLUs that were added, updated or deleted; False if the
+        sync failed.  The last sync time is only updated if the sync succeeded."""
+
+    try:
+        conn = openCLUmirror(mirrorFile)
+        if not conn:
+            return False
+
+        AddMsgAndPrint("\nSynchronizing CLU mirror: " + mirrorFile)
+        syncStart = time.time()
+        mirrorInfo = dict(conn.execute("SELECT key, value FROM mirror_info"))
+
+        # a different subset invalidates the mirror
+        if mirrorInfo.get('where','') != where:
+            if mirrorInfo:
+                AddMsgAndPrint("\tCLU mirror subset changed; Rebuilding the mirror",1)
+            conn.execute("DELETE FROM clu")
+            conn.execute("DELETE FROM clu_rtree")
+            conn.execute("DELETE FROM mirror_info")
+            mirrorInfo = dict()
+
+        # ------------------------------------------- ID diff against the service
+        idQuery = submitFSquery(RESTurl,urllibEncode({'f': 'json',
+                                                      'where':where or '1=1',
+                                                      'returnIdsOnly':'true',
+                                                      'token': portalToken['token']}))
+        if not idQuery:
+            AddMsgAndPrint("\tCould not request the CLU object IDs from the service",2)
+            return False
+
+        serviceIds = set(idQuery['objectIds'] or [])
+        localIds = set([row[0] for row in conn.execute("SELECT objectid FROM clu")])
+
+        deletedIds = localIds - serviceIds
+        downloadIds = serviceIds - localIds
+
+        # ------------------------------------------- CLUs edited since the last sync
+        editDateField = metadata.get('editFieldsInfo',{}).get('editDateField')
+
+        if editDateField and 'lastSync' in mirrorInfo:
+            since = time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime(float(mirrorInfo['lastSync']) - 600))
+            editWhere = editDateField + " > timestamp '" + since + "'"
+
+            editQuery = submitFSquery(RESTurl,urllibEncode({'f': 'json',
+                                                            'where':'(' + where + ') AND ' + editWhere if where else editWhere,
+                                                            'returnIdsOnly':'true',
+                                                            'token': portalToken['token']}))
+            if not editQuery:
+                AddMsgAndPrint("\tCould not request the CLUs edited since the last sync",2)
+                return False
+
+            downloadIds.update(editQuery['objectIds'] or [])
+
+        elif 'lastSync' in mirrorInfo:
+            AddMsgAndPrint("\tThe CLU service does not track edit dates; Only added and deleted CLUs are synchronized",1)
+
+        AddMsgAndPrint("\t" + splitThousands(len(downloadIds)) + " CLUs to download -- " + splitThousands(len(deletedIds)) + " CLUs to delete")
+
+        # ------------------------------------------- apply deletes
+        for oid in deletedIds:
+            conn.execute("DELETE FROM clu WHERE objectid = ?",(oid,))
+            conn.execute("DELETE FROM clu_rtree WHERE id = ?",(oid,))
+
+        # ------------------------------------------- download added and edited CLUs
+        downloadIds = sorted(downloadIds)
+        chunks = [downloadIds[j:j + maxRecordCount] for j in range(0,len(downloadIds),maxRecordCount)]
+        oidField = idQuery.get('objectIdFieldName','objectid')
+
+        arcpy.SetProgressor("step", "Downloading CLUs into the mirror", 0, len(chunks), 1)
+        for chunk in chunks:
+            geometry = submitFSquery(RESTurl,urllibEncode({'f': 'json',
+                                                          'objectIds':','.join([str(oid) for oid in chunk]),
+                                                          'returnGeometry':'true',
+                                                          'outFields':'*',
+                                                          'token': portalToken['token']}))
+            if not geometry:
+                AddMsgAndPrint("\tFailed to download " + str(len(chunk)) + " CLUs; Mirror sync stopped",2)
+                conn.commit()
+                return False
+
+            for rec in geometry['features']:
+                if not rec.get('geometry'):
+                    continue
+
+                oid = rec['attributes'][oidField]
+                xs = [coord[0] for ring in rec['geometry']['rings'] for coord in ring]
+                ys = [coord[1] for ring in rec['geometry']['rings'] for coord in ring]
+
+                conn.execute("INSERT OR REPLACE INTO clu VALUES (?,?,?,?)",
+                             (oid,rec['attributes'].get('clu_identifier'),json.dumps(rec['attributes']),json.dumps(rec['geometry'])))
+                conn.execute("DELETE FROM clu_rtree WHERE id = ?",(oid,))
+                conn.execute("INSERT INTO clu_rtree VALUES (?,?,?,?,?)",(oid,min(xs),max(xs),min(ys),max(ys)))
+
+            conn.commit()
+            arcpy.SetProgressorPosition()
+
+        arcpy.ResetProgressor()
+
+        # CLUs are stored in the spatial reference of the service
+        spatialReferences = metadata['extent']['spatialReference']
+        wkid = spatialReferences.get('latestWkid',spatialReferences.get('wkid'))
+
+        conn.executemany("INSERT OR REPLACE INTO mirror_info VALUES (?,?)",
+                         [('lastSync',str(syncStart)),('wkid',str(wkid)),('where',where)])
+        conn.commit()
+
+        AddMsgAndPrint("\tCLU mirror holds " + splitThousands(len(serviceIds)) + " CLUs")
+        conn.close()
+        return len(downloadIds) + len(deletedIds)
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def isCLUmirrorCurrent(mirrorFile,inFC,RESTurl,maxAgeHours=24):
+    """ This function will determine if an AOI can be extracted from the local CLU
+        mirror.  The mirror has to have been synchronized within maxAgeHours and has
+        to hold every CLU within the AOI:
+
+            1) A mirror of the entire CLU layer covers any AOI.
+            2) A mirror of a subset (where clause) covers the AOI only if the service
+               has as many CLUs within the AOI geometry inside the subset as it has
+               overall.  The extent of the CLUs in the mirror is not enough; an AOI
+               along a state line would be missing the CLUs of the neighboring state.
+
+        Return True if the mirror can be used; False otherwise"""
+
+    try:
+        if not mirrorFile or not os.path.exists(mirrorFile):
+            return False
+
+        conn = openCLUmirror(mirrorFile)
+        if not conn:
+            return False
+
+        mirrorInfo = dict(conn.execute("SELECT key, value FROM mirror_info"))
+        conn.close()
+
+        if not 'lastSync' in mirrorInfo:
+            return False
+
+        ageHours = (time.time() - float(mirrorInfo['lastSync'])) / 3600
+        if ageHours > maxAgeHours:
+            AddMsgAndPrint("\nCLU mirror was last synchronized " + str(round(ageHours,1)) + " hours ago; Extracting from the CLU service",1)
+            return False
+
+        if not mirrorInfo.get('where'):
+            return True
+
+        aoiGeometry = None
+        for row in arcpy.da.SearchCursor(inFC, ['SHAPE@']):
+            aoiGeometry = row[0] if aoiGeometry is None else aoiGeometry.union(row[0])
+
+        totalCount = getCountQuery(aoiGeometry.JSON,RESTurl)
+        subsetCount = getCountQuery(aoiGeometry.JSON,RESTurl,mirrorInfo['where'])
+
+        if totalCount is False or subsetCount is False:
+            AddMsgAndPrint("\nCould not verify that the CLU mirror covers the AOI; Extracting from the CLU service",1)
+            return False
+
+        if subsetCount < totalCount:
+            AddMsgAndPrint("\nAOI is not within the CLU mirror subset (" + mirrorInfo['where'] + "); Extracting from the CLU service",1)
+            return False
+
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def extractFromCLUmirror(mirrorFile,inFC,fc):
+    """ This function will extract the CLUs whose bounding box intersects the extent of
+        the AOI from the local CLU mirror using its R-tree and assemble them into the
+        CLU fc with insertCLUgeometry, the same as a response of the CLU service.  CLUs
+        outside of the AOI are removed by the final AOI filter.
+
+        Returns the number of CLUs read from the mirror; False if error ocurred"""
+
+    try:
+        conn = sqlite3.connect(mirrorFile)
+        wkid = int(conn.execute("SELECT value FROM mirror_info WHERE key = 'wkid'").fetchone()[0])
+
+        aoiGeometry = None
+        for row in arcpy.da.SearchCursor(inFC, ['SHAPE@']):
+            aoiGeometry = row[0] if aoiGeometry is None else aoiGeometry.union(row[0])
+        extent = aoiGeometry.projectAs(arcpy.SpatialReference(wkid)).extent
+
+        AddMsgAndPrint("\nExtracting CLUs from the CLU mirror: " + mirrorFile)
+
+        features = [{'attributes':json.loads(attributes),'geometry':json.loads(geometry)} for attributes,geometry in
+                    conn.execute("SELECT clu.attributes, clu.geometry FROM clu_rtree JOIN clu ON clu.objectid = clu_rtree.id "
+                                 "WHERE clu_rtree.xmax >= ? AND clu_rtree.xmin <= ? AND clu_rtree.ymax >= ? AND clu_rtree.ymin <= ?",
+                                 (extent.XMin,extent.XMax,extent.YMin,extent.YMax))]
+        conn.close()
+
+        if not insertCLUgeometry({'features':features},fc):
+            return False
+
+        return len(features)
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def buildFlatbuffer(table):
+    """ This function will serialize a FlatBuffers table into a size-prefixed byte
+        buffer.  FlatGeobuf headers and features are FlatBuffers tables; building
+        them by hand avoids depending on the flatbuffers library, which is not
+        part of the ArcGIS python install.
+
+        A table is a list of (slot, kind, value) tuples where slot is the field
+        index from the FlatGeobuf schema and kind is one of:
+        'bool','ubyte','ushort','int','uint','ulong','double','string',
+        'vecDouble','vecUint','vecUbyte','table','vecTable'
+        i.e. [(0,'string','CLU_AOI'),(2,'ubyte',6),(8,'ulong',1250)]
+
+        Objects are written front to back (vtable, table, children) and every
+        scalar is aligned relative to the start of the size prefix the same way
+        the FlatBuffers builder aligns a FinishSizePrefixed buffer.
+
+        Returns a bytearray"""
+
+    scalarFormats = {'bool':'<B','ubyte':'<B','ushort':'<H','int':'<i','uint':'<I',
+                     'ulong':'<Q','double':'<d'}
+    vectorFormats = {'vecDouble':'<d','vecUint':'<I','vecUbyte':'<B'}
+
+    buf = bytearray(8)    # size prefix + root uoffset
+
+    def pad(alignment, additional=0):
+        # pad buf so that len(buf) + additional is a multiple of alignment
+        while (len(buf) + additional) % alignment:
+            buf.append(0)
+
+    def writeTable(fields):
+        inline = list()   # (slot, kind, value, size)
+        for slot,kind,value in fields:
+            if value is None:
+                continue
+            size = struct.calcsize(scalarFormats[kind]) if kind in scalarFormats else 4
+            inline.append((slot,kind,value,size))
+
+        # largest scalars first so everything after the soffset stays aligned
+        inline.sort(key=lambda fld: -fld[3])
+
+        numOfSlots = max([fld[0] for fld in inline]) + 1 if inline else 0
+        vtableSize = 4 + (2 * numOfSlots)
+        tableSize = 4 + sum([fld[3] for fld in inline])
+
+        pad(2)
+        vtablePos = len(buf)
+        buf.extend(bytearray(vtableSize))
+
+        # table starts 4 bytes before an 8 byte boundary so 8 byte fields follow the soffset
+        pad(8,4)
+        tablePos = len(buf)
+        buf.extend(bytearray(tableSize))
+
+        struct.pack_into('<HH', buf, vtablePos, vtableSize, tableSize)
+        struct.pack_into('<i', buf, tablePos, tablePos - vtablePos)
+
+        children = list()   # (fieldPos, kind, value)
+        fieldPos = tablePos + 4
+        for slot,kind,value,size in inline:
+            struct.pack_into('<H', buf, vtablePos + 4 + (2 * slot), fieldPos - tablePos)
+            if kind in scalarFormats:
+                struct.pack_into(scalarFormats[kind], buf, fieldPos, value)
+            else:
+                children.append((fieldPos,kind,value))
+            fieldPos += size
+
+        for fieldPos,kind,value in children:
+            childPos = writeObject(kind,value)
+            struct.pack_into('<I', buf, fieldPos, childPos - fieldPos)
+
+        return tablePos
+
+    def writeObject(kind,value):
+        if kind == 'string':
+            if not isinstance(value,bytes):
+                value = value.encode('utf-8')
+            pad(4)
+            pos = len(buf)
+            buf.extend(struct.pack('<I',len(value)))
+            buf.extend(value)
+            buf.append(0)
+            return pos
+
+        elif kind in vectorFormats:
+            fmt = vectorFormats[kind]
+            pad(max(4,struct.calcsize(fmt)),4)
+            pos = len(buf)
+            buf.extend(struct.pack('<I',len(value)))
+            if kind == 'vecUbyte':
+                buf.extend(value)
+            else:
+                buf.extend(struct.pack('<' + str(len(value)) + fmt[1], *value))
+            return pos
+
+        elif kind == 'table':
+            return writeTable(value)
+
+        elif kind == 'vecTable':
+            pad(4)
+            pos = len(buf)
+            buf.extend(struct.pack('<I',len(value)))
+            offsetPositions = list()
+            for item in value:
+                offsetPositions.append(len(buf))
+                buf.extend(bytearray(4))
+            for offsetPos,item in zip(offsetPositions,value):
+                struct.pack_into('<I', buf, offsetPos, writeTable(item) - offsetPos)
+            return pos
+
+    rootPos = writeTable(table)
+    struct.pack_into('<I', buf, 4, rootPos - 4)
+    pad(8)
+    struct.pack_into('<I', buf, 0, len(buf) - 4)
+    return buf
+
+## ===================================================================================
+def hilbertValue(x,y):
+    """ This function will return the position of a cell along a hilbert curve within
+        a 65,535 x 65,535 grid.  This is the same hilbert function FlatGeobuf uses to
+        sort features for its packed R-tree."""
+
+    a = x ^ y
+    b = 0xFFFF ^ a
+    c = 0xFFFF ^ (x | y)
+    d = x & (y ^ 0xFFFF)
+
+    A = a | (b >> 1)
+    B = (a >> 1) ^ a
+    C = ((c >> 1) ^ (b & (d >> 1))) ^ c
+    D = ((a & (c >> 1)) ^ (d >> 1)) ^ d
+
+    a = A; b = B; c = C; d = D
+    A = ((a & (a >> 2)) ^ (b & (b >> 2)))
+    B = ((a & (b >> 2)) ^ (b & ((a ^ b) >> 2)))
+    C ^= ((a & (c >> 2)) ^ (b & (d >> 2)))
+    D ^= ((b & (c >> 2)) ^ ((a ^ b) & (d >> 2)))
+
+    a = A; b = B; c = C; d = D
+    A = ((a & (a >> 4)) ^ (b & (b >> 4)))
+    B = ((a & (b >> 4)) ^ (b & ((a ^ b) >> 4)))
+    C ^= ((a & (c >> 4)) ^ (b & (d >> 4)))
+    D ^= ((b & (c >> 4)) ^ ((a ^ b) & (d >> 4)))
+
+    a = A; b = B; c = C; d = D
+    C ^= ((a & (c >> 8)) ^ (b & (d >> 8)))
+    D ^= ((b & (c >> 8)) ^ ((a ^ b) & (d >> 8)))
+
+    a = C ^ (C >> 1)
+    b = D ^ (D >> 1)
+
+    i0 = x ^ y
+    i1 = b | (0xFFFF ^ (i0 | a))
+
+    i0 = (i0 | (i0 << 8)) & 0x00FF00FF
+    i0 = (i0 | (i0 << 4)) & 0x0F0F0F0F
+    i0 = (i0 | (i0 << 2)) & 0x33333333
+    i0 = (i0 | (i0 << 1)) & 0x55555555
+
+    i1 = (i1 | (i1 << 8)) & 0x00FF00FF
+    i1 = (i1 | (i1 << 4)) & 0x0F0F0F0F
+    i1 = (i1 | (i1 << 2)) & 0x33333333
+    i1 = (i1 | (i1 << 1)) & 0x55555555
+
+    return ((i1 << 1) | i0) & 0xFFFFFFFF
+
+## ===================================================================================
+def getAOIfilter(inFC,spatialRef):
+    """ This function will return the AOI geometry used to filter the CLUs that are
+        streamed to the FlatGeobuf and GeoParquet outputs.  Request geometries are
+        envelopes or buffered pieces of the AOI so the responses include CLUs outside
+        of the AOI; the streamed outputs are written before the final AOI filter.
+
+        spatialRef - spatial reference of the CLU fc (same as the WFS)
+
+        Returns a dictionary; False if error
+        {'geometry': <Polygon>, 'bounds': (xmin,ymin,xmax,ymax), 'spatialReference': {'wkid': 3857}}"""
+
+    try:
+        aoiGeometry = None
+        for row in arcpy.da.SearchCursor(inFC, ['SHAPE@']):
+            aoiGeometry = row[0] if aoiGeometry is None else aoiGeometry.union(row[0])
+
+        aoiGeometry = aoiGeometry.projectAs(spatialRef)
+        extent = aoiGeometry.extent
+
+        return {'geometry':aoiGeometry,
+                'bounds':(extent.XMin,extent.YMin,extent.XMax,extent.YMax),
+                'spatialReference':json.loads(aoiGeometry.JSON)['spatialReference']}
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def isCLUwithinAOI(aoiFilter,esriGeometry):
+    """ This function will determine if a CLU returned by the feature service intersects
+        the AOI.  The bounding box of the CLU is compared first so that only CLUs
+        near the AOI boundary are compared geometrically.
+
+        Returns True if the CLU intersects the AOI or if there is no AOI filter"""
+
+    if not aoiFilter or not esriGeometry or not esriGeometry.get('rings'):
+        return True
+
+    xs = [coord[0] for ring in esriGeometry['rings'] for coord in ring]
+    ys = [coord[1] for ring in esriGeometry['rings'] for coord in ring]
+    bounds = aoiFilter['bounds']
+
+    if max(xs) < bounds[0] or min(xs) > bounds[2] or max(ys) < bounds[1] or min(ys) > bounds[3]:
+        return False
+
+    cluGeometry = arcpy.AsShape(dict(esriGeometry,spatialReference=aoiFilter['spatialReference']),True)
+    return not cluGeometry.disjoint(aoiFilter['geometry'])
+
+## ===================================================================================
+def openFlatGeobuf(fgbPath,fieldDict,metadata,bSpatialIndex=True):
+    """ This function will open a FlatGeobuf (.fgb) output that CLU features will be
+        streamed into as they are downloaded.  Features are serialized into a spool
+        file next to the output and only their bounding box, offset and size are kept
+        in memory.  The packed Hilbert R-tree and the header are written once the
+        feature count is known by closeFlatGeobuf().
+
+        If bSpatialIndex is False (streaming mode) nothing is kept per feature; only
+        the feature count and full extent are tracked and the .fgb is written without
+        a spatial index, in download order.
+
+        fieldDict ={field:(fieldType,fieldLength,alias)} as returned by createOutputFC
+        i.e {'clu_identifier': ('TEXT', 36, 'clu_identifier'),'calcacres': ('DOUBLE', '', 'calcacres')}
+
+        Returns a dictionary describing the open writer.  Return False if error ocurred."""
+
+    try:
+        # cross-reference ArcGIS attribute description with FlatGeobuf column types
+        # Byte=0,UByte=1,Bool=2,Short=3,UShort=4,Int=5,UInt=6,Long=7,ULong=8,
+        # Float=9,Double=10,String=11,Json=12,DateTime=13,Binary=14
+        fgbTypeDict = {'TEXT':11,'DOUBLE':10,'FLOAT':9,'LONG':5,'SHORT':3,'DATE':13,'GUID':11}
+
+        columns = list()
+        for fldName,params in fieldDict.items():
+            fldType = params[0]
+            fldLength = params[1] if fldType == 'TEXT' and params[1] else -1
+            columns.append((fldName,fldType,fgbTypeDict[fldType],fldLength))
+
+        spatialReferences = metadata['extent']['spatialReference']
+        if 'latestWkid' in spatialReferences:
+            wkid = spatialReferences['latestWkid']
+        else:
+            wkid = spatialReferences['wkid']
+
+        AddMsgAndPrint("\nStreaming CLUs to FlatGeobuf: " + fgbPath)
+
+        return {'path':fgbPath,
+                'spool':open(fgbPath + ".spool",'w+b'),
+                'columns':columns,
+                'wkid':wkid,
+                'count':0,
+                'extent':None,    # [minX,minY,maxX,maxY] of all features
+                'items':list() if bSpatialIndex else None}   # [minX,minY,maxX,maxY,spoolOffset,size] per feature
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def getPolygonsFromRings(rings):
+    """ This function will group the rings of an ESRI polygon into polygons by ring
+        orientation; clockwise rings are exterior rings and counter-clockwise rings
+        are holes of the preceding exterior ring.
+
+        Returns a list of polygons; each polygon is a list of rings"""
+
+    polygons = list()
+    for ring in rings:
+        signedArea = 0.0
+        for j in range(len(ring) - 1):
+            signedArea += (ring[j][0] * ring[j+1][1]) - (ring[j+1][0] * ring[j][1])
+
+        # clockwise ring (or a hole with no exterior); start a new polygon
+        if signedArea <= 0 or not polygons:
+            polygons.append(list())
+        polygons[-1].append(ring)
+
+    return polygons
+
+## ===================================================================================
+def getWKBfromRings(rings):
+    """ This function will convert the rings of an ESRI polygon into a little endian
+        WKB MultiPolygon (getPolygonsFromRings) and compute its bounding box.
+
+        Returns a tuple of (WKB bytes, [minX,minY,maxX,maxY])"""
+
+    polygons = getPolygonsFromRings(rings)
+    minX = minY = float('inf')
+    maxX = maxY = float('-inf')
+
+    # WKB MultiPolygon (little endian) = 6; Polygon = 3
+    wkb = bytearray(struct.pack('<BII',1,6,len(polygons)))
+    for polygonRings in polygons:
+        wkb.extend(struct.pack('<BII',1,3,len(polygonRings)))
+        for ring in polygonRings:
+            wkb.extend(struct.pack('<I',len(ring)))
+            for coord in ring:
+                x = coord[0]; y = coord[1]
+                wkb.extend(struct.pack('<dd',x,y))
+                if x < minX: minX = x
+                if x > maxX: maxX = x
+                if y < minY: minY = y
+                if y > maxY: maxY = y
+
+    return bytes(wkb),[minX,minY,maxX,maxY]
+
+## ===================================================================================
+def writeFlatGeobufFeature(fgbWriter,attributes,esriGeometry):
+    """ This function will convert a single CLU returned by the feature service into a
+        FlatGeobuf feature and append it to the writer spool.  ESRI polygon rings are
+        grouped into polygons by ring orientation (getPolygonsFromRings).  All CLUs
+        are written as MultiPolygons.
+
+        attributes - u'attributes': {u'clu_identifier': u'73F53BC1-E3F8-4747-B51F-E598EE445E47'}
+        esriGeometry - u'geometry': {u'rings': [[[-89.4077, 43.3340], [-89.4076, 43.3356]]]}
+
+        Return True if feature was written; False otherwise"""
+
+    try:
+        polygons = getPolygonsFromRings(esriGeometry['rings'])
+        minX = minY = float('inf')
+        maxX = maxY = float('-inf')
+
+        parts = list()
+        for rings in polygons:
+            xy = list()
+            ends = list()
+            for ring in rings:
+                for coord in ring:
+                    x = coord[0]; y = coord[1]
+                    xy.extend((x,y))
+                    if x < minX: minX = x
+                    if x > maxX: maxX = x
+                    if y < minY: minY = y
+                    if y > maxY: maxY = y
+                ends.append(len(xy) // 2)
+
+            # Geometry: ends(0), xy(1), type(6) - Polygon = 3
+            parts.append([(0,'vecUint',ends if len(ends) > 1 else None),
+                          (1,'vecDouble',xy),
+                          (6,'ubyte',3)])
+
+        # Encode properties as (ushort column index, value) pairs; NULLs are omitted
+        properties = bytearray()
+        for i,column in enumerate(fgbWriter['columns']):
+            fldName,fldType,fgbType,fldLength = column
+            value = attributes.get(fldName)
+
+            if value in (None,'null','Null') or (value == '' and fldType != 'TEXT'):
+                continue
+
+            properties.extend(struct.pack('<H',i))
+
+            if fgbType in (11,13):
+                if fldType == 'DATE':
+                    value = time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime(float(value)/1000))
+                if not isinstance(value,bytes):
+                    value = value.encode('utf-8')
+                properties.extend(struct.pack('<I',len(value)))
+                properties.extend(value)
+            elif fgbType == 10:
+                properties.extend(struct.pack('<d',float(value)))
+            elif fgbType == 9:
+                properties.extend(struct.pack('<f',float(value)))
+            elif fgbType == 5:
+                properties.extend(struct.pack('<i',int(value)))
+            elif fgbType == 3:
+                properties.extend(struct.pack('<h',int(value)))
+
+        # Feature: geometry(0), properties(1); Geometry: type(6) - MultiPolygon = 6, parts(7)
+        featureBuffer = buildFlatbuffer([(0,'table',[(6,'ubyte',6),(7,'vecTable',parts)]),
+                                         (1,'vecUbyte',properties)])
+
+        spool = fgbWriter['spool']
+        if fgbWriter['items'] is not None:
+            fgbWriter['items'].append([minX,minY,maxX,maxY,spool.tell(),len(featureBuffer)])
+
+        extent = fgbWriter['extent']
+        if extent is None:
+            fgbWriter['extent'] = [minX,minY,maxX,maxY]
+        else:
+            fgbWriter['extent'] = [min(extent[0],minX),min(extent[1],minY),max(extent[2],maxX),max(extent[3],maxY)]
+
+        fgbWriter['count'] += 1
+        spool.write(featureBuffer)
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def closeFlatGeobuf(fgbWriter,nodeSize=16):
+    """ This function will finalize a FlatGeobuf output opened by openFlatGeobuf().
+        Features in the spool are sorted along a hilbert curve, a packed hilbert
+        R-tree is built from their bounding boxes and the magic bytes, header, index
+        and features are written to the .fgb file in that order.  The index lets
+        readers (GDAL, QGIS, flatgeobuf.js over HTTP range requests) do bbox lookups
+        without scanning the whole file.  Writers opened without a spatial index
+        are copied from the spool in the order the features were downloaded.
+
+        Return True if the .fgb was written; False otherwise"""
+
+    try:
+        items = fgbWriter['items']
+        spool = fgbWriter['spool']
+        fgbPath = fgbWriter['path']
+        numOfItems = fgbWriter['count']
+        extent = fgbWriter['extent']
+
+        if items is None:
+            items = list()
+            nodeSize = 0
+        else:
+            AddMsgAndPrint("\nBuilding FlatGeobuf spatial index for " + splitThousands(numOfItems) + " CLUs")
+            arcpy.SetProgressorLabel("Building FlatGeobuf spatial index")
+
+        # sort features by the hilbert value of their bbox center
+        if items:
+            width = (extent[2] - extent[0]) or 1.0
+            height = (extent[3] - extent[1]) or 1.0
+            hilbertMax = (1 << 16) - 1
+
+            def hilbertKey(item):
+                x = int(math.floor(hilbertMax * (((item[0] + item[2]) / 2.0) - extent[0]) / width))
+                y = int(math.floor(hilbertMax * (((item[1] + item[3]) / 2.0) - extent[1]) / height))
+                return hilbertValue(x,y)
+
+            items.sort(key=hilbertKey,reverse=True)
+
+        # ------------------------------------------- Packed Hilbert R-tree
+        # Level 0 contains the leaves which are stored at the end of the node array
+        index = bytearray()
+        if numOfItems and nodeSize:
+            n = numOfItems
+            numOfNodes = n
+            levelNumNodes = [n]
+            while True:
+                n = int(math.ceil(float(n) / nodeSize))
+                numOfNodes += n
+                levelNumNodes.append(n)
+                if n == 1:
+                    break
+
+            levelBounds = list()
+            n = numOfNodes
+            for size in levelNumNodes:
+                levelBounds.append((n - size,n))
+                n -= size
+
+            nodes = [None] * numOfNodes
+
+            # leaf nodes point to the byte offset of the feature within the feature section
+            featureOffset = 0
+            for i,item in enumerate(items):
+                nodes[levelBounds[0][0] + i] = (item[0],item[1],item[2],item[3],featureOffset)
+                featureOffset += item[5]
+
+            # parent nodes point to the position of their first child node
+            for i in range(len(levelBounds) - 1):
+                pos,end = levelBounds[i]
+                newPos = levelBounds[i + 1][0]
+                while pos < end:
+                    firstChild = pos
+                    children = nodes[pos:min(pos + nodeSize,end)]
+                    pos += len(children)
+                    nodes[newPos] = (min([c[0] for c in children]),min([c[1] for c in children]),
+                                     max([c[2] for c in children]),max([c[3] for c in children]),firstChild)
+                    newPos += 1
+
+            for node in nodes:
+                index.extend(struct.pack('<ddddQ',*node))
+
+        # ------------------------------------------- Header
+        columns = list()
+        for fldName,fldType,fgbType,fldLength in fgbWriter['columns']:
+            # Column: name(0), type(1), width(4)
+            columns.append([(0,'string',fldName),(1,'ubyte',fgbType),
+                            (4,'int',fldLength if fldLength != -1 else None)])
+
+        # Header: name(0), envelope(1), geometry_type(2), columns(7), features_count(8),
+        #         index_node_size(9), crs(10); Crs: org(0), code(1)
+        header = buildFlatbuffer([(0,'string',os.path.splitext(os.path.basename(fgbPath))[0]),
+                                  (1,'vecDouble',extent),
+                                  (2,'ubyte',6),
+                                  (7,'vecTable',columns),
+                                  (8,'ulong',numOfItems),
+                                  (9,'ushort',nodeSize if numOfItems else 0),
+                                  (10,'table',[(0,'string','EPSG'),(1,'int',fgbWriter['wkid'])])])
+
+        with open(fgbPath,'wb') as fgb:
+            fgb.write(bytearray([0x66,0x67,0x62,0x03,0x66,0x67,0x62,0x00]))   # 'fgb' v3
+            fgb.write(header)
+            fgb.write(index)
+
+            if nodeSize:
+                for item in items:
+                    spool.seek(item[4])
+                    fgb.write(spool.read(item[5]))
+            else:
+                spool.seek(0)
+                shutil.copyfileobj(spool,fgb)
+
+        spool.close()
+        os.remove(spool.name)
+
+        AddMsgAndPrint("\tFlatGeobuf written to: " + fgbPath)
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def getQuadkey(lon,lat,level):
+    """ This function will return the Bing Maps quadkey of the web mercator tile at
+        the given level that contains a longitude/latitude.
+        i.e. getQuadkey(-89.40,43.33,8) --> '03022102'"""
+
+    lat = max(-85.05112878,min(85.05112878,lat))
+    sinLat = math.sin(lat * math.pi / 180)
+    numOfTiles = 1 << level
+
+    tileX = int(((lon + 180) / 360.0) * numOfTiles)
+    tileY = int((0.5 - math.log((1 + sinLat) / (1 - sinLat)) / (4 * math.pi)) * numOfTiles)
+    tileX = max(0,min(numOfTiles - 1,tileX))
+    tileY = max(0,min(numOfTiles - 1,tileY))
+
+    quadkey = ""
+    for i in range(level,0,-1):
+        mask = 1 << (i - 1)
+        digit = 0
+        if tileX & mask:
+            digit += 1
+        if tileY & mask:
+            digit += 2
+        quadkey += str(digit)
+
+    return quadkey
+
+## ===================================================================================
+def openGeoParquet(parquetFolder,fieldDict,metadata,partitionKey='quadkey',quadkeyLevel=8,rowGroupSize=4096):
+    """ This function will open a GeoParquet dataset that CLU features will be streamed
+        into as they are downloaded.  The dataset is a folder of parquet files
+        partitioned hive-style by a spatial key so that parallel consumers only read
+        the partitions they need:
+
+            partitionKey = 'quadkey' --> CLU_AOI_parquet\\quadkey=03022102\\part-0.parquet
+            partitionKey = ['state_ansi_code','county_ansi_code']
+                    --> CLU_AOI_parquet\\state_ansi_code=19\\county_ansi_code=153\\part-0.parquet
+
+        Geometry is stored as WKB in the 'geometry' column and the bounding box of
+        every CLU in the 'bbox' struct column (GeoParquet 1.1 covering) so that readers
+        can skip row groups by their bbox statistics.  Partition fields are encoded in
+        the folder names and not repeated within the files; readers should declare
+        them as strings b/c quadkeys and ANSI codes have leading zeros.  pyarrow is
+        needed; it is part of the ArcGIS Pro python install but not of ArcMap.
+
+        Partitions are written to a temporary folder next to the dataset that replaces
+        the dataset in closeGeoParquet; partitions of a previous run (i.e. a different
+        AOI extent) would otherwise be read along with the new ones.
+
+        fieldDict ={field:(fieldType,fieldLength,alias)} as returned by createOutputFC
+
+        Returns a dictionary describing the open writer.  Return False if error ocurred."""
+
+    try:
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            AddMsgAndPrint("\npyarrow is not available; GeoParquet output will not be written",1)
+            return False
+
+        if partitionKey != 'quadkey':
+            missingFields = [fld for fld in partitionKey if not fld in fieldDict]
+            if missingFields:
+                AddMsgAndPrint("\nGeoParquet partition field(s) are not in the output: " + ", ".join(missingFields) + "; Partitioning by quadkey",1)
+                partitionKey = 'quadkey'
+
+        # cross-reference ArcGIS attribute description with arrow types
+        arrowTypeDict = {'TEXT':pyarrow.string(),'GUID':pyarrow.string(),'DOUBLE':pyarrow.float64(),
+                         'FLOAT':pyarrow.float32(),'LONG':pyarrow.int32(),'SHORT':pyarrow.int16(),
+                         'DATE':pyarrow.timestamp('ms',tz='UTC')}
+
+        columns = list()
+        for fldName,params in fieldDict.items():
+            if partitionKey != 'quadkey' and fldName in partitionKey:
+                continue
+            columns.append((fldName,params[0]))
+
+        bboxType = pyarrow.struct([('xmin',pyarrow.float64()),('ymin',pyarrow.float64()),
+                                   ('xmax',pyarrow.float64()),('ymax',pyarrow.float64())])
+
+        schemaFields = [pyarrow.field(fldName,arrowTypeDict[fldType]) for fldName,fldType in columns]
+        schemaFields.append(pyarrow.field('bbox',bboxType))
+        schemaFields.append(pyarrow.field('geometry',pyarrow.binary()))
+
+        spatialReferences = metadata['extent']['spatialReference']
+        if 'latestWkid' in spatialReferences:
+            wkid = spatialReferences['latestWkid']
+        else:
+            wkid = spatialReferences['wkid']
+
+        # PROJJSON is preferred; fall back to the EPSG identifier if pyproj is missing
+        try:
+            import pyproj
+            crs = pyproj.CRS.from_epsg(wkid).to_json_dict()
+        except:
+            crs = {'id':{'authority':'EPSG','code':wkid}}
+
+        geoMetadata = {'version':'1.1.0',
+                       'primary_column':'geometry',
+                       'columns':{'geometry':{'encoding':'WKB',
+                                              'geometry_types':['MultiPolygon'],
+                                              'crs':crs,
+                                              'covering':{'bbox':{'xmin':['bbox','xmin'],'ymin':['bbox','ymin'],
+                                                                  'xmax':['bbox','xmax'],'ymax':['bbox','ymax']}}}}}
+
+        schema = pyarrow.schema(schemaFields).with_metadata({'geo':json.dumps(geoMetadata)})
+
+        # Quadkeys are computed from longitude/latitude; other coordinate systems are projected
+        if wkid in (3857,102100,102113,900913):
+            toLonLat = 'mercator'
+        elif arcpy.SpatialReference(wkid).type == 'Geographic':
+            toLonLat = 'geographic'
+        else:
+            toLonLat = arcpy.SpatialReference(wkid)
+
+        tempFolder = parquetFolder + "_temp"
+        if os.path.exists(tempFolder):
+            shutil.rmtree(tempFolder)
+        os.makedirs(tempFolder)
+
+        AddMsgAndPrint("\nStreaming CLUs to GeoParquet: " + parquetFolder)
+
+        return {'folder':tempFolder,   # partitions are written here until closeGeoParquet
+                'path':parquetFolder,
+                'pyarrow':pyarrow,
+                'parquet':pyarrow.parquet,
+                'schema':schema,
+                'columns':columns,
+                'partitionKey':partitionKey,
+                'quadkeyLevel':quadkeyLevel,
+                'rowGroupSize':rowGroupSize,
+                'toLonLat':toLonLat,
+                'partitions':dict(),   # {partition folder: {'rows':[], 'writer':ParquetWriter}}
+                'count':0}
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def writeGeoParquetFeature(parquetWriter,attributes,esriGeometry):
+    """ This function will convert a single CLU returned by the feature service into a
+        GeoParquet row (attributes, bbox and WKB MultiPolygon) and add it to the buffer
+        of its partition.  A partition is flushed once it holds 4 row groups worth of
+        CLUs.
+
+        attributes - u'attributes': {u'clu_identifier': u'73F53BC1-E3F8-4747-B51F-E598EE445E47'}
+        esriGeometry - u'geometry': {u'rings': [[[-89.4077, 43.3340], [-89.4076, 43.3356]]]}
+
+        Return True if feature was written; False otherwise"""
+
+    try:
+        wkb,bbox = getWKBfromRings(esriGeometry['rings'])
+        minX,minY,maxX,maxY = bbox
+
+        # Hive-style partition folder
+        if parquetWriter['partitionKey'] == 'quadkey':
+            centerX = (minX + maxX) / 2.0
+            centerY = (minY + maxY) / 2.0
+            toLonLat = parquetWriter['toLonLat']
+
+            if toLonLat == 'mercator':
+                lon = centerX / 6378137.0 * 180 / math.pi
+                lat = (2 * math.atan(math.exp(centerY / 6378137.0)) - math.pi / 2) * 180 / math.pi
+            elif toLonLat == 'geographic':
+                lon,lat = centerX,centerY
+            else:
+                point = arcpy.PointGeometry(arcpy.Point(centerX,centerY),toLonLat).projectAs(arcpy.SpatialReference(4326)).firstPoint
+                lon,lat = point.X,point.Y
+
+            partition = "quadkey=" + getQuadkey(lon,lat,parquetWriter['quadkeyLevel'])
+        else:
+            partition = os.sep.join([fld + "=" + str(attributes.get(fld)) for fld in parquetWriter['partitionKey']])
+
+        row = list()
+        for fldName,fldType in parquetWriter['columns']:
+            value = attributes.get(fldName)
+
+            if value in ('null','Null') or (value == '' and fldType != 'TEXT'):
+                value = None
+            elif value is not None and fldType == 'DATE':
+                value = int(float(value))     # Unix Epoch ms
+            row.append(value)
+
+        row.append({'xmin':minX,'ymin':minY,'xmax':maxX,'ymax':maxY})
+        row.append(wkb)
+
+        if not partition in parquetWriter['partitions']:
+            parquetWriter['partitions'][partition] = {'rows':list(),'writer':None}
+
+        partitionRows = parquetWriter['partitions'][partition]['rows']
+        partitionRows.append(row)
+        parquetWriter['count'] += 1
+
+        if len(partitionRows) >= parquetWriter['rowGroupSize'] * 4:
+            flushGeoParquetPartition(parquetWriter,partition)
+
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def flushGeoParquetPartition(parquetWriter,partition):
+    """ This function will write the buffered rows of a partition to its parquet file.
+        Rows are ordered along a hilbert curve by the center of their bbox before
+        they are cut into row groups so that every row group covers a compact area
+        and has tight bbox statistics for predicate pushdown."""
+
+    partitionInfo = parquetWriter['partitions'][partition]
+    rows = partitionInfo['rows']
+
+    if not rows:
+        return
+
+    bboxIndex = len(parquetWriter['columns'])
+    xmin = min([row[bboxIndex]['xmin'] for row in rows]); xmax = max([row[bboxIndex]['xmax'] for row in rows])
+    ymin = min([row[bboxIndex]['ymin'] for row in rows]); ymax = max([row[bboxIndex]['ymax'] for row in rows])
+    width = (xmax - xmin) or 1.0
+    height = (ymax - ymin) or 1.0
+    hilbertMax = (1 << 16) - 1
+
+    def hilbertKey(row):
+        bbox = row[bboxIndex]
+        x = int(hilbertMax * (((bbox['xmin'] + bbox['xmax']) / 2.0) - xmin) / width)
+        y = int(hilbertMax * (((bbox['ymin'] + bbox['ymax']) / 2.0) - ymin) / height)
+        return hilbertValue(x,y)
+
+    rows.sort(key=hilbertKey)
+
+    schema = parquetWriter['schema']
+    table = parquetWriter['pyarrow'].Table.from_arrays([parquetWriter['pyarrow'].array([row[i] for row in rows],type=schema.field(i).type)
+                                                        for i in range(len(schema))],schema=schema)
+
+    if not partitionInfo['writer']:
+        partitionFolder = parquetWriter['folder'] + os.sep + partition
+        if not os.path.exists(partitionFolder):
+            os.makedirs(partitionFolder)
+        partitionInfo['writer'] = parquetWriter['parquet'].ParquetWriter(partitionFolder + os.sep + "part-0.parquet",schema,
+                                                                         compression='zstd',write_statistics=True)
+
+    partitionInfo['writer'].write_table(table,row_group_size=parquetWriter['rowGroupSize'])
+    partitionInfo['rows'] = list()
+
+## ===================================================================================
+def closeGeoParquet(parquetWriter):
+    """ This function will flush the remaining rows of every partition, close the
+        parquet files and replace the dataset (and every partition of a previous run)
+        with the partitions of this run.
+
+        Return True if the GeoParquet dataset was written; False otherwise"""
+
+    try:
+        arcpy.SetProgressorLabel("Writing GeoParquet partitions")
+
+        for partition in parquetWriter['partitions']:
+            flushGeoParquetPartition(parquetWriter,partition)
+            parquetWriter['partitions'][partition]['writer'].close()
+
+        if os.path.exists(parquetWriter['path']):
+            shutil.rmtree(parquetWriter['path'])
+        os.rename(parquetWriter['folder'],parquetWriter['path'])
+
+        AddMsgAndPrint("\n" + splitThousands(parquetWriter['count']) + " CLUs written to " + str(len(parquetWriter['partitions'])) +
+                       " GeoParquet partitions in: " + parquetWriter['path'])
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def openColumnSpool(spoolFolder,fieldDict,fieldList,bGeometry,batchSize=10000):
+    """ This function will open a columnar spool that CLUs are appended to while they
+        are downloaded instead of being inserted one at a time.  Every field is
+        stored in its own append-only files within spoolFolder:
+
+            fixed width fields (DOUBLE, FLOAT, LONG, SHORT, DATE as Unix Epoch ms)
+                <field>.data - native binary values read back as numpy memmaps
+            TEXT and GUID fields and the WKB geometry (__wkb__)
+                <field>.data - blob of utf-8 values / WKB
+                <field>.len  - uint32 length of every value
+            every field
+                <field>.null - uint8 null flag of every value
+
+        Rows are buffered in memory and written every batchSize rows.  The spool is
+        loaded into the output by bulkLoadColumnSpool and can be read again with
+        iterColumnSpool to write other formats without downloading again.
+
+        fieldList - output fields in cursor order without SHAPE@JSON
+
+        Returns a dictionary describing the open spool.  Return False if error ocurred."""
+
+    try:
+        # array typecodes of fixed width fields; 's' = variable length
+        kindDict = {'DOUBLE':'d','FLOAT':'f','LONG':'i','SHORT':'h','DATE':'d','TEXT':'s','GUID':'s'}
+
+        columns = [(fld,kindDict[fieldDict[fld][0]],fieldDict[fld][0]) for fld in fieldList]
+        if bGeometry:
+            columns.append(('__wkb__','s','WKB'))
+
+        if not os.path.exists(spoolFolder):
+            os.makedirs(spoolFolder)
+
+        for spoolFile in os.listdir(spoolFolder):
+            os.remove(os.path.join(spoolFolder,spoolFile))
+
+        spool = {'folder':spoolFolder,
+                 'columns':columns,
+                 'batchSize':batchSize,
+                 'rows':0,
+                 'buffered':0,
+                 'data':dict(),
+                 'lengths':dict(),
+                 'nulls':dict()}
+
+        for name,kind,fldType in columns:
+            spool['data'][name] = bytearray() if kind == 's' else array.array(kind)
+            spool['lengths'][name] = array.array('I')
+            spool['nulls'][name] = bytearray()
+
+        AddMsgAndPrint("\nSpooling CLUs to: " + spoolFolder)
+        return spool
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def appendColumnSpoolRow(spool,attributes,esriGeometry=None):
+    """ This function will append a single CLU returned by the feature service to the
+        column buffers of the spool and flush them every batchSize rows.
+
+        attributes - u'attributes': {u'clu_identifier': u'73F53BC1-E3F8-4747-B51F-E598EE445E47'}
+        esriGeometry - u'geometry': {u'rings': [[[-89.4077, 43.3340], [-89.4076, 43.3356]]]}"""
+
+    for name,kind,fldType in spool['columns']:
+        if name == '__wkb__':
+            value = getWKBfromRings(esriGeometry['rings'])[0] if esriGeometry else None
+        else:
+            value = attributes.get(name)
+
+            if value in ('null','Null') or (value == '' and kind != 's'):
+                value = None
+
+        if value is None:
+            spool['nulls'][name].append(1)
+            if kind == 's':
+                spool['lengths'][name].append(0)
+            else:
+                spool['data'][name].append(0)
+            continue
+
+        spool['nulls'][name].append(0)
+
+        if kind == 's':
+            if not isinstance(value,(bytes,bytearray)):
+                if not isinstance(value,type(u'')):
+                    value = str(value)
+                value = value.encode('utf-8')
+            spool['data'][name].extend(value)
+            spool['lengths'][name].append(len(value))
+        elif kind in ('d','f'):
+            spool['data'][name].append(float(value))
+        else:
+            spool['data'][name].append(int(value))
+
+    spool['rows'] += 1
+    spool['buffered'] += 1
+
+    if spool['buffered'] >= spool['batchSize']:
+        flushColumnSpool(spool)
+
+## ===================================================================================
+def flushColumnSpool(spool):
+    """ This function will append the buffered rows of every column to its files."""
+
+    folder = spool['folder']
+    for name,kind,fldType in spool['columns']:
+        with open(os.path.join(folder,name + ".data"),'ab') as f:
+            if kind == 's':
+                f.write(spool['data'][name])
+            else:
+                spool['data'][name].tofile(f)
+
+        if kind == 's':
+            with open(os.path.join(folder,name + ".len"),'ab') as f:
+                spool['lengths'][name].tofile(f)
+
+        with open(os.path.join(folder,name + ".null"),'ab') as f:
+            f.write(spool['nulls'][name])
+
+        spool['data'][name] = bytearray() if kind == 's' else array.array(kind)
+        spool['lengths'][name] = array.array('I')
+        spool['nulls'][name] = bytearray()
+
+    spool['buffered'] = 0
+
+## ===================================================================================
+def closeColumnSpool(spool):
+    """ This function will flush the remaining rows and write the spool manifest
+        (columns and row count) used by iterColumnSpool.
+
+        Return True if the spool was closed; False otherwise"""
+
+    try:
+        flushColumnSpool(spool)
+
+        with open(os.path.join(spool['folder'],"manifest.json"),'w') as f:
+            json.dump({'columns':spool['columns'],'rows':spool['rows']},f)
+
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def iterColumnSpool(spoolFolder):
+    """ This function is a generator of the rows of a closed column spool.  Columns
+        are memory mapped with numpy so the spool is never read into memory at once.
+        DATE values are returned as Unix Epoch ms and the geometry as WKB.
+
+        Yields a list of values in column order; None for NULL values"""
+
+    import numpy
+
+    with open(os.path.join(spoolFolder,"manifest.json"),'r') as f:
+        manifest = json.load(f)
+
+    numOfRows = manifest['rows']
+    if not numOfRows:
+        return
+
+    columns = list()
+    for name,kind,fldType in manifest['columns']:
+        dataFile = os.path.join(spoolFolder,name + ".data")
+        nulls = numpy.memmap(os.path.join(spoolFolder,name + ".null"),dtype=numpy.uint8,mode='r')
+
+        if kind == 's':
+            lengths = numpy.fromfile(os.path.join(spoolFolder,name + ".len"),dtype=numpy.uint32).astype(numpy.int64)
+            offsets = numpy.concatenate(([0],numpy.cumsum(lengths)))
+            # every value is NULL or '' (i.e. an empty GUID field); numpy can not map an empty file
+            if offsets[-1]:
+                blob = numpy.memmap(dataFile,dtype=numpy.uint8,mode='r')
+            else:
+                blob = numpy.zeros(0,dtype=numpy.uint8)
+            columns.append((kind,fldType,nulls,blob,offsets))
+        else:
+            columns.append((kind,fldType,nulls,numpy.memmap(dataFile,dtype=numpy.dtype(kind),mode='r'),None))
+
+    for i in range(numOfRows):
+        row = list()
+        for kind,fldType,nulls,data,offsets in columns:
+            if nulls[i]:
+                row.append(None)
+            elif kind == 's':
+                value = data[offsets[i]:offsets[i + 1]].tobytes()
+                row.append(value if fldType == 'WKB' else value.decode('utf-8'))
+            else:
+                row.append(data[i].item())
+        yield row
+
+## ===================================================================================
+def bulkLoadColumnSpool(spoolFolder,outputFC):
+    """ This function will load a closed column spool into the output feature class
+        (or table) through a single InsertCursor.  arcpy.da.NumPyArrayToFeatureClass
+        only creates point features so polygons are inserted with the cursor using the
+        SHAPE@WKB token.  DATE values are converted the same way as in
+        getCLUgeometryByExtent.
+
+        Rows are still inserted one at a time; the gain over inserting while
+        downloading is that the cursor is opened once and the inserts no longer
+        interleave with the requests, not a faster insert.
+
+        Return True if the spool was loaded; False otherwise"""
+
+    try:
+        with open(os.path.join(spoolFolder,"manifest.json"),'r') as f:
+            manifest = json.load(f)
+
+        AddMsgAndPrint("\nLoading " + splitThousands(manifest['rows']) + " spooled CLUs into " + os.path.basename(outputFC))
+        arcpy.SetProgressorLabel("Loading spooled CLUs")
+
+        cursorFields = ['SHAPE@WKB' if name == '__wkb__' else name for name,kind,fldType in manifest['columns']]
+        dateIndexes = [i for i,column in enumerate(manifest['columns']) if column[2] == 'DATE']
+        wkbIndexes = [i for i,column in enumerate(manifest['columns']) if column[2] == 'WKB']
+
+        with arcpy.da.InsertCursor(outputFC,cursorFields) as cur:
+            for row in iterColumnSpool(spoolFolder):
+                for i in dateIndexes:
+                    if row[i] is not None:
+                        row[i] = time.strftime('%m/%d/%Y',time.gmtime(row[i]/1000))   # 01/01/2021
+                for i in wkbIndexes:
+                    if row[i] is not None:
+                        row[i] = bytearray(row[i])
+                cur.insertRow(row)
+
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def deleteColumnSpool(spoolFolder):
+    """ This function will delete the files of a column spool and its folder."""
 
-            arcpy.SetProgressorLabel("Adding Field: " + field)
-            arcpy.AddField_management(newFC,field,params[0],"#","#",fldLength,fldAlias)
-            arcpy.SetProgressorPosition()
+    try:
+        for spoolFile in os.listdir(spoolFolder):
+            os.remove(os.path.join(spoolFolder,spoolFile))
+        os.rmdir(spoolFolder)
 
-        arcpy.ResetProgressor()
-        arcpy.SetProgressorLabel("")
-        return fieldDict,newFC
+    except:
+        errorMsg()
+
+## ===================================================================================
+def downloadRequestsConcurrently(envelopeDict,fc,RESTurl):
+    """ This function will download the planned requests on several threads while the
+        CLUs are inserted on the main thread (arcpy is not thread safe).  Messages
+        and arcpy calls (token regeneration) of the download threads are run by the
+        main thread while it waits for downloads (serviceMainThreadCalls).  The
+        number of requests actually in flight is set by the AIMD controller in
+        submitFSquery (configureConcurrency).  Downloaded responses waiting to be
+        inserted are bounded so memory stays flat if inserts fall behind.
+
+        envelopeDict - {'request_42': ['{"rings":...}', 691]}
+
+        Returns a dictionary of the requests that failed; False if error ocurred"""
+
+    try:
+        numOfThreads = concurrencyState['max'] if concurrencyState['enabled'] else 1
+        requestQueue = queue.Queue()
+        resultQueue = queue.Queue(maxsize=2 * numOfThreads)
+
+        for item in envelopeDict.items():
+            requestQueue.put(item)
+
+        def worker():
+            while True:
+                try:
+                    key,envelope = requestQueue.get_nowait()
+                except queue.Empty:
+                    return
+
+                try:
+                    result = fetchCLUgeometry(envelope[0],RESTurl,getRequestWhere(envelope),getRequestParams(envelope))
+                except:
+                    result = False
+                resultQueue.put((key,envelope,result))
+
+        for i in range(numOfThreads):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        failedRequests = dict()
+        for i in range(len(envelopeDict)):
+
+            # run arcpy calls handed over by the download threads while waiting
+            while True:
+                serviceMainThreadCalls()
+                try:
+                    key,envelope,result = resultQueue.get(timeout=0.2)
+                    break
+                except queue.Empty:
+                    pass
+
+            status = getConcurrencyStatus()
+
+            AddMsgAndPrint("Received Request " + str(i + 1) + " of " + splitThousands(len(envelopeDict)) + " - " + str(envelope[1]) +
+                           " CLUs -- concurrency " + str(status['current']) + "/" + str(status['target']))
+
+            # If request fails add to failed Requests for a 2nd attempt
+            if not result or not insertCLUgeometry(result[0],fc,result[1]):
+                failedRequests[key] = envelope
+
+        status = getConcurrencyStatus()
+        AddMsgAndPrint("\tPeak concurrency: " + str(status['peak']) + " -- p95 latency: " + str(round(status['p95'],2)) + " sec")
+        return failedRequests
 
     except:
         errorMsg()
-        AddMsgAndPrint("\tFailed to create scratch " + newFC + " Feature Class",2)
         return False
 
 ## ===================================================================================
-def getCLUgeometryByExtent(JSONextent,fc,RESTurl):
-    """ This funciton will will retrieve CLU geometry from the CLU WFS and assemble
-        into the CLU fc along with the attributes associated with it.
-        It is intended to receive requests that will return records that are
-        below the WFS record limit"""
+def downloadFetchFirst(inFC,fc,RESTurl,bGeometry=True):
+    """ This function will download the CLUs within the AOI without planning the
+        requests first.  Pieces expected to be within the WFS limit go straight to the
+        geometry query instead of a count query followed by a geometry query.  Pieces
+        that are likely over the limit (the AOI itself, halves of a piece that was
+        counted with more than 2 x maxRecordCount CLUs and halves of a piece whose
+        response was cut off) are counted first (returnCountOnly) so that a response
+        of maxRecordCount full geometries is not downloaded only to be discarded.
+        Pieces over the limit are cut in half (getGeometryHalves) and both halves are
+        queued; otherwise the CLUs are inserted right away.
+
+        A piece whose request failed is split in half and both halves are queued
+        again; halves that fail as well are returned with their CLU count so that the
+        2nd attempt requests a piece within the WFS limit.
+
+        Returns a tuple of (dictionary of the requests that failed, number of pieces
+        downloaded or given up on) where the failed requests are in the same format
+        as createListOfJSONextents.  Count requests and pieces that were split are
+        not included in the number of pieces so that it can be compared against the
+        number of failed requests; False if error ocurred"""
 
     try:
+        aoiGeometry = [row[0] for row in arcpy.da.SearchCursor(inFC, ['SHAPE@'])][0]
+
+        # [piece, estimated CLU count (None if unknown), bCounted, number of failed attempts]
+        pieces = [[aoiGeometry,None,False,0]]
+        failedRequests = dict()
+        numOfRequests = 0
+        numOfSplits = 0
+        numOfPieces = [0]       # final pieces; list so that requeueFailedPiece can update it
+
+        def requeueFailedPiece(piece,estimate,attempts,requestJSON):
+            # split a failed piece once; its halves are counted before they are downloaded
+            if attempts < 1:
+                for half in getGeometryHalves(piece):
+                    pieces.append([half,None,False,attempts + 1])
+            else:
+                numOfPieces[0] += 1
+                failedRequests["fetch_request_" + str(numOfRequests)] = [requestJSON,estimate if estimate is not None else maxRecordCount]
 
-        params = urllibEncode({'f': 'json',
-                               'geometry':JSONextent,
-                               'geometryType':'esriGeometryPolygon',
-                               'returnGeometry':'true',
-                               'outFields': '*',
-                               'token': portalToken['token']})
+        while pieces:
+            piece,estimate,bCounted,attempts = pieces.pop()
+            requestJSON = getRequestGeometry(piece,aoiGeometry,bGeometry)
 
-        # Send request to feature service; The following dict keys are returned:
-        # ['objectIdFieldName', 'globalIdFieldName', 'geometryType', 'spatialReference', 'fields', 'features']
-        geometry = submitFSquery(RESTurl,params)
+            # ------------------------------------------- count large or unknown pieces first
+            if estimate is None or estimate > maxRecordCount:
+                numOfRequests += 1
+                count = getCountQuery(requestJSON,RESTurl)
 
-        if not geometry:
-           return False
+                if count is False:
+                    requeueFailedPiece(piece,estimate,attempts,requestJSON)
+                    continue
 
-        # Insert Geometry
-        with arcpy.da.InsertCursor(fc, [fld for fld in fields]) as cur:
+                if count == 0:
+                    continue
 
-            arcpy.SetProgressor("step", "Assembling Geometry", 0, len(geometry['features']),1)
+                if count > maxRecordCount:
+                    numOfSplits += 1
+                    for half in getGeometryHalves(piece):
+                        pieces.append([half,int(math.ceil(count / 2.0)),False,attempts])
+                    continue
 
-            # Iterenate through the 'features' key in geometry dict
-            # 'features' contains geometry and attributes
-            for rec in geometry['features']:
+                estimate = count
+                bCounted = True
+
+            numOfRequests += 1
+            result = fetchCLUgeometry(requestJSON,RESTurl)
+
+            if not result:
+                requeueFailedPiece(piece,estimate,attempts,requestJSON)
+                continue
+
+            geometry,newObjectIds = result
+            numOfCLUs = len(geometry.get('features',[]))
+
+            # Too many CLUs within this piece; split it and count both halves first
+            if geometry.get('exceededTransferLimit') or (numOfCLUs >= maxRecordCount and not bCounted):
+                if newObjectIds:
+                    releaseCLUidentifiers(ingestedObjectIds,newObjectIds)
+
+                numOfSplits += 1
+                for half in getGeometryHalves(piece):
+                    pieces.append([half,None,False,attempts])
+                continue
+
+            AddMsgAndPrint("Request " + str(numOfRequests) + " - " + str(numOfCLUs) + " CLUs -- " + str(len(pieces)) + " pieces queued")
+
+            if not insertCLUgeometry(geometry,fc,newObjectIds):
+                requeueFailedPiece(piece,numOfCLUs,attempts,requestJSON)
+            else:
+                numOfPieces[0] += 1
+
+        AddMsgAndPrint("\t" + splitThousands(numOfRequests) + " server requests were made; " + splitThousands(numOfSplits) + " pieces exceeded the WFS limit and were split")
+        return (failedRequests,numOfPieces[0])
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def getJSONgeometryCenter(jsonGeometry):
+    """ This function will return the center (x,y) of the bounding box of an ESRI JSON
+        polygon or envelope string such as the ones stored in geometryEnvelopes.
+        i.e. '{"rings":[[[-90.11,37.00],[-89.95,37.17],...]],"spatialReference":{"wkid":4326}}'"""
+
+    xmin,ymin,xmax,ymax = getJSONgeometryBounds(jsonGeometry)
+    return ((xmin + xmax) / 2.0, (ymin + ymax) / 2.0)
+
+## ===================================================================================
+def splitEnvelopesIntoShards(envelopeDict,numOfShards):
+    """ This function will split the planned envelopes into spatially coherent shards
+        that can be downloaded by separate worker processes.  Envelopes are ordered
+        along a hilbert curve by their center and the ordered list is cut into
+        contiguous runs containing roughly the same number of CLUs.  Neighboring
+        envelopes therefore end up in the same shard which keeps the number of
+        CLUs downloaded by more than one shard low.
+
+        envelopeDict - {'request_42': ['{"rings":...}', 691]}
+
+        Returns a list of envelope dictionaries; one per shard"""
+
+    try:
+        centers = dict([(key,getJSONgeometryCenter(value[0])) for key,value in envelopeDict.items()])
+
+        xmin = min([c[0] for c in centers.values()]); xmax = max([c[0] for c in centers.values()])
+        ymin = min([c[1] for c in centers.values()]); ymax = max([c[1] for c in centers.values()])
+        width = (xmax - xmin) or 1.0
+        height = (ymax - ymin) or 1.0
+        hilbertMax = (1 << 16) - 1
+
+        def hilbertKey(key):
+            x = int(hilbertMax * (centers[key][0] - xmin) / width)
+            y = int(hilbertMax * (centers[key][1] - ymin) / height)
+            return hilbertValue(x,y)
+
+        orderedKeys = sorted(envelopeDict.keys(),key=hilbertKey)
+
+        numOfShards = max(1,min(numOfShards,len(orderedKeys)))
+        totalCLUs = sum([value[1] for value in envelopeDict.values()]) or 1
+        shardCLUtarget = float(totalCLUs) / numOfShards
+
+        shards = [dict()]
+        shardCLUs = 0
+        for key in orderedKeys:
+            if shardCLUs >= shardCLUtarget and len(shards) < numOfShards:
+                shards.append(dict())
+                shardCLUs = 0
+
+            shards[-1][key] = envelopeDict[key]
+            shardCLUs += envelopeDict[key][1]
 
-                arcpy.SetProgressorLabel("Assembling Geometry")
-                values = list()    # list of attributes
+        return shards
 
-                polygon = json.dumps(rec['geometry'])   # u'geometry': {u'rings': [[[-89.407702228, 43.334059191999984], [-89.40769642800001, 43.33560779300001]}
-                attributes = rec['attributes']          # u'attributes': {u'land_unit_id': u'73F53BC1-E3F8-4747-B51F-E598EE445E47'}}
+    except:
+        errorMsg()
+        return [envelopeDict]
+
+## ===================================================================================
+def extractShardsInParallel(envelopeDict,numOfShards,outputFC,RESTurl):
+    """ This function will download the planned envelopes using a pool of worker
+        processes.  The envelopes are split into spatially coherent shards, each
+        shard is downloaded by extractShard into its own scratch output and the
+        partial outputs are appended to outputFC (Append_management).  extractShard
+        lives in extract_CLU_shard.py so that the worker processes do not need to
+        import this script.  CLUs that were
+        downloaded by more than one shard (along shard boundaries) are deleted from
+        the partial output by clu_identifier before it is appended.  JSON decoding and inserts are CPU bound so this scales with
+        the number of cores instead of being bound by a single process.
+
+        Returns a dictionary of requests that failed in every attempt.
+        Return False if error ocurred."""
+
+    try:
+        import multiprocessing
+        import extract_CLU_shard
+
+        shards = splitEnvelopesIntoShards(envelopeDict,numOfShards)
+        AddMsgAndPrint("\nDownloading " + splitThousands(len(envelopeDict)) + " requests using " + str(len(shards)) + " worker processes")
+        arcpy.SetProgressorLabel("Downloading CLUs using " + str(len(shards)) + " worker processes")
+
+        # Inside ArcGIS Pro sys.executable is ArcGISPro.exe; workers need python
+        if not os.path.basename(sys.executable).lower().startswith('python'):
+            multiprocessing.set_executable(os.path.join(sys.exec_prefix,'pythonw.exe'))
+
+        shardInfoList = list()
+        for shardNum,shardEnvelopes in enumerate(shards):
+            shardInfoList.append({'shardNum':shardNum,
+                                  'envelopes':shardEnvelopes,
+                                  'templateFC':outputFC,
+                                  'scratchFolder':arcpy.env.scratchFolder,
+                                  'RESTurl':RESTurl,
+                                  'portalToken':portalToken,
+                                  'endpoints':[endpoint['url'] for endpoint in endpointState['endpoints']],
+                                  'fields':fields,
+                                  'fldsDict':fldsDict,
+                                  'cluIdentifierMemoryLimit':cluIdentifiers['threshold'],
+                                  'bIDdiffFetching':bIDdiffFetching})
+
+        pool = multiprocessing.Pool(len(shardInfoList))
+        try:
+            results = pool.map(extract_CLU_shard.extractShard,shardInfoList)
+        finally:
+            pool.close()
+            pool.join()
+
+        # ------------------------------------------- Merge partial outputs
+        failedRequests = dict()
+        AddMsgAndPrint("Merging " + str(len(results)) + " partial outputs")
+
+        for shardNum,(shardFC,shardFailed,shardTruncated,shardMessages) in enumerate(results):
+            failedRequests.update(shardFailed)
+            requestStats['truncated'] += shardTruncated
+
+            for msg,severity in shardMessages:
+                AddMsgAndPrint("\tShard " + str(shardNum) + ": " + msg.strip(),severity)
+
+            if not shardFC:
+                continue
+
+            # CLUs along shard boundaries were downloaded by more than one shard
+            with arcpy.da.UpdateCursor(shardFC,['clu_identifier']) as shardCursor:
+                for row in shardCursor:
+                    if not addCLUidentifier(cluIdentifiers,row[0]):
+                        shardCursor.deleteRow()
+
+            arcpy.Append_management(shardFC,outputFC,"NO_TEST")
+
+            if fgbWriter or parquetWriter:
+                with arcpy.da.SearchCursor(shardFC,fields) as shardCursor:
+                    for row in shardCursor:
+                        if not isCLUwithinAOI(aoiFilter,json.loads(row[-1])):
+                            continue
+
+                        attributes = dict()
+                        for fld,value in zip(fields,row):
+                            # cursors return datetime objects; FlatGeobuf/GeoParquet writers expect Unix Epoch ms
+                            if fld in fldsDict and fldsDict[fld][0] == 'DATE' and value is not None:
+                                value = calendar.timegm(value.timetuple()) * 1000
+                            attributes[fld] = value
+
+                        if fgbWriter:
+                            writeFlatGeobufFeature(fgbWriter,attributes,json.loads(row[-1]))
+                        if parquetWriter:
+                            writeGeoParquetFeature(parquetWriter,attributes,json.loads(row[-1]))
+
+            arcpy.Delete_management(os.path.dirname(shardFC))
+
+        return failedRequests
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def startProfiling(snapshotInterval=100):
+    """ This function will turn on the profiling mode.  Every stage of the client side
+        work (planning, request, decode, transform, insert, final filter) that is
+        wrapped with beginProfileStage/endProfileStage gets its own cProfile profiler
+        and its own peak memory (tracemalloc).  Every snapshotInterval-th occurrence
+        of a stage a tracemalloc snapshot is taken at the beginning and compared at
+        the end to collect the lines allocating memory in that stage.  Snapshots are
+        the only expensive part so the interval keeps the mode cheap enough for
+        sampled production runs.  Inserts are profiled per response (batch), not
+        per row.
+
+        tracemalloc is not available in python 2.7 (ArcMap); only CPU time is
+        profiled there.  Worker processes of the sharded mode are not profiled."""
+
+    try:
+        profileState['enabled'] = True
+        profileState['start'] = time.time()
+        profileState['lastTimeline'] = 0.0
+        profileState['snapshotInterval'] = max(1,snapshotInterval)
+
+        if tracemalloc:
+            # 1 frame per allocation keeps the tracing overhead low
+            tracemalloc.start(1)
+        else:
+            AddMsgAndPrint("\ntracemalloc is not available; Only CPU time will be profiled",1)
+
+        AddMsgAndPrint("\nProfiling mode is on")
+
+    except:
+        errorMsg()
 
-                # "clu_identifier" is the unique field that will be used to
-                # maintain unique CLUs; If the CLU exists continue
-                if attributes['clu_identifier'] in cluIdentifierList:
-                   continue
+## ===================================================================================
+def beginProfileStage(stage):
+    """ This function will start profiling a stage.  Stages can be nested; the
+        profiler of the enclosing stage is paused so that cProfile times are
+        exclusive to the innermost stage.  If the stage is already open (an exception
+        skipped its endProfileStage) the stale entries are closed first.  Only the
+        main thread is profiled."""
+
+    if not profileState['enabled'] or threading.current_thread().name != 'MainThread':
+        return
+
+    try:
+        stack = profileState['stack']
+
+        # stage left open by an exception
+        if stage in [entry['stage'] for entry in stack]:
+            endProfileStage(stage)
+
+        if stack:
+            stack[-1]['profiler'].disable()
+
+        if not stage in profileState['profilers']:
+            profileState['profilers'][stage] = cProfile.Profile()
+            profileState['stages'][stage] = {'calls':0,'seconds':0.0,'peak':0}
+            profileState['allocations'][stage] = collections.Counter()
+
+        stageStats = profileState['stages'][stage]
+        entry = {'stage':stage,'profiler':profileState['profilers'][stage],'start':time.time(),'snapshot':None,
+                 'memory':(0,0)}
+
+        if tracemalloc:
+            # traced memory (current,peak) when the stage began; the peak is never reset
+            entry['memory'] = tracemalloc.get_traced_memory()
+
+            if stageStats['calls'] % profileState['snapshotInterval'] == 0:
+                entry['snapshot'] = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False,tracemalloc.__file__)])
+
+        stageStats['calls'] += 1
+        stack.append(entry)
+        entry['profiler'].enable()
+
+    except:
+        errorMsg()
+
+## ===================================================================================
+def endProfileStage(stage):
+    """ This function will stop profiling a stage and resume the profiler of the
+        enclosing stage.  Stages opened after this one that were never closed are
+        closed as well.  The peak memory of the stage is recorded and a point is
+        added to the memory timeline at most once per second.
+
+        The tracemalloc peak is not reset so that enclosing stages are not affected.
+        If the peak rose while the stage was open it was reached within the stage;
+        otherwise the larger of the memory at the beginning and at the end of the
+        stage is recorded."""
+
+    if not profileState['enabled'] or threading.current_thread().name != 'MainThread':
+        return
+
+    try:
+        stack = profileState['stack']
+
+        if not stage in [entry['stage'] for entry in stack]:
+            return
+
+        while stack:
+            entry = stack.pop()
+            entry['profiler'].disable()
+            stageStats = profileState['stages'][entry['stage']]
+            stageStats['seconds'] += time.time() - entry['start']
+
+            if tracemalloc:
+                current,peak = tracemalloc.get_traced_memory()
+                beginCurrent,beginPeak = entry['memory']
+
+                if peak > beginPeak:
+                    stageStats['peak'] = max(stageStats['peak'],peak)
                 else:
-                    cluIdentifierList.append(attributes['clu_identifier'])
+                    stageStats['peak'] = max(stageStats['peak'],beginCurrent,current)
 
-                for fld in fields:
-                    if fld == "SHAPE@JSON":
-                        continue
+                if entry['snapshot']:
+                    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False,tracemalloc.__file__)])
+                    for stat in snapshot.compare_to(entry['snapshot'],'lineno'):
+                        if stat.size_diff > 0:
+                            profileState['allocations'][entry['stage']][str(stat.traceback)] += stat.size_diff
 
-                    # DATE values need to be converted from Unix Epoch format
-                    # to dd/mm/yyyy format so that it can be inserted into fc.
-                    elif fldsDict[fld][0] == 'DATE':
-                        dateVal = attributes[fld]
-                        if not dateVal in (None,'null','','Null'):
-                            epochFormat = float(attributes[fld]) # 1609459200000
+                elapsed = time.time() - profileState['start']
+                if elapsed - profileState['lastTimeline'] >= 1.0:
+                    profileState['timeline'].append((elapsed,entry['stage'],current,peak))
+                    profileState['lastTimeline'] = elapsed
 
-                            # Convert to seconds from milliseconds and reformat
-                            localFormat = time.strftime('%m/%d/%Y',time.gmtime(epochFormat/1000))   # 01/01/2021
-                            values.append(localFormat)
-                        else:
-                            values.append(None)
+            if entry['stage'] == stage:
+                break
 
-                    else:
-                        values.append(attributes[fld])
+        if stack:
+            stack[-1]['profiler'].enable()
 
-                # geometry goes at the the end
-                values.append(polygon)
-                cur.insertRow(values)
-                arcpy.SetProgressorPosition()
+    except:
+        errorMsg()
 
-        arcpy.ResetProgressor()
-        arcpy.SetProgressorLabel("")
-        del cur
+## ===================================================================================
+def writeProfileReport(reportFile,topN=15):
+    """ This function will stop the profiling mode and write the profiling report to
+        reportFile.  For every stage the report lists the number of calls, the
+        inclusive wall time, the peak memory, the topN cProfile hotspots (sorted by
+        internal time) and the topN lines allocating memory.  The peak memory
+        timeline is written at the end.  A short per-stage summary is printed.
+
+        Return True if the report was written; False otherwise"""
+
+    if not profileState['enabled']:
+        return False
+
+    try:
+        while profileState['stack']:
+            endProfileStage(profileState['stack'][0]['stage'])
+
+        profileState['enabled'] = False
+        stages = sorted(profileState['stages'].items(),key=lambda item: item[1]['seconds'],reverse=True)
+
+        AddMsgAndPrint("\nProfile summary (inclusive seconds):")
 
+        with open(reportFile,'w') as report:
+            report.write("CLU extraction profile -- " + time.strftime('%m/%d/%Y %H:%M:%S') + "\n")
+            report.write("Total seconds: " + str(round(time.time() - profileState['start'],2)) + "\n")
+
+            for stage,stageStats in stages:
+                peakMB = round(stageStats['peak'] / 1048576.0,1)
+                summary = stage + ": " + splitThousands(stageStats['calls']) + " calls -- " + \
+                          str(round(stageStats['seconds'],2)) + " seconds -- peak memory " + str(peakMB) + " MB"
+
+                AddMsgAndPrint("\t" + summary)
+                report.write("\n" + "=" * 83 + "\n" + summary + "\n" + "=" * 83 + "\n")
+
+                report.write("\nCPU hotspots:\n")
+                try:
+                    pstats.Stats(profileState['profilers'][stage],stream=report).sort_stats('tottime').print_stats(topN)
+                except TypeError:
+                    report.write("\tNo calls profiled\n")
+
+                allocations = profileState['allocations'][stage]
+                if allocations:
+                    report.write("\nMemory allocated (sampled every " + str(profileState['snapshotInterval']) + " calls):\n")
+                    for line,size in allocations.most_common(topN):
+                        report.write("\t" + str(round(size / 1024.0,1)) + " KB\t" + line + "\n")
+
+            if profileState['timeline']:
+                report.write("\n" + "=" * 83 + "\nMemory timeline\n" + "=" * 83 + "\n")
+                report.write("seconds\tstage\tcurrent MB\tpeak MB\n")
+                for elapsed,stage,current,peak in profileState['timeline']:
+                    report.write(str(round(elapsed,1)) + "\t" + stage + "\t" + str(round(current / 1048576.0,1)) +
+                                 "\t" + str(round(peak / 1048576.0,1)) + "\n")
+
+        if tracemalloc:
+            tracemalloc.stop()
+
+        AddMsgAndPrint("\tProfile report written to: " + reportFile)
         return True
 
     except:
-        try: del cur
-        except: pass
-
         errorMsg()
         return False
 
 ## ====================================== Main Body ==================================
 # Import modules
 import sys, string, os, traceback
-import urllib, re, time, json
+import urllib, re, time, json, struct, math, calendar
+import collections, tempfile, sqlite3, hashlib, array, shutil
+import cProfile, pstats, threading
 import arcgisscripting, arcpy
 from arcpy import env
 import random
 
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None    # python 2.7 (ArcMap)
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue    # python 2.7 (ArcMap)
+
+# Number of requests sent and bytes received by submitFSquery and number of responses
+# inserted although they were cut off at the WFS record limit (insertCLUgeometry)
+requestStats = {'requests':0,'bytes':0,'truncated':0,'planningErrors':0}
+
+# Guards requestStats and endpointState, which are updated by download threads
+stateLock = threading.Lock()
+
+# Messages added by download threads (AddMsgAndPrint) and arcpy calls they hand to
+# the main thread (callOnMainThread); arcpy is not thread safe
+threadMessages = collections.deque()
+mainThreadCalls = queue.Queue()
+
+# CLU identifier stores (openCLUidentifierStore); closed at the end of the main body
+# so that a spilled sqlite file is removed on every exit path
+cluIdentifiers = False
+ingestedObjectIds = False
+
+# CLU density grid file header and value of cells that have never been observed
+gridHeaderFormat = '<4sHIdddII'
+unknownCellValue = 0xFFFFFFFF
+
+# Seconds before a request to the CLU service times out
+requestTimeout = 300
+
+# AIMD controller of the number of requests in flight (configureConcurrency)
+concurrencyState = {'enabled':False,'limit':1.0,'inFlight':0,'peak':0}
+
+# Equivalent CLU service endpoints requests are balanced across (configureEndpoints)
+endpointState = {'endpoints':[]}
+
+# Per-stage profilers, timings, memory peaks and allocations of the profiling mode
+profileState = {'enabled':False,'stack':[],'profilers':{},'stages':{},'allocations':{},'timeline':[]}
+
 if __name__ == '__main__':
 
     try:
@@ -1052,6 +5285,154 @@ if __name__ == '__main__':
         #AOI = r'O:\NRCS_Engineering_Tools_ArcPro\NRCS_Engineering_Tools_ArcPro_Update.gdb\bnd071401070404_WTSH'
         #outputWS = r'O:\NRCS_Engineering_Tools_ArcPro\NRCS_Engineering_Tools_ArcPro_Update.gdb'
 
+        """ --------------------------------------------------- Tool Options -----------------------------------"""
+        # Write a FlatGeobuf copy of the CLUs with a packed Hilbert R-tree index.
+        # The .fgb is written to the folder containing the output workspace.
+        bFlatGeobufOutput = False
+
+        # Write a GeoParquet copy of the CLUs partitioned by a spatial key (ArcPro only;
+        # needs pyarrow).  partition key = 'quadkey' or a list of CLU fields.
+        # The dataset folder is written to the folder containing the output workspace.
+        bGeoParquetOutput = False
+        geoParquetPartitionKey = 'quadkey'     # i.e. ['state_ansi_code','county_ansi_code']
+        geoParquetQuadkeyLevel = 8
+        geoParquetRowGroupSize = 4096
+
+        # Number of worker processes used to download and insert CLUs.  Each worker
+        # downloads a spatially coherent shard of the requests; 1 = single process.
+        numOfShards = 1
+
+        # Bounded-memory mode for very large AOIs (ArcPro only).  Requests are planned
+        # lazily and downloaded as soon as they are planned instead of holding the
+        # whole plan in memory.
+        bStreamingMode = False
+
+        # Number of CLU identifiers kept in memory for de-duplication before they are
+        # moved to a temporary database on disk.
+        cluIdentifierMemoryLimit = 250000
+
+        # Service fields requested and written to the output; empty list = all fields.
+        # i.e. ['clu_identifier','clu_number','tract_number','farm_number','calcacres']
+        # clu_identifier is always included b/c it is used to remove duplicate CLUs.
+        outputFields = []
+
+        # False = attribute-only extract; CLUs are written to a table without geometry
+        # (returnGeometry=false).  The table is not filtered by the exact AOI boundary.
+        bReturnGeometry = True
+
+        # Append downloaded CLUs to a columnar spool in the scratch folder and bulk load
+        # them into the output at the end instead of inserting them one at a time.
+        # Keep the spool to write other formats from it later (iterColumnSpool).
+        bColumnSpool = False
+        bKeepColumnSpool = False
+
+        # Local CLU mirror; a sqlite database with an R-tree spatial index.  AOIs covered
+        # by a mirror synchronized within cluMirrorMaxAge hours are extracted from it
+        # instead of the CLU service.  Set bSyncCLUmirror to synchronize the mirror and
+        # exit (i.e. from a scheduled task); cluMirrorWhere limits it to a subset.
+        cluMirrorFile = ""
+        cluMirrorWhere = ""             # i.e. "state_ansi_code = '55'"
+        cluMirrorMaxAge = 24            # hours
+        bSyncCLUmirror = False
+
+        # Bulk load into a File Geodatabase: the spatial index is not maintained while
+        # CLUs are inserted.  The spatial index (grid size from the CLU extents) and an
+        # attribute index on clu_identifier are built in one pass at the end.
+        bFGDBbulkLoad = False
+
+        # Update an existing CLU_<AOI> output with only the CLUs that were inserted,
+        # changed or deleted since the last run instead of rewriting it.  Per-CLU hashes
+        # are kept in CLU_<AOI>_hashes.sqlite next to the output workspace.
+        bUpdateMode = False
+
+        # Hours a cached copy of the CLU service metadata may be used when the service
+        # cannot be reached; the cache is revalidated on every run; 0 = no cache
+        metadataCacheMaxAge = 24
+
+        # Create outputs from a schema template kept in the scratch GDB instead of
+        # adding every field to each new output.
+        bUseSchemaTemplate = True
+
+        # Only plan the requests and report the number of requests, expected CLUs and
+        # estimated download size and time.  No output is created.
+        bDryRun = False
+
+        # Export the plan to this GeoJSON file (dry run) / re-use the plan in this
+        # GeoJSON file instead of planning again.  Empty = not used.
+        planExportPath = ""
+        planImportPath = ""
+
+        # CLU density grid used to plan requests locally instead of with count queries.
+        # Regular runs add the counts they discover to the grid.  Empty = not used.
+        densityGridFile = ""
+        densityGridCellSize = 5000      # units of the CLU service spatial reference (meters)
+        densityGridTarget = 0.75        # plan requests for this fraction of maxRecordCount
+        densityGridVerifyCount = 5      # densest planned requests verified with a count query
+        densityGridVerifyFraction = 0.5 # requests estimated above this fraction of maxRecordCount are verified too
+
+        # One-time sweep of the AOI extent (i.e. a state) into the density grid with one
+        # count query per grid cell.  No CLUs are extracted.
+        bSweepDensityGrid = False
+
+        # Plan requests by administrative partition with a single outStatistics query
+        # grouped by partitionFields instead of geometric bisection.  Planning falls
+        # back to geometric bisection if the service does not have the fields.
+        bAttributePartitioning = False
+        partitionFields = ['state_ansi_code','county_ansi_code']
+
+        # Extraction strategy: 'subdivide' (default), 'attribute' or 'paged'.  'auto' picks
+        # 'attribute' if the CLU service supports it and 'subdivide' otherwise.  Paged
+        # requests return up to maxRecordCount x maxRecordCountFactor CLUs per response
+        # and are only used if requested.  bAttributePartitioning forces 'attribute'.
+        extractionStrategy = 'subdivide'
+
+        # Request geometries are buffered outward and generalized by this fraction of
+        # the larger side of their bounding box before being sent to the WFS.
+        requestGeometryTolerance = 0.002
+
+        # Request the object IDs of each extent first and only download the CLUs that
+        # were not already downloaded by an overlapping extent.
+        bIDdiffFetching = False
+
+        # Equivalent CLU FeatureServer layers (i.e. an internal cached replica) that
+        # requests are balanced across along with the authoritative service.
+        # i.e. ['https://replica.example.gov/arcgis/rest/services/common_land_units/FeatureServer/0']
+        cluServiceEndpoints = []
+
+        # Split the AOI at the median sampled CLU centroid instead of into equal areas.
+        # Blocks are cut until they are estimated to hold medianSplitTarget x maxRecordCount.
+        bMedianSplitting = False
+        medianSplitTarget = 0.8
+
+        # CLU centroids sampled per piece, in multiples of maxRecordCount (one request
+        # each).  Pieces with fewer CLUs are sampled completely and need no count queries.
+        medianSampleSize = 10
+
+        # Skip planning; every piece goes straight to the geometry query and is split
+        # only if the response exceeded the WFS limit.  Ignored if a plan is imported.
+        bFetchFirst = False
+
+        # Merge adjacent planned requests whose combined CLU count fits within
+        # maxRecordCount less coalesceMargin (a fraction of maxRecordCount)
+        bCoalesceRequests = False
+        coalesceMargin = 0.1
+
+        # Download requests on several threads.  The number of requests in flight is
+        # adjusted between 1 and maxConcurrency by an AIMD controller: raised while the
+        # p95 latency and error rate stay under their targets and halved on 5xx
+        # responses, timeouts or latency spikes.
+        bAdaptiveConcurrency = False
+        maxConcurrency = 8
+        concurrencyTargetP95 = 30           # seconds
+        concurrencyTargetErrorRate = 0.05
+
+        # Fraction of runs profiled with cProfile and tracemalloc per stage (planning,
+        # request, decode, transform, insert, final filter); 0 = never, 1 = every run.
+        # The report is written to the scratch folder.
+        profileSampleRate = 0.0
+        profileTopN = 15                # hotspots and allocating lines reported per stage
+        profileSnapshotInterval = 100   # memory snapshot every Nth call of a stage
+
         # Determine the ESRI product and set boolean
         productInfo = arcpy.GetInstallInfo()['ProductName']
 
@@ -1088,6 +5469,11 @@ if __name__ == '__main__':
         # Use most of the cores on the machine where ever possible
         arcpy.env.parallelProcessingFactor = "75%"
 
+        # Sampled profiling mode
+        profileReportFile = arcpy.env.scratchFolder + os.sep + "CLU_profile_" + time.strftime('%Y%m%d_%H%M%S') + ".txt"
+        if profileSampleRate and random.random() < profileSampleRate:
+            startProfiling(profileSnapshotInterval)
+
         """ ---------------------------------------------- ArcGIS Portal Information ---------------------------"""
         nrcsPortal = 'https://gis.sc.egov.usda.gov/portal/'
         portalToken = getPortalTokenInfo(nrcsPortal)
@@ -1101,15 +5487,104 @@ if __name__ == '__main__':
         # URL for Feature Service Metadata (Service Definition) - Dictionary of ;
         cluRESTurl_Metadata = """https://gis.sc.egov.usda.gov/appserver/rest/services/common_land_units/common_land_units/FeatureServer/0"""
 
-        # Used for admin or feature service info; Send POST request
-        params = urllibEncode({'f': 'json','token': portalToken['token']})
+        # Requests to the CLU service are balanced across it and the equivalent endpoints
+        configureEndpoints([cluRESTurl_Metadata] + cluServiceEndpoints)
 
-        # request info about the feature service
-        fsMetadata = submitFSquery(cluRESTurl_Metadata,params)
+        # Balancing only adds throughput if requests are in flight at the same time
+        if cluServiceEndpoints and not bAdaptiveConcurrency:
+            bAdaptiveConcurrency = True
+            maxConcurrency = max(2,len(cluServiceEndpoints) + 1)
+            AddMsgAndPrint("\n" + str(len(cluServiceEndpoints) + 1) + " CLU service endpoints configured; Downloading up to " +
+                           str(maxConcurrency) + " requests at a time",1)
+
+        if bAdaptiveConcurrency:
+            configureConcurrency(maxConcurrency,concurrencyTargetP95,concurrencyTargetErrorRate)
+
+        # request info about the feature service; cached in the scratch folder
+        metadataCache = arcpy.env.scratchFolder + os.sep + "CLU_service_metadata.json"
+        fsMetadata = getServiceMetadata(cluRESTurl_Metadata,metadataCache,metadataCacheMaxAge)
+
+        if not fsMetadata:
+           AddMsgAndPrint("Could not retrieve CLU service metadata. Exiting!",2)
+           exit()
+
+        # Get the Max record count the REST service can return
+        if not 'maxRecordCount' in fsMetadata:
+           AddMsgAndPrint('\t\tCould not determine FS maximum record count: Setting default to 1,000 records',1)
+           maxRecordCount = 1000
+        else:
+           maxRecordCount = fsMetadata['maxRecordCount']
+
+        cluRESTurl = """https://gis.sc.egov.usda.gov/appserver/rest/services/common_land_units/common_land_units/FeatureServer/0/query"""
+
+        # Query capabilities of the service used to pick the extraction strategy
+        serviceCapabilities = probeServiceCapabilities(fsMetadata)
 
-        # Create empty CLU FC with necessary fields
+        # Download statistics of previous runs used by the dry run estimate
+        runStatsFile = arcpy.env.scratchFolder + os.sep + "CLU_run_statistics.json"
+
+        """ ---------------------------------------------- CLU Density Grid -----------------------------"""
+        densityGrid = False
+        if densityGridFile:
+            if os.path.exists(densityGridFile):
+                densityGrid = loadCLUdensityGrid(densityGridFile)
+            else:
+                densityGrid = createCLUdensityGrid(fsMetadata,densityGridCellSize)
+
+        if bAttributePartitioning and extractionStrategy in ('auto','subdivide'):
+            extractionStrategy = 'attribute'
+
+        if not bSweepDensityGrid:
+            extractionStrategy = selectExtractionStrategy(serviceCapabilities,extractionStrategy)
+
+        if bSweepDensityGrid:
+            if not densityGrid:
+                AddMsgAndPrint("A density grid file is needed to sweep the CLU density grid. Exiting!",2)
+                exit()
+
+            numOfCells = sweepCLUdensityGrid(densityGrid,AOI,cluRESTurl)
+            saveCLUdensityGrid(densityGrid,densityGridFile)
+            AddMsgAndPrint("\n" + splitThousands(numOfCells) + " CLU density grid cells updated in " + densityGridFile + ".  Done!\n")
+            exit()
+
+        """ ---------------------------------------------- CLU Mirror -----------------------------"""
+        if bSyncCLUmirror:
+            if not cluMirrorFile:
+                AddMsgAndPrint("A CLU mirror file is needed to synchronize the CLU mirror. Exiting!",2)
+                exit()
+
+            numOfChanges = syncCLUmirror(cluMirrorFile,cluRESTurl,fsMetadata,cluMirrorWhere)
+
+            if numOfChanges is False:
+                exit()
+
+            AddMsgAndPrint("\n" + splitThousands(numOfChanges) + " CLU changes synchronized into " + cluMirrorFile + ".  Done!\n")
+            exit()
+
+        """ ---------------------------------------------- Dry Run -----------------------------"""
+        if bDryRun:
+            beginProfileStage('planning')
+            geometryEnvelopes = planJSONextents(AOI,cluRESTurl,bReturnGeometry)
+            endProfileStage('planning')
+
+            if not geometryEnvelopes:
+                exit()
+
+            estimateRunCost(geometryEnvelopes,runStatsFile)
+
+            if planExportPath:
+                exportPlanGeoJSON(geometryEnvelopes,planExportPath)
+
+            exit()
+
+        # Extract the AOI from the local CLU mirror if it is current
+        bMirrorExtract = isCLUmirrorCurrent(cluMirrorFile,AOI,cluRESTurl,cluMirrorMaxAge) if cluMirrorFile else False
+
+        # Create empty CLU FC with necessary fields; in update mode CLUs are extracted
+        # into the scratch GDB and only the changes are applied to the output
         # fldsDict - {'clu_number': ('TEXT', 7, 'clu_number')}
-        fldsDict,cluFC = createOutputFC(fsMetadata,outputWS)
+        extractWS = arcpy.env.scratchGDB if bUpdateMode else outputWS
+        fldsDict,cluFC = createOutputFC(fsMetadata,extractWS,"POLYGON" if bReturnGeometry else None,outputFields)
         #fldsDict['SHAPE@JSON'] = ('SHAPE')
 
         # Isolate the fields that were inserted into new fc
@@ -1121,51 +5596,164 @@ if __name__ == '__main__':
         if bArcGISPro:
            fields = list(fields)
 
-        fields.append('SHAPE@JSON')
+        if bReturnGeometry:
+            fields.append('SHAPE@JSON')
 
-        # Get the Max record count the REST service can return
-        if not 'maxRecordCount' in fsMetadata:
-           AddMsgAndPrint('\t\tCould not determine FS maximum record count: Setting default to 1,000 records',1)
-           maxRecordCount = 1000
-        else:
-           maxRecordCount = fsMetadata['maxRecordCount']
+        # Open the FlatGeobuf output; features are streamed to it by getCLUgeometryByExtent
+        fgbWriter = False
+        if bFlatGeobufOutput and not bReturnGeometry:
+            AddMsgAndPrint("\nFlatGeobuf output needs CLU geometry; Not written for attribute-only extracts",1)
+
+        elif bFlatGeobufOutput:
+            fgbFolder = os.path.dirname(outputWS) if outputWS.lower().endswith('.gdb') else outputWS
+            fgbWriter = openFlatGeobuf(fgbFolder + os.sep + "CLU_" + os.path.basename(AOI) + ".fgb",fldsDict,fsMetadata,
+                                       not (bStreamingMode and bArcGISPro))
+
+        # Open the GeoParquet output; features are streamed to it by getCLUgeometryByExtent
+        parquetWriter = False
+        if bGeoParquetOutput and not bReturnGeometry:
+            AddMsgAndPrint("\nGeoParquet output needs CLU geometry; Not written for attribute-only extracts",1)
+
+        elif bGeoParquetOutput:
+            parquetFolder = os.path.dirname(outputWS) if outputWS.lower().endswith('.gdb') else outputWS
+            parquetWriter = openGeoParquet(parquetFolder + os.sep + "CLU_" + os.path.basename(AOI) + "_parquet",fldsDict,fsMetadata,
+                                           geoParquetPartitionKey,geoParquetQuadkeyLevel,geoParquetRowGroupSize)
+
+        # CLUs outside of the AOI are not streamed to the FlatGeobuf and GeoParquet outputs
+        aoiFilter = False
+        if fgbWriter or parquetWriter:
+            aoiFilter = getAOIfilter(AOI,arcpy.Describe(cluFC).spatialReference)
+
+        # Open the column spool; CLUs are bulk loaded into the output after the download
+        columnSpool = False
+        if bColumnSpool:
+            columnSpool = openColumnSpool(arcpy.env.scratchFolder + os.sep + "CLU_spool_" + os.path.basename(AOI),
+                                          fldsDict,[fld for fld in fields if fld != 'SHAPE@JSON'],bReturnGeometry)
 
         """ ---------------------------------------------- generate JSON Extents for requests -----------------------------"""
         # deconstructed AOI geometry in JSON
         #jSONpolygon = [row[0] for row in arcpy.da.SearchCursor(AOI, ['SHAPE@JSON'])][0]
 
-        cluRESTurl = """https://gis.sc.egov.usda.gov/appserver/rest/services/common_land_units/common_land_units/FeatureServer/0/query"""
-
         # Get a dictionary of extents to send to WFS
         # {'request_42': ['{"xmin":-90.15,"ymin":37.19,"xmax":-90.036,"ymax":37.26,"spatialReference":{"wkid":4326,"latestWkid":4326}}', 691]}
-        if bArcGISPro:
-            geometryEnvelopes = createListOfJSONextents(AOI,cluRESTurl)
+        # CLUs are read from the local CLU mirror; nothing to plan
+        if bMirrorExtract:
+            geometryEnvelopes = None
+
+        # Re-use a previously exported plan
+        elif planImportPath:
+            geometryEnvelopes = loadPlanGeoJSON(planImportPath)
+
+            if not geometryEnvelopes:
+                exit()
+
+        # Fetch-first mode; pieces are split during the download (downloadFetchFirst)
+        elif bFetchFirst:
+            geometryEnvelopes = None
+
+        # Streaming mode; envelopes are planned by iterJSONextents during the download
+        elif bStreamingMode and bArcGISPro:
+            geometryEnvelopes = None
         else:
-            geometryEnvelopes = createListOfJSONextents_ArcMap(AOI,cluRESTurl)
+            if bStreamingMode:
+                AddMsgAndPrint("\nStreaming mode is only available in ArcGIS Pro; Planning all requests first",1)
 
-        if not geometryEnvelopes:
-            exit()
+            beginProfileStage('planning')
+            geometryEnvelopes = planJSONextents(AOI,cluRESTurl,bReturnGeometry)
+            endProfileStage('planning')
+
+            if not geometryEnvelopes:
+                exit()
 
-        cluIdentifierList = list()  # Unique list of CLUs used to avoid duplicates
+        # Unique set of CLUs used to avoid duplicates
+        cluIdentifiers = openCLUidentifierStore(cluIdentifierMemoryLimit,arcpy.env.scratchFolder)
+        ingestedObjectIds = openCLUidentifierStore(cluIdentifierMemoryLimit,arcpy.env.scratchFolder)  # used by bIDdiffFetching
         failedRequests = dict()     # copy of geometryEnvelopes items that failed
         i = 1                       # request number
 
-        for envelope in geometryEnvelopes.items():
-            extent = envelope[1][0]
-            numOfCLUs = envelope[1][1]
-            AddMsgAndPrint("Submitting Request " + str(i) + " of " + splitThousands(len(geometryEnvelopes)) + " - " + str(numOfCLUs) + " CLUs")
+        # Download statistics used to calibrate the dry run estimate
+        downloadStart = time.time()
+        downloadStats = dict(requestStats)
 
-            # If request fails add to failed Requests for a 2nd attempt
-            if not getCLUgeometryByExtent(extent,cluFC,cluRESTurl):
-               failedRequests[envelope[0]] = envelope[1]
+        # False if any request failed twice or was cut off at the WFS record limit; an
+        # incomplete extract must not delete CLUs from the output in update mode
+        bExtractComplete = True
+
+        if bMirrorExtract:
+            if extractFromCLUmirror(cluMirrorFile,AOI,cluFC) is False:
+                AddMsgAndPrint("Could not extract CLUs from the CLU mirror.....exiting!",2)
+                exit()
+
+        elif geometryEnvelopes is None and bFetchFirst:
+            if numOfShards > 1 or bAdaptiveConcurrency:
+                AddMsgAndPrint("\nFetch-first mode downloads one piece at a time; Downloading in a single process",1)
+
+            fetchFirstResult = downloadFetchFirst(AOI,cluFC,cluRESTurl,bReturnGeometry)
+
+            if not fetchFirstResult:
+                exit()
+
+            # i - 1 is compared against the failed requests; only final pieces count
+            failedRequests,numOfPieces = fetchFirstResult
+            i = numOfPieces + 1
+
+        elif geometryEnvelopes is None:
+            if numOfShards > 1:
+                AddMsgAndPrint("\nSharded mode needs all requests planned first; Downloading in a single process",1)
+
+            for envelope in iterJSONextents(AOI,cluRESTurl,bReturnGeometry):
+                extent = envelope[1][0]
+                numOfCLUs = envelope[1][1]
+                AddMsgAndPrint("Submitting Request " + str(i) + " - " + str(numOfCLUs) + " CLUs")
 
-            i+=1
+                # If request fails add to failed Requests for a 2nd attempt
+                if not getCLUgeometryByExtent(extent,cluFC,cluRESTurl,getRequestWhere(envelope[1]),getRequestParams(envelope[1])):
+                   failedRequests[envelope[0]] = envelope[1]
+
+                i+=1
+
+            if i == 1:
+                AddMsgAndPrint("\tCould not determine number of server requests.  Exiting",2)
+                exit()
+
+        # Sharded mode; workers already made a 2nd attempt at their failed requests
+        elif numOfShards > 1 and len(geometryEnvelopes) > 1:
+            shardFailedRequests = extractShardsInParallel(geometryEnvelopes,numOfShards,cluFC,cluRESTurl)
+
+            if shardFailedRequests is False or len(shardFailedRequests) == len(geometryEnvelopes):
+                AddMsgAndPrint("ALL WFS requests failed.....exiting!")
+                exit()
+
+            for envelope in shardFailedRequests.items():
+                AddMsgAndPrint("This reques failed again")
+                AddMsgAndPrint(envelope)
+                bExtractComplete = False
+
+        # Concurrent downloads with adaptive concurrency
+        elif bAdaptiveConcurrency and len(geometryEnvelopes) > 1:
+            failedRequests = downloadRequestsConcurrently(geometryEnvelopes,cluFC,cluRESTurl)
+
+            if failedRequests is False:
+                failedRequests = dict(geometryEnvelopes)
+            i = len(geometryEnvelopes) + 1
+
+        else:
+            for envelope in geometryEnvelopes.items():
+                extent = envelope[1][0]
+                numOfCLUs = envelope[1][1]
+                AddMsgAndPrint("Submitting Request " + str(i) + " of " + splitThousands(len(geometryEnvelopes)) + " - " + str(numOfCLUs) + " CLUs")
+
+                # If request fails add to failed Requests for a 2nd attempt
+                if not getCLUgeometryByExtent(extent,cluFC,cluRESTurl,getRequestWhere(envelope[1]),getRequestParams(envelope[1])):
+                   failedRequests[envelope[0]] = envelope[1]
+
+                i+=1
 
         # Process failed requests as a 2nd attempt.
-        if len(failedRequests) > 1:
+        if len(failedRequests) > 0:
 
            # All Requests failed; Not trying 2nd attempt
-           if len(failedRequests) == len(geometryEnvelopes):
+           if len(failedRequests) == i - 1:
               AddMsgAndPrint("ALL WFS requests failed.....exiting!")
               exit()
 
@@ -1178,23 +5766,108 @@ if __name__ == '__main__':
                     AddMsgAndPrint("Submitting Request " + str(i) + " of " + splitThousands(len(failedRequests)) + " - " + str(numOfCLUs) + " CLUs")
 
                     # If request fails add to failed Requests for a 2nd attempt
-                    if not getCLUgeometryByExtent(extent,cluFC,cluRESTurl):
+                    if not getCLUgeometryByExtent(extent,cluFC,cluRESTurl,getRequestWhere(envelope[1]),getRequestParams(envelope[1])):
                        AddMsgAndPrint("This reques failed again")
                        AddMsgAndPrint(envelope)
+                       bExtractComplete = False
+
+        if requestStats['planningErrors']:
+            AddMsgAndPrint("\nPlanning of the WFS requests failed; the extract may be missing CLUs",1)
+            bExtractComplete = False
+
+        if requestStats['truncated'] > downloadStats['truncated']:
+            AddMsgAndPrint("\n" + str(requestStats['truncated'] - downloadStats['truncated']) + " requests exceeded the WFS record limit; the extract may be missing CLUs",1)
+            bExtractComplete = False
+
+        # Bulk load the spooled CLUs into the output
+        if columnSpool:
+            beginProfileStage('insert')
+            bSpoolLoaded = closeColumnSpool(columnSpool) and bulkLoadColumnSpool(columnSpool['folder'],cluFC)
+            endProfileStage('insert')
+
+            # the spool is the only copy of the downloaded CLUs; keep it if the load failed
+            if not bSpoolLoaded:
+                AddMsgAndPrint("\nSpooled CLUs could not be loaded into " + os.path.basename(cluFC) +
+                               "; the spool was kept in: " + columnSpool['folder'],2)
+                bExtractComplete = False
+
+            elif not bKeepColumnSpool:
+                deleteColumnSpool(columnSpool['folder'])
+
+        closeCLUidentifierStore(cluIdentifiers)
+        closeCLUidentifierStore(ingestedObjectIds)
+
+        # Bulk load; the indexes are built once the CLUs outside of the AOI are deleted
+        bBulkLoaded = bFGDBbulkLoad and extractWS.lower().endswith('.gdb')
+
+        # Worker process requests are not counted in requestStats; only record single process runs
+        if not (numOfShards > 1 and geometryEnvelopes) and not bMirrorExtract:
+            recordRunStatistics(runStatsFile,
+                                requestStats['requests'] - downloadStats['requests'],
+                                int(arcpy.GetCount_management(cluFC)[0]),
+                                requestStats['bytes'] - downloadStats['bytes'],
+                                time.time() - downloadStart)
+
+        # Build the spatial index and write out the FlatGeobuf
+        if fgbWriter:
+            closeFlatGeobuf(fgbWriter)
+
+        # Flush and close the GeoParquet partitions
+        if parquetWriter:
+            closeGeoParquet(parquetWriter)
+
+        # Filter CLUs by AOI boundary; attribute-only extracts have no geometry to filter by
+        # Bulk loaded outputs are filtered in place; a copy would get a default spatial index
+        if bReturnGeometry and bBulkLoaded:
+            beginProfileStage('final filter')
+            arcpy.MakeFeatureLayer_management(cluFC,"CLUFC_LYR")
+            arcpy.SelectLayerByLocation_management("CLUFC_LYR", "INTERSECT", AOI, "", "NEW_SELECTION")
+
+            # delete the CLUs outside of the AOI
+            if int(arcpy.GetCount_management("CLUFC_LYR")[0]) < int(arcpy.GetCount_management(cluFC)[0]):
+                arcpy.SelectLayerByAttribute_management("CLUFC_LYR","SWITCH_SELECTION")
+                arcpy.DeleteFeatures_management("CLUFC_LYR")
+
+            arcpy.Delete_management("CLUFC_LYR")
+            endProfileStage('final filter')
+
+        elif bReturnGeometry:
+            beginProfileStage('final filter')
+            arcpy.MakeFeatureLayer_management(cluFC,"CLUFC_LYR")
+            arcpy.SelectLayerByLocation_management("CLUFC_LYR", "INTERSECT", AOI, "", "NEW_SELECTION")
+
+            newCLUfc = os.path.dirname(cluFC) + os.sep + "clu_temp"
+            arcpy.CopyFeatures_management("CLUFC_LYR",newCLUfc)
+
+            arcpy.Delete_management(cluFC)
+            arcpy.Delete_management("CLUFC_LYR")
+
+            arcpy.env.workspace = os.path.dirname(cluFC)
+            arcpy.Rename_management(newCLUfc,"CLU_" + os.path.basename(AOI))
+            endProfileStage('final filter')
+
+        # Apply only the inserts, updates and deletes to the existing output
+        if bUpdateMode:
+            outputFC = outputWS + os.sep + "CLU_" + os.path.basename(AOI)
+            hashFolder = os.path.dirname(outputWS) if outputWS.lower().endswith('.gdb') else outputWS
+            hashFile = hashFolder + os.sep + "CLU_" + os.path.basename(AOI) + "_hashes.sqlite"
+
+            if applyCLUchanges(cluFC,outputFC,hashFile,[fld for fld in fields if fld != 'SHAPE@JSON'],bReturnGeometry,bExtractComplete):
+                cluFC = outputFC
+            else:
+                bBulkLoaded = False
 
-        # Filter CLUs by AOI boundary
-        arcpy.MakeFeatureLayer_management(cluFC,"CLUFC_LYR")
-        arcpy.SelectLayerByLocation_management("CLUFC_LYR", "INTERSECT", AOI, "", "NEW_SELECTION")
-
-        newCLUfc = outputWS + os.sep + "clu_temp"
-        arcpy.CopyFeatures_management("CLUFC_LYR",newCLUfc)
-
-        arcpy.Delete_management(cluFC)
-        arcpy.Delete_management("CLUFC_LYR")
+        # Build the spatial and clu_identifier indexes of the kept output in one pass.  In
+        # update mode an output that was only updated already has its indexes.
+        if bBulkLoaded and os.path.dirname(cluFC).lower().endswith('.gdb'):
+            if not 'clu_identifier_idx' in [index.name for index in arcpy.ListIndexes(cluFC)]:
+                beginProfileStage('indexing')
+                buildOutputIndexes(cluFC)
+                endProfileStage('indexing')
 
-        arcpy.env.workspace = outputWS
-        arcpy.Rename_management(newCLUfc,"CLU_" + os.path.basename(AOI))
+        writeProfileReport(profileReportFile,profileTopN)
 
+        logEndpointSummary()
         AddMsgAndPrint("\nThere are " + splitThousands(arcpy.GetCount_management(cluFC)[0]) + " CLUs in your AOI.  Done!\n")
 
         # Add final CLU layer to either ArcPro or ArcMap
@@ -1221,3 +5894,14 @@ if __name__ == '__main__':
 
     except:
         errorMsg()
+
+    finally:
+        # write the profile report and remove the identifier spill files; exit()
+        # skips the end of the main body
+        if profileState['enabled']:
+            writeProfileReport(profileReportFile,profileTopN)
+
+        if cluIdentifiers:
+            closeCLUidentifierStore(cluIdentifiers)
+        if ingestedObjectIds:
+            closeCLUidentifierStore(ingestedObjectIds)
@@ -0,0 +1,337 @@
+#-------------------------------------------------------------------------------
+# Name:        Extract CLUs by AOI - shard worker
+# Purpose:     Worker process of the sharded mode of extract_CLU_by_AOI.py
+#
+# Created:     10/19/2026
+#
+# extractShardsInParallel (extract_CLU_by_AOI.py) hands every shard of the planned
+# requests to extractShard in a separate worker process.  Worker processes are
+# spawned; they import this module instead of the tool script.  This is required
+# when the tool runs in process: ArcGISPro.exe is the main process, the tool script
+# is not a module that a worker process can import, and a worker function defined
+# in the tool script can not be found by the workers.  It also keeps the workers from
+# loading the whole tool.
+#
+# This module must be kept in the same folder as extract_CLU_by_AOI.py and must not
+# import it.  It only depends on arcpy and the python standard library and keeps the
+# query semantics of submitFSquery and getCLUgeometryByExtent: POSTed url-encoded
+# queries, a 2nd attempt after 5 seconds on a bad response, CLUs de-duplicated by
+# clu_identifier and, with bIDdiffFetching, only object IDs that were not already
+# downloaded by the shard are requested with geometry.  A worker can not sign in; a
+# request that fails with an expired token is returned as failed and retried by the
+# main process.
+#-------------------------------------------------------------------------------
+
+## ====================================== Imports ====================================
+import sys, os, time, json, traceback, random, sqlite3, tempfile
+import arcpy
+
+if sys.version_info[0] >= 3:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError as httpErrors
+    from urllib.parse import urlencode as urllibEncode
+else:
+    from urllib2 import Request, urlopen
+    from urllib2 import HTTPError as httpErrors
+    from urllib import urlencode as urllibEncode
+
+# Seconds before a request to the CLU service times out
+requestTimeout = 300
+
+# Messages returned to the parent process, responses cut off at the WFS record limit
+# and the equivalent CLU service endpoints requests are sent to in turn
+shardState = {'messages':[],'truncated':0,'endpoints':[],'nextEndpoint':0}
+
+## ===================================================================================
+def AddMsgAndPrint(msg, severity=0):
+    # The worker process has no geoprocessing messages (and no console in pythonw);
+    # messages are returned to the parent process and written there.
+    shardState['messages'].append((msg,severity))
+
+## ===================================================================================
+def errorMsg():
+    try:
+
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        theMsg = "\t" + traceback.format_exception(exc_type, exc_value, exc_traceback)[1] + "\n\t" + traceback.format_exception(exc_type, exc_value, exc_traceback)[-1]
+        AddMsgAndPrint(theMsg,2)
+
+    except:
+        AddMsgAndPrint("Unhandled error in unHandledException method", 2)
+        pass
+
+## ===================================================================================
+def resolveEndpoint(url):
+    """ This function will return url re-written to the next configured endpoint.  A
+        worker sends one request at a time so the endpoints are simply used in turn."""
+
+    endpoints = shardState['endpoints']
+    matches = [ep for ep in endpoints if url.startswith(ep)]
+
+    if not matches:
+        return url
+
+    path = url[len(max(matches,key=len)):]
+    endpoint = endpoints[shardState['nextEndpoint'] % len(endpoints)]
+    shardState['nextEndpoint'] += 1
+
+    return endpoint + path
+
+## ===================================================================================
+def submitFSquery(url,INparams):
+    """ This function will send a query to the CLU feature service and convert the
+        results into a python structure.  If the results are an error or empty a 2nd
+        attempt is made after 5 seconds, possibly to a different endpoint.
+
+        Returns requested data via a python dictionary; False if both attempts failed"""
+
+    try:
+        INparams = INparams.encode('ascii')
+
+        for attempt in range(2):
+            if attempt:
+                time.sleep(5)
+
+            resp = urlopen(Request(resolveEndpoint(url),INparams),timeout=requestTimeout)
+            results = json.loads(resp.read())
+
+            if 'error' in results and results['error'].get('message') == 'Invalid Token':
+                AddMsgAndPrint("\tArcGIS Token expired in a worker process; Request will be retried by the main process",1)
+                return False
+
+            if not 'error' in results and len(results) > 0:
+                return results
+
+        AddMsgAndPrint("\t2nd Request Attempt Failed - Error Code: " + str(resp.getcode()) + " -- " + str(results),2)
+        return False
+
+    except httpErrors as e:
+        if int(e.code) < 400:
+            AddMsgAndPrint('HTTP ERROR = ' + str(e.code),2)
+        return False
+
+    except:
+        # i.e. connection refused or timed out
+        errorMsg()
+        return False
+
+## ===================================================================================
+def openCLUidentifierStore(memoryThreshold,spillFolder):
+    """ This function will create the store of clu_identifiers (or object IDs) that
+        have already been inserted by the shard.  Identifiers are kept in a python set
+        until it holds more than memoryThreshold identifiers after which they are
+        moved into a temporary sqlite database in spillFolder."""
+
+    return {'ids':set(),'threshold':memoryThreshold,'spillFolder':spillFolder,'db':None,'dbPath':None}
+
+## ===================================================================================
+def addCLUidentifier(store,cluID):
+    """ This function will add cluID to the store.
+
+        Return True if cluID is new; False if it has already been inserted"""
+
+    if store['db'] is None:
+        if cluID in store['ids']:
+            return False
+        store['ids'].add(cluID)
+
+        if len(store['ids']) > store['threshold']:
+            store['dbPath'] = os.path.join(store['spillFolder'] or tempfile.gettempdir(),"clu_identifiers_" + str(random.randint(1,9999999999)) + ".sqlite")
+            store['db'] = sqlite3.connect(store['dbPath'])
+            store['db'].execute("PRAGMA journal_mode=OFF")
+            store['db'].execute("PRAGMA synchronous=OFF")
+            store['db'].execute("CREATE TABLE clu_ids (clu_identifier TEXT PRIMARY KEY) WITHOUT ROWID")
+            store['db'].executemany("INSERT INTO clu_ids VALUES (?)",[(i,) for i in store['ids']])
+            store['ids'] = set()
+
+        return True
+
+    return store['db'].execute("INSERT OR IGNORE INTO clu_ids VALUES (?)",(cluID,)).rowcount == 1
+
+## ===================================================================================
+def hasCLUidentifier(store,cluID):
+    """ This function will return True if cluID is in the store without adding it."""
+
+    if store['db'] is None:
+        return cluID in store['ids']
+    return store['db'].execute("SELECT 1 FROM clu_ids WHERE clu_identifier = ?",(cluID,)).fetchone() is not None
+
+## ===================================================================================
+def closeCLUidentifierStore(store):
+    """ This function will close and delete the on-disk portion of the store."""
+
+    try:
+        if store['db'] is not None:
+            store['db'].close()
+            os.remove(store['dbPath'])
+            store['db'] = None
+        store['ids'] = set()
+
+    except:
+        errorMsg()
+
+## ===================================================================================
+def getCLUgeometryByExtent(request,fc,RESTurl,shardInfo,cluIdentifiers,ingestedObjectIds):
+    """ This function will retrieve the CLUs of a planned request and insert them into
+        the shard fc.  CLUs already inserted by the shard are skipped.
+
+        request - ['{"rings":...}', 691]  or  ['{"rings":...}', 691, where, pageParams]
+
+        Return True if the CLUs were retrieved and inserted; False otherwise"""
+
+    try:
+        fields = shardInfo['fields']
+        fldsDict = shardInfo['fldsDict']
+        JSONextent = request[0]
+        where = request[2] if len(request) > 2 else None
+        pageParams = request[3] if len(request) > 3 else None
+
+        # Only request the fields (and geometry) that are written to the output
+        outFields = ','.join([fld for fld in fields if fld != 'SHAPE@JSON'])
+        bGeometry = 'SHAPE@JSON' in fields
+        geometryType = 'esriGeometryEnvelope' if JSONextent.find('"xmin"') > -1 else 'esriGeometryPolygon'
+
+        newObjectIds = None
+        if shardInfo['bIDdiffFetching'] and not pageParams:
+            queryParams = {'f':'json',
+                           'geometry':JSONextent,
+                           'geometryType':geometryType,
+                           'returnIdsOnly':'true',
+                           'token':shardInfo['portalToken']['token']}
+            if where:
+                queryParams['where'] = where
+
+            idQuery = submitFSquery(RESTurl,urllibEncode(queryParams))
+            if not idQuery:
+                return False
+
+            # object IDs downloaded by a previous request of this shard are skipped
+            newObjectIds = [oid for oid in idQuery['objectIds'] or [] if not hasCLUidentifier(ingestedObjectIds,oid)]
+            if not newObjectIds:
+                return True
+
+            queryParams = {'f':'json',
+                           'objectIds':','.join([str(oid) for oid in newObjectIds]),
+                           'returnGeometry':'true' if bGeometry else 'false',
+                           'outFields':outFields,
+                           'token':shardInfo['portalToken']['token']}
+
+        else:
+            queryParams = {'f':'json',
+                           'geometry':JSONextent,
+                           'geometryType':geometryType,
+                           'returnGeometry':'true' if bGeometry else 'false',
+                           'outFields':outFields,
+                           'token':shardInfo['portalToken']['token']}
+            if where:
+                queryParams['where'] = where
+            if pageParams:
+                queryParams.update(pageParams)
+
+        geometry = submitFSquery(RESTurl,urllibEncode(queryParams))
+        if not geometry:
+            return False
+
+        # Pages other than the last always exceed the transfer limit
+        if geometry.get('exceededTransferLimit') and not pageParams:
+            AddMsgAndPrint("\tRequest exceeded the WFS record limit -- some CLUs may be missing",1)
+            shardState['truncated'] += 1
+
+        rows = list()
+        for rec in geometry['features']:
+            attributes = rec['attributes']
+
+            if not addCLUidentifier(cluIdentifiers,attributes['clu_identifier']):
+                continue
+
+            values = list()
+            for fld in fields:
+                if fld == "SHAPE@JSON":
+                    continue
+
+                # DATE values need to be converted from Unix Epoch format (ms)
+                elif fldsDict[fld][0] == 'DATE':
+                    dateVal = attributes[fld]
+                    if not dateVal in (None,'null','','Null'):
+                        values.append(time.strftime('%m/%d/%Y',time.gmtime(float(dateVal)/1000)))
+                    else:
+                        values.append(None)
+
+                else:
+                    values.append(attributes[fld])
+
+            # geometry goes at the the end
+            if bGeometry:
+                values.append(json.dumps(rec['geometry']))
+
+            rows.append(values)
+
+        if rows:
+            with arcpy.da.InsertCursor(fc,fields) as cur:
+                for values in rows:
+                    cur.insertRow(values)
+
+        for oid in newObjectIds or []:
+            addCLUidentifier(ingestedObjectIds,oid)
+
+        return True
+
+    except:
+        errorMsg()
+        return False
+
+## ===================================================================================
+def extractShard(shardInfo):
+    """ This function is the worker that downloads a single shard of envelopes in its
+        own process.  CLUs are inserted into a feature class within the worker's own
+        scratch File Geodatabase and de-duplicated within the shard by
+        clu_identifier.  Failed requests are retried once.
+
+        shardInfo - dictionary containing the shard number, envelopes, template fc,
+                    scratch folder, portal token, field info and REST url.
+
+        Returns a tuple containing the shard feature class, a dictionary of
+        requests that failed twice, the number of responses that were cut off
+        at the WFS record limit and the list of (message, severity) tuples.  The
+        shard feature class is False if the shard could not be created."""
+
+    cluIdentifiers = None
+    ingestedObjectIds = None
+
+    try:
+        # a pool worker process can be handed more than one shard
+        shardState.update({'messages':[],'truncated':0,'nextEndpoint':0,
+                           'endpoints':[url.rstrip('/') for url in shardInfo['endpoints']]})
+        cluIdentifiers = openCLUidentifierStore(shardInfo['cluIdentifierMemoryLimit'],shardInfo['scratchFolder'])
+        ingestedObjectIds = openCLUidentifierStore(shardInfo['cluIdentifierMemoryLimit'],shardInfo['scratchFolder'])
+
+        arcpy.env.overwriteOutput = True
+
+        shardGDB = arcpy.CreateFileGDB_management(shardInfo['scratchFolder'],"CLU_shard_" + str(shardInfo['shardNum']) + ".gdb").getOutput(0)
+        if 'SHAPE@JSON' in shardInfo['fields']:
+            shardFC = arcpy.CreateFeatureclass_management(shardGDB,"CLU_shard","POLYGON",shardInfo['templateFC'],
+                                                          "DISABLED","DISABLED",shardInfo['templateFC']).getOutput(0)
+        else:
+            shardFC = arcpy.CreateTable_management(shardGDB,"CLU_shard",shardInfo['templateFC']).getOutput(0)
+
+        failedRequests = dict()
+        for key,envelope in shardInfo['envelopes'].items():
+            if not getCLUgeometryByExtent(envelope,shardFC,shardInfo['RESTurl'],shardInfo,cluIdentifiers,ingestedObjectIds):
+                failedRequests[key] = envelope
+
+        for key,envelope in list(failedRequests.items()):
+            time.sleep(5)
+            if getCLUgeometryByExtent(envelope,shardFC,shardInfo['RESTurl'],shardInfo,cluIdentifiers,ingestedObjectIds):
+                del failedRequests[key]
+
+        return (shardFC,failedRequests,shardState['truncated'],list(shardState['messages']))
+
+    except:
+        errorMsg()
+        return (False,shardInfo['envelopes'],0,list(shardState['messages']))
+
+    finally:
+        if cluIdentifiers:
+            closeCLUidentifierStore(cluIdentifiers)
+        if ingestedObjectIds:
+            closeCLUidentifierStore(ingestedObjectIds)